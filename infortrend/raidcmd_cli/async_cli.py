@@ -0,0 +1,228 @@
+# Copyright (c) 2015 Infortrend Technology, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+Infortrend asyncio CLI.
+
+Drive raidcmd from asyncio code such as inventory or cleanup tools::
+
+    async with AsyncRaidcmdSession(java_path, cli_path) as session:
+        await session.connect('172.27.0.1', password)
+        rc, out = await session.run('show part', '-l')
+
+Commands are built and parsed by the cli_factory command classes and
+read through the same RaidcmdOutput as the driver, so return codes,
+retries and parse results match CLIBaseCommand.execute.
+"""
+import asyncio
+import os
+import pty
+
+from oslo_log import log as logging
+from oslo_utils import strutils
+
+from cinder import exception
+from cinder.i18n import _
+from cinder.volume.drivers.infortrend.raidcmd_cli import cli_factory as cli
+
+LOG = logging.getLogger(__name__)
+
+_COMMANDS = {}
+
+
+def get_command(command):
+    """Return the command class of a class name or a raidcmd command.
+
+    :param command: a class name such as 'ShowPartition', or the raidcmd
+                    command such as 'show part'
+    """
+    command_class = getattr(cli, command, None)
+    if (isinstance(command_class, type) and
+            issubclass(command_class, cli.CLIBaseCommand)):
+        return command_class
+
+    if not _COMMANDS:
+        for command_class in _all_commands(cli.CLIBaseCommand):
+            line = command_class({}).command
+            if line:
+                _COMMANDS[line] = command_class
+
+    try:
+        return _COMMANDS[command]
+    except KeyError:
+        msg = _('Unknown raidcmd command: %s.') % command
+        raise exception.VolumeDriverException(message=msg)
+
+
+def _all_commands(command_class):
+    for subclass in command_class.__subclasses__():
+        yield subclass
+        for subsubclass in _all_commands(subclass):
+            yield subsubclass
+
+
+def _set_readable(readable):
+    if not readable.done():
+        readable.set_result(None)
+
+
+class AsyncRaidcmdSession(object):
+
+    """A raidcmd process driven from asyncio.
+
+    One command runs at a time per session. Open a session per array,
+    or several, to run queries concurrently.
+    """
+
+    def __init__(self, java_path, cli_path, raidcmd_timeout=60,
+                 cli_retry_time=None, cli_cache=False,
+                 raidcmd_max_timeout=600):
+        self.java_path = java_path
+        self.cli_path = cli_path
+        self.cli_conf = {
+            'cli_retry_time': cli_retry_time,
+            'raidcmd_timeout': raidcmd_timeout,
+            'raidcmd_max_timeout': raidcmd_max_timeout,
+            'cli_cache': cli_cache,
+            # eventlet.sleep would block the asyncio loop.
+            'parse_yield': None,
+        }
+        self.process = None
+        self.fd = None
+        self.broken = False
+        self._lock = None
+        self._connect_parameters = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def start(self, timeout=10):
+        """Spawn raidcmd and return its output until the first prompt."""
+        master, slave = pty.openpty()
+        try:
+            self.process = await asyncio.create_subprocess_exec(
+                self.java_path, '-jar', self.cli_path,
+                stdin=slave, stdout=slave, stderr=slave,
+                start_new_session=True)
+        except Exception:
+            os.close(master)
+            raise
+        finally:
+            os.close(slave)
+
+        os.set_blocking(master, False)
+        self.fd = master
+        self.broken = False
+        return await self._read(cli.RaidcmdOutput('RAIDCmd:>', timeout))
+
+    async def connect(self, ip, password=None):
+        parameters = [ip]
+        if password:
+            parameters.append('password=%s' % password)
+        parameters.append('-notiOn')
+        # A reopened raidcmd connects again with these.
+        self._connect_parameters = tuple(parameters)
+        return await self.run('ConnectRaid', *parameters)
+
+    async def run(self, command, *parameters):
+        """Run a raidcmd command.
+
+        :param command: a command class name or raidcmd command, see
+                        get_command
+        :returns: (rc, out) as CLIBaseCommand.execute returns them
+        """
+        cli_command = get_command(command)(self.cli_conf)
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            total_retry_time = cli.retry_limit(cli_command)
+
+            retry_time = 0
+            while retry_time < total_retry_time:
+                if self.broken:
+                    await self._reopen()
+                rc, out = await self._execute(cli_command, parameters)
+                retry_time += 1
+
+                if not cli.should_retry(cli_command, retry_time, rc, out):
+                    break
+
+            cli.log_return(cli_command, rc, out)
+            return rc, out
+
+    async def close(self):
+        if self.fd is not None:
+            try:
+                os.close(self.fd)
+            except OSError:
+                pass
+            self.fd = None
+        if self.process is not None:
+            if self.process.returncode is None:
+                self.process.kill()
+                await self.process.wait()
+            self.process = None
+
+    async def _reopen(self):
+        """Replace a raidcmd that timed out or closed."""
+        LOG.warning('Reopening the broken raidcmd session.')
+        await self.close()
+        await self.start()
+        if self._connect_parameters is not None:
+            await self._execute(get_command('ConnectRaid')(self.cli_conf),
+                                self._connect_parameters)
+
+    async def _execute(self, cli_command, parameters):
+        command_line = cli_command._generate_command(parameters)
+        LOG.debug('Executing: %(command)s', {
+            'command': strutils.mask_password(command_line)})
+
+        os.write(self.fd, command_line.encode('utf-8'))
+        content = await self._read(cli.RaidcmdOutput(
+            'RAIDCmd:>', self.cli_conf['raidcmd_timeout'],
+            max_timeout=self.cli_conf['raidcmd_max_timeout']))
+
+        rc, out = cli_command._parser(content)
+        if rc == -3:
+            self.broken = True
+        return rc, out
+
+    async def _read(self, output):
+        while True:
+            remaining = output.remaining()
+            if remaining <= 0:
+                return output.timeout()
+
+            try:
+                await self._wait_readable(remaining)
+            except asyncio.TimeoutError:
+                continue
+
+            content = cli.os_drain(self.fd, output)
+            if content is not None:
+                return content
+
+    async def _wait_readable(self, timeout):
+        loop = asyncio.get_running_loop()
+        readable = loop.create_future()
+        loop.add_reader(self.fd, _set_readable, readable)
+        try:
+            await asyncio.wait_for(readable, timeout)
+        finally:
+            loop.remove_reader(self.fd)
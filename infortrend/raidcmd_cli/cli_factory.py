@@ -17,12 +17,24 @@ Infortrend basic CLI factory.
 """
 
 import abc
+import codecs
+import collections
+from collections import abc as collections_abc
+import contextlib
 import os
+import re
+import signal
+import threading
 import time
 
+import eventlet
+from eventlet import hubs
+from eventlet import patcher
 from oslo_concurrency import processutils
 from oslo_log import log as logging
+from oslo_utils import excutils
 from oslo_utils import strutils
+from oslo_utils import units
 import six
 
 from cinder import utils
@@ -31,71 +43,433 @@ LOG = logging.getLogger(__name__)
 
 DEFAULT_RETRY_TIME = 5
 
+# Return codes not worth a retry: RAID return fail (1), not exist (11)
+# and already exist (20).
+NO_RETRY_RC = (1, 11, 20)
+
+# Rows parsed between yields to other greenthreads.
+PARSE_YIELD_ROWS = 500
+
+# The characters of a show output split into lines at once.
+PARSE_CHUNK_SIZE = 64 * 1024
+
+# The largest single read from the raidcmd pty.
+MAX_READ_SIZE = 1024 * 1024
+
+# The lock key of a change whose array objects are not known.
+ARRAY_LOCK_KEY = 'raidcmd'
+
+# The green os.read waits for more output instead of raising EAGAIN.
+os_read_nonblocking = patcher.original('os').read
+
 
 def retry_cli(func):
     def inner(self, *args, **kwargs):
-        total_retry_time = self.cli_retry_time
-
-        if total_retry_time is None:
-            total_retry_time = DEFAULT_RETRY_TIME
+        total_retry_time = retry_limit(self)
 
         retry_time = 0
         while retry_time < total_retry_time:
             rc, out = func(self, *args, **kwargs)
             retry_time += 1
 
-            if rc == 0:
+            if not should_retry(self, retry_time, rc, out):
                 break
-
-            LOG.error(
-                'Retry %(retry)s times: %(method)s Failed '
-                '%(rc)s: %(reason)s', {
-                    'retry': retry_time,
-                    'method': self.__class__.__name__,
-                    'rc': rc,
-                    'reason': out})
-
-            # show error log, not retrying
-            if rc == 1:
-                # RAID return fail
-                break
-            elif rc == 11:
-                # rc == 11 means not exist
-                break
-            elif rc == 20:
-                # rc == 20 means already exist
+            if rc == -3:
+                # Late output of the timed out run would be read as the
+                # result of the retry, the caller retries on another
+                # session.
                 break
 
-        LOG.debug(
-            'Method: %(method)s Return Code: %(rc)s '
-            'Output: %(out)s', {
-                'method': self.__class__.__name__, 'rc': rc, 'out': out})
+        log_return(self, rc, out)
         return rc, out
     return inner
 
 
-def os_execute(fd, raidcmd_timeout, command_line):
+def retry_limit(command):
+    if command.cli_retry_time is None:
+        return DEFAULT_RETRY_TIME
+    return command.cli_retry_time
+
+
+def should_retry(command, retry_time, rc, out):
+    """Tell whether a failed run is worth another try, log the failure."""
+    if rc == 0:
+        return False
+
+    LOG.error(
+        'Retry %(retry)s times: %(method)s Failed '
+        '%(rc)s: %(reason)s', {
+            'retry': retry_time,
+            'method': command.__class__.__name__,
+            'rc': rc,
+            'reason': out})
+
+    # show error log, not retrying
+    return rc not in NO_RETRY_RC
+
+
+def log_return(command, rc, out):
+    LOG.debug(
+        'Method: %(method)s Return Code: %(rc)s '
+        'Output: %(out)s', {
+            'method': command.__class__.__name__, 'rc': rc, 'out': out})
+
+
+def os_execute(fd, raidcmd_timeout, command_line, max_timeout=None):
+    start_time = time.time()
     os.write(fd, command_line.encode('utf-8'))
-    return os_read(fd, 8192, 'RAIDCmd:>', raidcmd_timeout)
+    write_time = time.time()
+
+    timing = {}
+    content = os_read(fd, 8192, 'RAIDCmd:>', raidcmd_timeout, timing,
+                      max_timeout)
+
+    LOG.debug(
+        'Raidcmd latency [%(command)s]: write %(write).3fs, '
+        'first output %(first).3fs, prompt %(prompt).3fs.', {
+            'command': strutils.mask_password(command_line.strip()),
+            'write': write_time - start_time,
+            'first': timing.get('first_output', -1),
+            'prompt': timing.get('prompt', -1)})
+    return content
+
+
+def os_read(fd, buffer_size, cmd_pattern, raidcmd_timeout, timing=None,
+            max_timeout=None):
+    """Read raidcmd output until the prompt shows up.
 
+    Wait on the fd readiness through the eventlet hub, so the read
+    returns as soon as the prompt arrives and other greenthreads keep
+    running meanwhile. Each wakeup drains everything raidcmd has
+    written so far.
 
-def os_read(fd, buffer_size, cmd_pattern, raidcmd_timeout):
-    content = ''
-    start_time = int(time.time())
+    :param raidcmd_timeout: the longest gap in seconds between outputs
+    :param timing: optional dict filled with the seconds spent until the
+                   first output ('first_output') and the prompt ('prompt')
+    :param max_timeout: the longest time in seconds for the whole output
+    """
+    os.set_blocking(fd, False)
+    output = RaidcmdOutput(cmd_pattern, raidcmd_timeout, timing,
+                           max_timeout, buffer_size)
     while True:
-        time.sleep(0.5)
-        output = os.read(fd, buffer_size)
-        if len(output) > 0:
-            content += output.decode('utf-8')
-        if content.find(cmd_pattern) >= 0:
-            break
-        if int(time.time()) - start_time > raidcmd_timeout:
-            content = 'Raidcmd timeout: %s' % content
+        remaining = output.remaining()
+        if remaining <= 0:
+            return output.timeout()
+
+        try:
+            hubs.trampoline(fd, read=True, timeout=remaining)
+        except eventlet.Timeout:
+            continue
+
+        content = os_drain(fd, output)
+        if content is not None:
+            return content
+
+
+def os_drain(fd, output):
+    """Read everything available on a non-blocking fd into the output.
+
+    :returns: the raidcmd output once the prompt shows up or raidcmd
+              closed the pty, None while more output is expected
+    """
+    while True:
+        try:
+            data = os_read_nonblocking(fd, output.read_size)
+        except BlockingIOError:
+            return None
+        except OSError:
+            # The pty raises EIO once raidcmd has exited.
+            data = b''
+        if len(data) == 0:
+            return output.closed()
+
+        if output.feed(data):
+            return output.content
+
+
+class RaidcmdOutput(object):
+
+    """The output of one raidcmd command, up to the prompt.
+
+    It does no I/O by itself: the synchronous reader above and the
+    asyncio session feed it whatever they read from the raidcmd pty.
+
+    A command times out once raidcmd stays silent for raidcmd_timeout
+    seconds, or once the whole output takes longer than max_timeout
+    seconds, so large listings can stream for as long as they need.
+    """
+
+    def __init__(self, cmd_pattern, raidcmd_timeout, timing=None,
+                 max_timeout=None, read_size=8192):
+        self.cmd_pattern = cmd_pattern
+        self.raidcmd_timeout = raidcmd_timeout
+        self.max_timeout = max_timeout or raidcmd_timeout
+        self.timing = timing
+        self.read_size = read_size
+        self.start_time = time.time()
+        self.last_output_time = self.start_time
+        self._pattern = cmd_pattern.encode('utf-8')
+        self._buffer = bytearray()
+        self._decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self._decoded = 0
+        self._text = ''
+        # The bytes searched for the prompt, each about once.
+        self.scanned = 0
+
+    @property
+    def content(self):
+        """The output decoded so far.
+
+        Only the bytes arrived since the last call are decoded. A
+        multi-byte character split across reads is kept back until
+        its remaining bytes arrive.
+        """
+        self._text += self._decode()
+        return self._text
+
+    def _decode(self):
+        if self._decoded == len(self._buffer):
+            return ''
+        with memoryview(self._buffer) as view:
+            text = self._decoder.decode(view[self._decoded:])
+        self._decoded = len(self._buffer)
+        return text
+
+    def remaining(self):
+        """Return the seconds left before the command times out."""
+        now = time.time()
+        return min(self.raidcmd_timeout - (now - self.last_output_time),
+                   self.max_timeout - (now - self.start_time))
+
+    def feed(self, data):
+        """Add read bytes, return True once the prompt has arrived."""
+        self.last_output_time = time.time()
+        if self.timing is not None and 'first_output' not in self.timing:
+            self.timing['first_output'] = (
+                self.last_output_time - self.start_time)
+
+        # Large listings come in full reads, read more at once.
+        if len(data) >= self.read_size:
+            self.read_size = min(self.read_size * 2, MAX_READ_SIZE)
+
+        # Only scan the new bytes, plus enough of the old ones to catch
+        # a prompt split across reads.
+        start = max(0, len(self._buffer) - len(self._pattern) + 1)
+        self._buffer += data
+        self.scanned += len(self._buffer) - start
+        found = self._buffer.find(self._pattern, start) >= 0
+
+        if found:
+            if self.timing is not None:
+                self.timing['prompt'] = time.time() - self.start_time
+            return True
+        return False
+
+    def timeout(self):
+        if time.time() - self.start_time >= self.max_timeout:
+            LOG.error(
+                'Raidcmd exceeds cli max timeout [%(timeout)s]s.', {
+                    'timeout': self.max_timeout})
+        else:
             LOG.error(
                 'Raidcmd exceeds cli timeout [%(timeout)s]s.', {
-                    'timeout': raidcmd_timeout})
-            break
-    return content
+                    'timeout': self.raidcmd_timeout})
+        return 'Raidcmd timeout: %s' % self.content
+
+    def closed(self):
+        LOG.error('Raidcmd closed the connection.')
+        return 'Raidcmd closed: %s' % self.content
+
+
+class RaidcmdSession(object):
+
+    """A raidcmd process running on its own pty."""
+
+    def __init__(self, java_path, cli_path):
+        self.java_path = java_path
+        self.cli_path = cli_path
+        self.pid = None
+        self.fd = None
+        self.connected = False
+        self.broken = False
+
+    def start(self, timeout=10):
+        """Fork raidcmd and return its output until the first prompt."""
+        self.pid, self.fd = os.forkpty()
+        if self.pid == 0:
+            try:
+                os.execv(self.java_path,
+                         [self.java_path, '-jar', self.cli_path])
+            finally:
+                # Never fall back into the driver code in the child.
+                os._exit(1)
+
+        return os_read(self.fd, 1024, 'RAIDCmd:>', timeout)
+
+    def is_alive(self):
+        if self.pid is None:
+            return False
+        try:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+        except OSError:
+            return False
+        return pid == 0
+
+    def close(self):
+        if self.fd is not None:
+            hubs.notify_close(self.fd)
+            try:
+                os.close(self.fd)
+            except OSError:
+                pass
+        if self.pid is not None:
+            try:
+                os.kill(self.pid, signal.SIGKILL)
+                os.waitpid(self.pid, 0)
+            except OSError:
+                pass
+        self.pid = None
+        self.fd = None
+        self.connected = False
+
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+PRIORITY_BULK = 2
+
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: 'interactive',
+    PRIORITY_BACKGROUND: 'background',
+    PRIORITY_BULK: 'bulk',
+}
+
+
+class RaidcmdSessionPool(object):
+
+    """A pool of connected raidcmd sessions.
+
+    A command checks out one idle session for its whole run. When every
+    session is busy, a released session goes to the waiting command with
+    the best priority. A command is promoted one priority level for every
+    ``aging`` seconds it waits, so background and bulk commands are not
+    starved by interactive ones.
+
+    Sessions whose process died, or which are marked broken, are replaced
+    by ``spawn``; sessions which are not connected are passed to
+    ``connect`` before they are handed out.
+    """
+
+    def __init__(self, size, spawn, connect, aging=5):
+        self.size = size
+        self.aging = aging
+        self._spawn = spawn
+        self._connect = connect
+        self._sessions = []
+        self._idle = collections.deque()
+        self._waiters = []
+        self._lock = threading.Lock()
+        self._stats = dict(
+            (priority, {
+                'waiting': 0,
+                'max_waiting': 0,
+                'commands': 0,
+                'wait_time': 0.0,
+                'max_wait_time': 0.0,
+            }) for priority in PRIORITY_NAMES)
+
+    def start(self):
+        for _i in range(self.size):
+            session = self._spawn()
+            self._sessions.append(session)
+            self._put(session)
+
+    @contextlib.contextmanager
+    def session(self, priority=PRIORITY_INTERACTIVE):
+        session = self._checkout(priority)
+        try:
+            yield session
+        finally:
+            self._put(session)
+
+    def reconnect(self):
+        """Make every session run the connect bootstrap again."""
+        for session in self._sessions:
+            session.connected = False
+
+    def stats(self):
+        """Return the queue counters of each priority class."""
+        with self._lock:
+            return dict((PRIORITY_NAMES[priority], dict(counters))
+                        for priority, counters in self._stats.items())
+
+    def _checkout(self, priority):
+        start_time = time.time()
+        stats = self._stats[priority]
+        with self._lock:
+            if self._idle and not self._waiters:
+                session = self._idle.popleft()
+                waiter = None
+            else:
+                session = None
+                waiter = {
+                    'priority': priority,
+                    'time': start_time,
+                    'event': threading.Event(),
+                    'session': None,
+                }
+                self._waiters.append(waiter)
+                stats['waiting'] += 1
+                stats['max_waiting'] = max(
+                    stats['max_waiting'], stats['waiting'])
+
+        if waiter:
+            waiter['event'].wait()
+            session = waiter['session']
+
+        wait_time = time.time() - start_time
+        with self._lock:
+            if waiter:
+                stats['waiting'] -= 1
+            stats['commands'] += 1
+            stats['wait_time'] += wait_time
+            stats['max_wait_time'] = max(stats['max_wait_time'], wait_time)
+
+        try:
+            if session.broken or not session.is_alive():
+                LOG.warning('Raidcmd [%(pid)s] is not usable, respawn it.', {
+                    'pid': session.pid})
+                session = self._replace(session)
+            if not session.connected:
+                self._connect(session)
+                session.connected = True
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                self._put(session)
+        return session
+
+    def _replace(self, session):
+        session.close()
+        new_session = self._spawn()
+        self._sessions[self._sessions.index(session)] = new_session
+        return new_session
+
+    def _next_waiter(self):
+        now = time.time()
+        return min(
+            self._waiters,
+            key=lambda waiter: (
+                waiter['priority'] - (now - waiter['time']) / self.aging,
+                waiter['time']))
+
+    def _put(self, session):
+        with self._lock:
+            if not self._waiters:
+                self._idle.append(session)
+                return
+            waiter = self._next_waiter()
+            self._waiters.remove(waiter)
+            waiter['session'] = session
+            waiter['event'].set()
 
 
 def strip_empty_in_list(list):
@@ -108,42 +482,316 @@ def strip_empty_in_list(list):
     return result
 
 
-def table_to_dict(table):
-    tableHeader = table[0].split("  ")
-    tableHeaderList = strip_empty_in_list(tableHeader)
+def parse_int(value):
+    """Return a number column as int, None for '---' and the like."""
+    try:
+        return int(value)
+    except ValueError:
+        return None
 
-    result = []
 
-    for i in range(len(table) - 2):
-        if table[i + 2].strip() == "":
-            break
+def parse_bool(value):
+    """Return a true/false or Yes/No column as bool, None if neither."""
+    value = value.lower()
+    if value in ('true', 'yes'):
+        return True
+    if value in ('false', 'no'):
+        return False
+    return None
 
-        resultEntry = {}
-        tableEntry = table[i + 2].split("  ")
-        tableEntryList = strip_empty_in_list(tableEntry)
 
-        for key, value in zip(tableHeaderList, tableEntryList):
-            resultEntry[key] = value
+# Size units of raidcmd in MB.
+SIZE_UNITS_MB = (('TB', units.Mi), ('GB', units.Ki), ('MB', 1))
 
-        result.append(resultEntry)
-    return result
 
+def parse_size_mb(value):
+    """Return a size column, such as '418.93 GB' or '10 GB(2.4%)', in MB.
 
-def content_lines_to_dict(content_lines):
-    result = []
-    resultEntry = {}
+    Plain numbers, as in show part, are already in MB.
+    """
+    size, _sep, unit = value.partition(' ')
+    try:
+        size = float(size)
+    except ValueError:
+        return None
+    if not unit:
+        return int(round(size))
+    for name, factor in SIZE_UNITS_MB:
+        if unit.startswith(name):
+            return int(round(size * factor))
 
-    for content_line in content_lines:
+    LOG.warning('Size [%(size)s], the unit is not recognized.', {
+        'size': value})
+    return None
 
-        if content_line.strip() == "":
-            result.append(resultEntry)
-            resultEntry = {}
-            continue
 
-        split_entry = content_line.strip().split(": ", 1)
-        resultEntry[split_entry[0]] = split_entry[1]
+class TableColumns(object):
 
-    return result
+    """The column spans of a raidcmd table, taken from its header.
+
+    raidcmd pads every column to its widest cell, so rows are cut at
+    the offsets where the header names start. Empty cells and cells
+    with double spaces then stay in their own column.
+    """
+
+    HEADER_NAME = re.compile(r'\S+(?: \S+)*')
+
+    def __init__(self, header, names=None):
+        starts = self._find_names(header, names) if names else None
+        if starts is None:
+            names, starts = [], []
+            for match in self.HEADER_NAME.finditer(header):
+                names.append(match.group())
+                starts.append(match.start())
+
+        self.names = tuple(names)
+        # Each cell but the last is followed by the blank character left
+        # of the next column, rows that do not line up do not match.
+        pattern = ' {%d}' % (starts[0] if starts else 0)
+        for start, end in zip(starts, starts[1:]):
+            pattern += '(.{%d}) ' % (end - start - 1)
+        self._row = re.compile(pattern + '(.*)')
+
+    @staticmethod
+    def _find_names(header, names):
+        """Return the offsets of known column names, None on mismatch."""
+        starts = []
+        end = 0
+        for name in names:
+            start = header.find(name, end)
+            if start < 0 or header[end:start].strip():
+                return None
+            starts.append(start)
+            end = start + len(name)
+        if header[end:].strip():
+            return None
+        return starts
+
+    def split(self, line):
+        """Return the cells of a row, or None if it does not line up."""
+        match = self._row.match(line)
+        if match is None:
+            return None
+        return list(map(str.strip, match.groups()))
+
+
+class ShowRow(collections_abc.Mapping):
+
+    """A parsed show command row, read like a read-only dict.
+
+    The columns a command always prints live in __slots__, so the rows
+    of large listings carry neither a dict nor copies of the keys each.
+    Columns unknown to the class go to a dict of their own.
+    """
+
+    __slots__ = ('_extra',)
+
+    # The known column names and the slots holding them.
+    COLUMNS = {}
+
+    def __init__(self, fields):
+        self._extra = None
+        for key, value in fields.items():
+            slot = self.COLUMNS.get(key)
+            if slot is not None:
+                setattr(self, slot, value)
+            elif self._extra is None:
+                self._extra = {key: value}
+            else:
+                self._extra[key] = value
+
+    def __getitem__(self, key):
+        slot = self.COLUMNS.get(key)
+        if slot is None:
+            if self._extra is None:
+                raise KeyError(key)
+            return self._extra[key]
+        try:
+            return getattr(self, slot)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __iter__(self):
+        for key, slot in self.COLUMNS.items():
+            if hasattr(self, slot):
+                yield key
+        if self._extra is not None:
+            for key in self._extra:
+                yield key
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, dict(self))
+
+
+def show_row_class(name, columns):
+    """Create a ShowRow class for the given column names."""
+    slots = tuple(column.lower().replace('-', '_') for column in columns)
+    return type(name, (ShowRow,), {
+        '__slots__': slots,
+        'COLUMNS': dict(zip(columns, slots)),
+    })
+
+
+PartitionRow = show_row_class('PartitionRow', (
+    'ID', 'Name', 'LV-ID', 'Size', 'Used', 'Min-reserve', 'Creation-time',
+    'Last-modification-time', 'Valid-filled-block', 'Total-filled-block',
+    'Progress', 'Mapped', 'Mapping'))
+
+MapRow = show_row_class('MapRow', (
+    'Ch', 'Target', 'LUN', 'Media', 'Name', 'ID', 'Host-ID'))
+
+SnapshotRow = show_row_class('SnapshotRow', (
+    'Index', 'SI-ID', 'ID', 'Name', 'Partition-ID', 'LV-ID', 'Map',
+    'Activated-time', 'Created-time', 'Last-modification-time',
+    'Activation-schedule-time', 'Used', 'Valid-filled-block',
+    'Total-filled-block', 'Description', 'Mapped', 'Mapping'))
+
+ReplicaRow = show_row_class('ReplicaRow', (
+    'Pair-ID', 'Name', 'Source-Device', 'Source', 'Source-Type',
+    'Source-Name', 'Source-LV', 'Source-VS', 'Source-Mapped',
+    'Target-Device', 'Target', 'Target-Type', 'Target-Name', 'Target-LV',
+    'Target-VS', 'Target-Mapped', 'Type', 'Priority', 'Timeout',
+    'Incremental', 'Compression', 'Status', 'Progress', 'Created-time',
+    'Sync-commence-time', 'Split-time', 'Completed-time', 'Description'))
+
+
+class ShowOutputParser(object):
+
+    """Turn show command output into rows while it arrives.
+
+    Like RaidcmdOutput it does no I/O: feed it the decoded output in
+    chunks of any size and it returns the rows they complete. Only the
+    unfinished line, the row being built and the last lines, which may
+    turn out to be the footer, are kept.
+    """
+
+    # The CLI result, the return code, a blank line and the prompt.
+    FOOTER_LINES = 4
+
+    def __init__(self, command):
+        self.command = command
+        self.detect_type = command.detect_type()
+        self._partial = ''
+        self._blank_lines = 0
+        self._lines = collections.deque()
+        self._count = 0
+        self._parsed = 0
+        self._skip = -1
+        self._columns = None
+        self._entry = {}
+        self._done = False
+        self._rows = 0
+        self.rc = None
+        self.out = None
+
+    def feed(self, text):
+        """Add decoded output, return the rows it completes."""
+        rows = []
+        lines = (self._partial + text).split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self._push(line, rows)
+        return rows
+
+    def close(self):
+        """Finish the output, return the rows it still completes.
+
+        The return code and the error output, if any, are then left in
+        self.rc and self.out.
+        """
+        rows = []
+        if self._partial.strip() != '':
+            self._push(self._partial, rows)
+        self._partial = ''
+
+        self.rc, self.out = self.command._parse_return(list(self._lines))
+        if self.rc == 0:
+            self.out = None
+        return rows
+
+    def _push(self, line, rows):
+        line = line.replace('\r', '').replace('\\/-', '')
+
+        # Leading and trailing blank lines do not count.
+        if line.strip() == '':
+            if self._count:
+                self._blank_lines += 1
+            return
+        for i in range(self._blank_lines):
+            self._queue('', rows)
+        self._blank_lines = 0
+        self._queue(line, rows)
+
+    def _queue(self, line, rows):
+        self._count += 1
+        self._lines.append(line)
+        if len(self._lines) > self.FOOTER_LINES:
+            self._parse_line(self._lines.popleft(), rows)
+
+    def _parse_line(self, line, rows):
+        index = self._parsed
+        self._parsed += 1
+        # The first line echoes the command.
+        if index == 0 or self._done:
+            return
+
+        if self._skip < 0:
+            self._skip = self._detect_start(line)
+            if self._skip < 0:
+                return
+            if self.detect_type != 'list':
+                self._columns = TableColumns(
+                    line, self.command.table_columns)
+        if self._skip > 0:
+            self._skip -= 1
+            return
+
+        if self.detect_type == 'list':
+            self._parse_detail_line(line, rows)
+        else:
+            self._parse_table_line(line, rows)
+
+    def _detect_start(self, line):
+        """Return how many lines after this one the rows start, or -1."""
+        if self.detect_type == 'list':
+            return self.command.detect_detail_start(line)
+        if self.command.detect_table_start(line):
+            # Skip the header and the separator line.
+            return 2
+        return -1
+
+    def _parse_table_line(self, line, rows):
+        if line.strip() == '':
+            self._done = True
+            return
+        entry = self._columns.split(line)
+        if entry is None:
+            entry = strip_empty_in_list(line.split('  '))
+        self._emit(dict(zip(self._columns.names, entry)), rows)
+
+    def _parse_detail_line(self, line, rows):
+        if line.strip() == '':
+            self._emit(self._entry, rows)
+            self._entry = {}
+            return
+        split_entry = line.strip().split(': ', 1)
+        self._entry[split_entry[0]] = split_entry[1]
+
+    def _emit(self, row, rows):
+        for key, convert in self.command.schema.items():
+            value = row.get(key)
+            if value is not None:
+                row[key] = convert(value)
+        if self.command.row_class is not None:
+            row = self.command.row_class(row)
+        rows.append(row)
+        self._rows += 1
+        if (self._rows % PARSE_YIELD_ROWS == 0 and
+                self.command.parse_yield is not None):
+            self.command.parse_yield()
 
 
 @six.add_metaclass(abc.ABCMeta)
@@ -214,11 +862,18 @@ class CLIBaseCommand(BaseCommand):
 
     """The CLIBaseCommand class."""
 
+    # Whether the command leaves the array configuration unchanged.
+    read_only = False
+
     def __init__(self, cli_conf):
         super(CLIBaseCommand, self).__init__()
         self.cli_retry_time = cli_conf.get('cli_retry_time')
         self.raidcmd_timeout = cli_conf.get('raidcmd_timeout')
+        self.raidcmd_max_timeout = cli_conf.get('raidcmd_max_timeout')
         self.cli_cache = cli_conf.get('cli_cache')
+        # Lets other greenthreads run while a long output is parsed,
+        # None where nothing else runs in the meantime, as in asyncio.
+        self.parse_yield = cli_conf.get('parse_yield', eventlet.sleep)
         self.pid = cli_conf.get('pid')
         self.fd = cli_conf.get('fd')
         self.command = ""
@@ -226,6 +881,27 @@ class CLIBaseCommand(BaseCommand):
         self.show_noinit = ""
         self.command_line = ""
 
+    @classmethod
+    def lock_keys(cls, *parameters):
+        """Return the keys of the array objects changed by the command.
+
+        Commands sharing a key must not run at the same time, commands
+        without keys can run at any time. ARRAY_LOCK_KEY stands for
+        objects not known, a command with it must not run along any
+        other change.
+        """
+        if cls.read_only:
+            return ()
+        try:
+            return cls._object_keys(*parameters)
+        except (IndexError, TypeError):
+            # Unknown parameters layout.
+            return (ARRAY_LOCK_KEY,)
+
+    @classmethod
+    def _object_keys(cls, *parameters):
+        return (ARRAY_LOCK_KEY,)
+
     def _generate_command(self, parameters):
         """Generate execute Command. use java, execute, command, parameters."""
         self.parameters = parameters
@@ -284,12 +960,14 @@ class CLIBaseCommand(BaseCommand):
 
     def _execute(self, command_line):
         return os_execute(
-            self.fd, self.raidcmd_timeout, command_line)
+            self.fd, self.raidcmd_timeout, command_line,
+            self.raidcmd_max_timeout)
 
     def _parse_return(self, content_lines):
         """Get the end of command line result."""
         rc = 0
-        if 'Raidcmd timeout' in content_lines[0]:
+        if ('Raidcmd timeout' in content_lines[0] or
+                'Raidcmd closed' in content_lines[0]):
             rc = -3
             return_cli_result = content_lines
         elif len(content_lines) < 4:
@@ -307,6 +985,8 @@ class ConnectRaid(CLIBaseCommand):
 
     """The Connect Raid Command."""
 
+    read_only = True
+
     def __init__(self, *args, **kwargs):
         super(ConnectRaid, self).__init__(*args, **kwargs)
         self.command = "connect"
@@ -316,6 +996,8 @@ class CheckConnection(CLIBaseCommand):
 
     """The Check Connection Command."""
 
+    read_only = True
+
     def __init__(self, *args, **kwargs):
         super(CheckConnection, self).__init__(*args, **kwargs)
         self.command = "lock"
@@ -324,6 +1006,8 @@ class CheckConnection(CLIBaseCommand):
 class InitCache(CLIBaseCommand):
     """Refresh cacahe data for update volume status."""
 
+    read_only = True
+
     def __init__(self, *args, **kwargs):
         super(InitCache, self).__init__(*args, **kwargs)
         self.command = "utility init-cache"
@@ -361,6 +1045,10 @@ class CreatePartition(CLIBaseCommand):
         super(CreatePartition, self).__init__(*args, **kwargs)
         self.command = "create part"
 
+    @classmethod
+    def _object_keys(cls, *parameters):
+        return ('part-name-%s' % parameters[1],)
+
 
 class DeletePartition(CLIBaseCommand):
 
@@ -373,6 +1061,10 @@ class DeletePartition(CLIBaseCommand):
         super(DeletePartition, self).__init__(*args, **kwargs)
         self.command = "delete part"
 
+    @classmethod
+    def _object_keys(cls, *parameters):
+        return ('part-%s' % parameters[0],)
+
 
 class SetPartition(CLIBaseCommand):
 
@@ -390,6 +1082,14 @@ class SetPartition(CLIBaseCommand):
         super(SetPartition, self).__init__(*args, **kwargs)
         self.command = "set part"
 
+    SUB_COMMANDS = ('expand', 'purge', 'reclaim', 'tier-resided')
+
+    @classmethod
+    def _object_keys(cls, *parameters):
+        if parameters[0] in cls.SUB_COMMANDS:
+            return ('part-%s' % parameters[1],)
+        return ('part-%s' % parameters[0],)
+
 
 class SetLV(CLIBaseCommand):
 
@@ -402,6 +1102,14 @@ class SetLV(CLIBaseCommand):
         super(SetLV, self).__init__(*args, **kwargs)
         self.command = "set lv"
 
+    @classmethod
+    def _object_keys(cls, *parameters):
+        for parameter in parameters:
+            if parameter.startswith('part='):
+                return tuple('part-%s' % part_id
+                             for part_id in parameter[5:].split(','))
+        return ('lv-%s' % parameters[1],)
+
 
 class SetSnapshot(CLIBaseCommand):
 
@@ -414,6 +1122,10 @@ class SetSnapshot(CLIBaseCommand):
         super(SetSnapshot, self).__init__(*args, **kwargs)
         self.command = "set si"
 
+    @classmethod
+    def _object_keys(cls, *parameters):
+        return ('si-%s' % parameters[0],)
+
 
 class CreateMap(CLIBaseCommand):
 
@@ -428,6 +1140,11 @@ class CreateMap(CLIBaseCommand):
         super(CreateMap, self).__init__(*args, **kwargs)
         self.command = "create map"
 
+    @classmethod
+    def _object_keys(cls, *parameters):
+        return ('part-%s' % parameters[1],
+                'lun-%s-%s-%s' % parameters[2:5])
+
 
 class DeleteMap(CLIBaseCommand):
 
@@ -442,6 +1159,10 @@ class DeleteMap(CLIBaseCommand):
         super(DeleteMap, self).__init__(*args, **kwargs)
         self.command = "delete map"
 
+    @classmethod
+    def _object_keys(cls, *parameters):
+        return ('part-%s' % parameters[1],)
+
 
 class CreateSnapshot(CLIBaseCommand):
 
@@ -454,6 +1175,10 @@ class CreateSnapshot(CLIBaseCommand):
         super(CreateSnapshot, self).__init__(*args, **kwargs)
         self.command = "create si"
 
+    @classmethod
+    def _object_keys(cls, *parameters):
+        return ('part-%s' % parameters[1],)
+
 
 class DeleteSnapshot(CLIBaseCommand):
 
@@ -466,6 +1191,10 @@ class DeleteSnapshot(CLIBaseCommand):
         super(DeleteSnapshot, self).__init__(*args, **kwargs)
         self.command = "delete si"
 
+    @classmethod
+    def _object_keys(cls, *parameters):
+        return ('si-%s' % parameters[0],)
+
 
 class CreateReplica(CLIBaseCommand):
 
@@ -483,6 +1212,11 @@ class CreateReplica(CLIBaseCommand):
         super(CreateReplica, self).__init__(*args, **kwargs)
         self.command = "create replica"
 
+    @classmethod
+    def _object_keys(cls, *parameters):
+        return ('%s-%s' % (parameters[1], parameters[2]),
+                'part-%s' % parameters[4])
+
 
 class DeleteReplica(CLIBaseCommand):
 
@@ -495,6 +1229,10 @@ class DeleteReplica(CLIBaseCommand):
         super(DeleteReplica, self).__init__(*args, **kwargs)
         self.command = "delete replica"
 
+    @classmethod
+    def _object_keys(cls, *parameters):
+        return ('replica-%s' % parameters[0],)
+
 
 class CreateIQN(CLIBaseCommand):
 
@@ -510,6 +1248,10 @@ class CreateIQN(CLIBaseCommand):
         super(CreateIQN, self).__init__(*args, **kwargs)
         self.command = "create iqn"
 
+    @classmethod
+    def _object_keys(cls, *parameters):
+        return ('iqn-%s' % parameters[1],)
+
 
 class DeleteIQN(CLIBaseCommand):
 
@@ -522,6 +1264,10 @@ class DeleteIQN(CLIBaseCommand):
         super(DeleteIQN, self).__init__(*args, **kwargs)
         self.command = "delete iqn"
 
+    @classmethod
+    def _object_keys(cls, *parameters):
+        return ('iqn-%s' % parameters[0],)
+
 
 class SetIOTimeout(CLIBaseCommand):
 
@@ -530,6 +1276,8 @@ class SetIOTimeout(CLIBaseCommand):
     utility set io-timeout [time]
     """
 
+    read_only = True
+
     def __init__(self, *args, **kwargs):
         super(SetIOTimeout, self).__init__(*args, **kwargs)
         self.command = "utility set io-timeout"
@@ -539,11 +1287,19 @@ class ShowCommand(CLIBaseCommand):
 
     """Basic Show Command."""
 
+    read_only = True
+
     def __init__(self, *args, **kwargs):
         super(ShowCommand, self).__init__(*args, **kwargs)
         self.param_detail = "-l"
         self.default_type = "table"
         self.start_key = ""
+        # The known table header, if any, to skip the column discovery.
+        self.table_columns = None
+        # The ShowRow class of the parsed rows, plain dicts if None.
+        self.row_class = None
+        # The converters of the typed columns, by column name.
+        self.schema = {}
         if self.cli_cache:
             self.show_noinit = "-noinit"
 
@@ -581,37 +1337,22 @@ class ShowCommand(CLIBaseCommand):
         :param content: The parse Content.
         :returns: parse result
         """
-        rc, out = super(ShowCommand, self)._parser(content)
-
-        # Error.
-        if rc != 0:
-            return rc, out
-
-        # No content.
-        if len(out) < 6:
-            return rc, []
+        if content.startswith(('Raidcmd timeout', 'Raidcmd closed')):
+            return super(ShowCommand, self)._parser(content)
 
-        detect_type = self.detect_type()
+        # Feed the transcript in slices, so only the lines of one slice
+        # are split out at a time.
+        parser = ShowOutputParser(self)
+        result = []
+        for i in range(0, len(content), PARSE_CHUNK_SIZE):
+            result.extend(parser.feed(content[i:i + PARSE_CHUNK_SIZE]))
+        result.extend(parser.close())
 
-        # Show detail content.
-        if detect_type == "list":
-
-            start_id = self.detect_detail_start_index(out)
-
-            if start_id < 0:
-                return rc, []
-
-            result = content_lines_to_dict(out[start_id:-3])
-        else:
-
-            start_id = self.detect_table_start_index(out)
-
-            if start_id < 0:
-                return rc, []
-
-            result = table_to_dict(out[start_id:-4])
+        # Error.
+        if parser.rc != 0:
+            return parser.rc, parser.out
 
-        return rc, result
+        return parser.rc, result
 
     def detect_type(self):
         if self.param_detail in self.parameters:
@@ -620,19 +1361,16 @@ class ShowCommand(CLIBaseCommand):
             detect_type = self.default_type
         return detect_type
 
-    def detect_table_start_index(self, content):
-        for i in range(1, len(content)):
-            key = content[i].strip().split('  ')
-            if self.start_key in key[0].strip():
-                return i
-
-        return -1
+    def detect_table_start(self, line):
+        """Return whether the table header is this line."""
+        key = line.strip().split('  ')
+        return self.start_key in key[0].strip()
 
-    def detect_detail_start_index(self, content):
-        for i in range(1, len(content)):
-            split_entry = content[i].strip().split(' ')
-            if len(split_entry) >= 2 and ':' in split_entry[0]:
-                return i
+    def detect_detail_start(self, line):
+        """Return how many lines after this one the details start, or -1."""
+        split_entry = line.strip().split(' ')
+        if len(split_entry) >= 2 and ':' in split_entry[0]:
+            return 0
 
         return -1
 
@@ -659,19 +1397,22 @@ class ShowLV(ShowCommand):
     def __init__(self, *args, **kwargs):
         super(ShowLV, self).__init__(*args, **kwargs)
         self.command = "show lv"
+        self.table_columns = ('ID', 'Name', 'LD-amount', 'Size',
+                              'Available', 'Progress', 'Status')
+        self.schema = {
+            'Size': parse_size_mb,
+            'Available': parse_size_mb,
+            'Used': parse_size_mb,
+            'Tier': parse_int,
+        }
         self.start_key = "ID"
         self.show_noinit = ""
 
-    def detect_table_start_index(self, content):
+    def detect_table_start(self, line):
         if "tier" in self.parameters:
             self.start_key = "LV-Name"
 
-        for i in range(1, len(content)):
-            key = content[i].strip().split('  ')
-            if self.start_key in key[0].strip():
-                return i
-
-        return -1
+        return super(ShowLV, self).detect_table_start(line)
 
 
 class ShowPartition(ShowCommand):
@@ -684,6 +1425,15 @@ class ShowPartition(ShowCommand):
     def __init__(self, *args, **kwargs):
         super(ShowPartition, self).__init__(*args, **kwargs)
         self.command = "show part"
+        self.row_class = PartitionRow
+        self.table_columns = ('ID', 'Name', 'LV-ID', 'Size', 'Used',
+                              'Min-reserve')
+        self.schema = {
+            'Size': parse_int,
+            'Used': parse_int,
+            'Min-reserve': parse_int,
+            'Mapped': parse_bool,
+        }
         self.start_key = "ID"
         self.show_noinit = ""
 
@@ -698,6 +1448,14 @@ class ShowSnapshot(ShowCommand):
     def __init__(self, *args, **kwargs):
         super(ShowSnapshot, self).__init__(*args, **kwargs)
         self.command = "show si"
+        self.row_class = SnapshotRow
+        self.table_columns = ('Index', 'SI-ID', 'Name', 'Partition-ID',
+                              'Map', 'Activated-time')
+        self.schema = {
+            'Used': parse_int,
+            'Map': parse_bool,
+            'Mapped': parse_bool,
+        }
         self.start_key = "Index"
 
 
@@ -749,6 +1507,10 @@ class ShowMap(ShowCommand):
     def __init__(self, *args, **kwargs):
         super(ShowMap, self).__init__(*args, **kwargs)
         self.command = "show map"
+        self.row_class = MapRow
+        self.table_columns = ('Ch', 'Target', 'LUN', 'Media', 'Name',
+                              'ID', 'Host-ID')
+        self.schema = {'LUN': parse_int}
         self.start_key = "Ch"
 
 
@@ -830,6 +1592,7 @@ class ShowReplica(ShowCommand):
     def __init__(self, *args, **kwargs):
         super(ShowReplica, self).__init__(*args, **kwargs)
         self.command = 'show replica'
+        self.row_class = ReplicaRow
         self.show_noinit = ""
 
 
@@ -860,10 +1623,9 @@ class ShowIQN(ShowCommand):
         self.command = "show iqn"
         self.default_type = "list"
 
-    def detect_detail_start_index(self, content):
-        for i in range(1, len(content)):
-            if content[i].strip() == self.LIST_START_LINE:
-                return i + 2
+    def detect_detail_start(self, line):
+        if line.strip() == self.LIST_START_LINE:
+            return 2
 
         return -1
 
@@ -880,8 +1642,7 @@ class ShowHost(ShowCommand):
         self.command = "show host"
         self.default_type = "list"
 
-    def detect_detail_start_index(self, content):
-        for i in range(1, len(content)):
-            if ':' in content[i]:
-                return i
+    def detect_detail_start(self, line):
+        if ':' in line:
+            return 0
         return -1
@@ -15,9 +15,13 @@
 """
 Infortrend Common CLI.
 """
+import contextlib
+import functools
 import math
-import os
+import threading
 import time
+import weakref
+import zlib
 
 from oslo_concurrency import lockutils
 from oslo_config import cfg
@@ -25,10 +29,12 @@ from oslo_log import log as logging
 from oslo_service import loopingcall
 from oslo_utils import timeutils
 from oslo_utils import units
+from oslo_utils import uuidutils
 
 from cinder import exception
 from cinder.i18n import _
 from cinder.volume.drivers.infortrend.raidcmd_cli import cli_factory as cli
+from cinder.volume.drivers.infortrend.raidcmd_cli import inventory
 from cinder.volume.drivers.san import san
 from cinder.volume import volume_utils
 from cinder.volume import volume_types
@@ -49,7 +55,60 @@ infortrend_opts = [
                help='The maximum retry times if a command fails.'),
     cfg.IntOpt('infortrend_cli_timeout',
                default=60,
-               help='The timeout for CLI in seconds.'),
+               help='The timeout for CLI in seconds. A command times out '
+               'once the CLI stays silent for this long.'),
+    cfg.IntOpt('infortrend_cli_max_timeout',
+               default=600,
+               help='The longest time for one CLI command in seconds, '
+               'even while the CLI keeps sending output.'),
+    cfg.IntOpt('infortrend_cli_sessions',
+               default=1,
+               min=1,
+               help='The number of raidcmd sessions connected to the RAID. '
+               'Commands are dispatched to idle sessions, so up to this '
+               'many commands can run at the same time.'),
+    cfg.IntOpt('infortrend_inventory_ttl',
+               default=300,
+               min=0,
+               help='The seconds the driver trusts its copy of the RAID '
+               'partitions and LUN maps. The driver keeps the copy '
+               'current with its own changes and reloads it from the '
+               'RAID after this long, to catch changes made outside of '
+               'this backend. '
+               '0 reloads it on every use.'),
+    cfg.IntOpt('infortrend_topology_ttl',
+               default=3600,
+               min=0,
+               help='The seconds the driver trusts its copy of the RAID '
+               'channels, MCS groups, portal IPs and target WWPNs before '
+               'reading them again. The copy is also read again after '
+               'the driver reconnected to the RAID.'),
+    cfg.IntOpt('infortrend_license_ttl',
+               default=86400,
+               min=0,
+               help='The seconds the driver trusts the RAID license it '
+               'read, such as whether thin provisioning is licensed. '
+               'The license, tiers and host settings are read again '
+               'after the driver reconnected to the RAID, or when the '
+               'service receives SIGHUP.'),
+    cfg.IntOpt('infortrend_tier_ttl',
+               default=300,
+               min=0,
+               help='The seconds the driver trusts the tiers of the pools '
+               'and their space before reading them again.'),
+    cfg.IntOpt('infortrend_host_ttl',
+               default=3600,
+               min=0,
+               help='The seconds the driver trusts the RAID host settings, '
+               'such as the max LUN per ID, before reading them again.'),
+    cfg.IntOpt('infortrend_stats_max_age',
+               default=300,
+               min=0,
+               help='The seconds old the volume stats reported to the '
+               'scheduler may be. Younger stats are reported at once '
+               'while they are refreshed in the background, older ones '
+               'are refreshed before they are reported. 0 always '
+               'refreshes them before reporting.'),
     cfg.ListOpt('infortrend_slots_a_channels_id',
                 default='',
                 help='Infortrend raid channel ID list on Slot A '
@@ -76,6 +135,23 @@ infortrend_opts = [
 ]
 
 CONF = cfg.CONF
+
+# The array-wide change lock of each RAID, by IP. Changes of known
+# objects hold it shared, changes of unknown objects alone.
+_array_locks = {}
+_array_locks_guard = threading.Lock()
+
+# The drivers whose capabilities a SIGHUP drops, see _on_config_mutate.
+_drivers = weakref.WeakSet()
+
+
+def _on_config_mutate(conf, fresh):
+    """Let operators drop the capabilities after changing the RAID."""
+    for driver in list(_drivers):
+        driver.invalidate_capabilities()
+
+
+CONF.register_mutate_hook(_on_config_mutate)
 CONF.register_opts(infortrend_opts)
 
 CLI_RC_FILTER = {
@@ -111,7 +187,10 @@ CLI_RC_FILTER = {
         'error': _('Failed to delete iqn.'),
     },
     'ShowLV': {'error': _('Failed to get lv info.')},
-    'ShowPartition': {'error': _('Failed to get partition info.')},
+    'ShowPartition': {
+        'warning': {11: 'No such partition.'},
+        'error': _('Failed to get partition info.'),
+    },
     'ShowSnapshot': {'error': _('Failed to get snapshot info.')},
     'ShowDevice': {'error': _('Failed to get device info.')},
     'ShowChannel': {'error': _('Failed to get channel info.')},
@@ -199,9 +278,25 @@ class InfortrendCommon(object):
         2.1.3 - Add handling for LUN ID conflict for Active/Active cinder
                 Improve speed for attach/detach/polling commands
         2.1.4 - Check CLI connection first for polling process
+        2.1.5 - Wait for the raidcmd prompt instead of polling
+        2.2.0 - Support a pool of raidcmd sessions
+                Serialize raidcmd changes per array object
+                Prioritize attach/detach commands over polling
+                Share concurrent identical show commands
+                Cooperate with eventlet while waiting on raidcmd
+                Time out raidcmd on silence, drain large outputs
+                Look partitions up in an in-memory inventory
+                Look LUN maps up in an in-memory index
+                Spread LUNs of services sharing an array
+                Cache the channel topology across attaches
+                Refresh volume stats in the background
+                Run the stats commands concurrently
+                Sum up the pools' partitions in one pass
+                Count the pool usage along with our own changes
+                Cache the license, tiers and host settings
     """
 
-    VERSION = '2.1.4'
+    VERSION = '2.2.0'
 
     constants = {
         'ISCSI_PORT': 3260,
@@ -214,6 +309,9 @@ class InfortrendCommon(object):
     PROVISIONING_VALUES = ['thin', 'full']
     TIERING_VALUES = [0, 1, 2, 3]
 
+    # The seconds a LUN that conflicted is skipped by map retries.
+    LUN_CONFLICT_TIMEOUT = 60
+
     def __init__(self, protocol, configuration=None):
 
         self.protocol = protocol
@@ -226,6 +324,7 @@ class InfortrendCommon(object):
         self.ip = self.configuration.san_ip
         self.cli_retry_time = self.configuration.infortrend_cli_max_retries
         self.cli_timeout = self.configuration.infortrend_cli_timeout
+        self.cli_max_timeout = self.configuration.infortrend_cli_max_timeout
         self.cli_cache = self.configuration.infortrend_cli_cache
         self.iqn_prefix = self.configuration.infortrend_iqn_prefix
         self.iqn = self.iqn_prefix + ':raid.uid%s.%s%s%s'
@@ -236,16 +335,54 @@ class InfortrendCommon(object):
 
         self.backend_name = None
         self._volume_stats = None
+        self._stats_updated_at = None
+        self._stats_lock = threading.Lock()
+        self._stats_refreshing = False
+        self._stats_refresh_lock = threading.Lock()
+        # Whether the last stats found thin provisioning licensed.
+        self._thin_provisioning = None
         self.system_id = None
-        self.pid = None
-        self.fd = None
+        self._session_pool = None
+        self._session_local = threading.local()
+        self._flights = {}
+        self._flight_lock = threading.Lock()
+        self._flight_generation = 0
+        self._flight_stats = {'hits': 0, 'misses': 0}
         self._model_type = 'R'
+        # The max LUN per channel ID set on the RAID, see
+        # _check_host_setup.
+        self.max_lun = self.constants['MAX_LUN_MAP_PER_CHL']
+        self.partitions = inventory.PartitionInventory(
+            self.configuration.infortrend_inventory_ttl)
+        self.maps = inventory.MapIndex(
+            self.configuration.infortrend_inventory_ttl)
+        self.topology = inventory.Topology(
+            self.configuration.infortrend_topology_ttl)
+        self.capabilities = inventory.CapabilityCache({
+            'license': self.configuration.infortrend_license_ttl,
+            'tiers': self.configuration.infortrend_tier_ttl,
+            'host': self.configuration.infortrend_host_ttl,
+        })
+        # What the partitions of each pool provision, by LV-ID. Kept
+        # current by _track_change and recounted from the partition
+        # inventory after it was reloaded.
+        self._pool_usage = {}
+        self._pool_usage_loads = None
+        self._pool_usage_lock = threading.Lock()
 
         self.map_dict = {
             'slot_a': {},
             'slot_b': {},
         }
         self.map_dict_init = False
+        # The load of the map index map_dict was built from.
+        self._map_dict_loads = None
+        # The time of the last conflict, by (Ch, Target, LUN).
+        self._conflicted_luns = {}
+        self._conflict_lock = threading.Lock()
+        # Unique to this service, even among services sharing a
+        # backend_host, to spread the LUN search after a conflict.
+        self._lun_search_seed = uuidutils.generate_uuid()
         self.target_dict = {
             'slot_a': {},
             'slot_b': {},
@@ -256,6 +393,7 @@ class InfortrendCommon(object):
                 'slot_b': {},
             }
         self.tier_pools_dict = {}
+        _drivers.add(self)
 
     def check_for_setup_error(self):
         # These two checks needs raidcmd to be ready
@@ -273,19 +411,22 @@ class InfortrendCommon(object):
             LOG.error(msg)
             raise exception.VolumeDriverException(message=msg)
 
+        if self.cli_max_timeout < self.cli_timeout:
+            msg = _('infortrend_cli_max_timeout should not be smaller '
+                    'than infortrend_cli_timeout.')
+            LOG.error(msg)
+            raise exception.VolumeDriverException(message=msg)
+
         self._init_pool_dict()
         self._init_channel_list()
-        self._init_raidcmd()
         self.cli_conf = {
             'path': self.path,
             'cli_retry_time': self.cli_retry_time,
             'raidcmd_timeout': self.cli_timeout,
+            'raidcmd_max_timeout': self.cli_max_timeout,
             'cli_cache': self.cli_cache,
-            'pid': self.pid,
-            'fd': self.fd,
         }
-        self._init_raid_connection()
-        self._set_raidcmd()
+        self._init_raidcmd()
 
     def _init_pool_dict(self):
         self.pool_dict = {}
@@ -318,25 +459,40 @@ class InfortrendCommon(object):
         )
 
     def _init_raidcmd(self):
-        if not self.pid:
-            self.pid, self.fd = os.forkpty()
-            if self.pid == 0:
-                try:
-                    os.execv(self.java_path,
-                             [self.java_path, '-jar', self.path])
-                except OSError:
-                    msg = _('Raidcmd failed to start. '
-                            'Please check Java is installed.')
-                    LOG.error(msg)
-                    raise exception.VolumeDriverException(message=msg)
+        if not self._session_pool:
+            self._session_pool = cli.RaidcmdSessionPool(
+                self.configuration.infortrend_cli_sessions,
+                self._spawn_raidcmd,
+                self._connect_raidcmd)
+            self._session_pool.start()
+
+    def _spawn_raidcmd(self):
+        session = cli.RaidcmdSession(self.java_path, self.path)
+        check_java_start = session.start()
+        if ('Raidcmd timeout' in check_java_start or
+                'Raidcmd closed' in check_java_start):
+            session.close()
+            msg = _('Raidcmd failed to start. '
+                    'Please check Java is installed.')
+            LOG.error(msg)
+            raise exception.VolumeDriverException(message=msg)
+        LOG.debug('Raidcmd [%s:%s] start!', session.pid, session.fd)
+        return session
 
-            check_java_start = cli.os_read(self.fd, 1024, 'RAIDCmd:>', 10)
-            if 'Raidcmd timeout' in check_java_start:
-                msg = _('Raidcmd failed to start. '
-                        'Please check Java is installed.')
-                LOG.error(msg)
-                raise exception.VolumeDriverException(message=msg)
-        LOG.debug('Raidcmd [%s:%s] start!', self.pid, self.fd)
+    def _connect_raidcmd(self, session):
+        with self._use_session(session):
+            self._init_raid_connection()
+            self._set_raidcmd()
+
+    @contextlib.contextmanager
+    def _use_session(self, session):
+        """Run the commands of this thread on the given session."""
+        previous = getattr(self._session_local, 'session', None)
+        self._session_local.session = session
+        try:
+            yield session
+        finally:
+            self._session_local.session = previous
 
     def _set_raidcmd(self):
         cli_io_timeout = str(self.cli_timeout - 10)
@@ -353,16 +509,189 @@ class InfortrendCommon(object):
 
     def _execute_command(self, cli_type, *args, **kwargs):
         command = getattr(cli, cli_type)
-        return command(self.cli_conf).execute(*args, **kwargs)
+        if not issubclass(command, cli.CLIBaseCommand):
+            return command(self.cli_conf).execute(*args, **kwargs)
+
+        session = getattr(self._session_local, 'session', None)
+        if session is not None:
+            return self._execute_on_session(
+                session, command, *args, **kwargs)
+
+        priority = getattr(self._session_local, 'priority',
+                           cli.PRIORITY_INTERACTIVE)
+        total_retry_time = self.cli_retry_time
+        if total_retry_time is None:
+            total_retry_time = cli.DEFAULT_RETRY_TIME
+
+        retry_time = 0
+        while True:
+            with self._session_pool.session(priority) as session:
+                rc, out = self._execute_on_session(
+                    session, command, *args, **kwargs)
+            retry_time += 1
+            if rc != -3 or retry_time >= total_retry_time:
+                return rc, out
+            LOG.warning('Retry %(method)s on another raidcmd session.', {
+                'method': cli_type})
+
+    def _execute_on_session(self, session, command, *args, **kwargs):
+        cli_conf = dict(self.cli_conf, pid=session.pid, fd=session.fd)
+        rc, out = command(cli_conf).execute(*args, **kwargs)
+        if rc == -3:
+            # Late output of a timed out command would be read as the
+            # result of the next one, so this session can not be reused.
+            # The pool replaces it before handing it out again.
+            session.broken = True
+        elif rc in (9, 13):
+            session.connected = False
+            self.topology.invalidate()
+        return rc, out
+
+    @contextlib.contextmanager
+    def _command_priority(self, priority):
+        """Queue the raidcmd commands of this thread with the priority."""
+        previous = getattr(self._session_local, 'priority',
+                           cli.PRIORITY_INTERACTIVE)
+        self._session_local.priority = priority
+        try:
+            yield
+        finally:
+            self._session_local.priority = previous
+
+    def _run_concurrently(self, *funcs):
+        """Run the functions in threads and return their results in order.
+
+        The commands of the threads keep the priority of the caller. The
+        first exception raised by a function is raised once all ended.
+        """
+        priority = getattr(self._session_local, 'priority',
+                           cli.PRIORITY_INTERACTIVE)
+        results = [None] * len(funcs)
+        errors = [None] * len(funcs)
+
+        def run(index, func):
+            with self._command_priority(priority):
+                try:
+                    results[index] = func()
+                except Exception as e:
+                    errors[index] = e
+
+        threads = [threading.Thread(target=run, args=(index, func))
+                   for index, func in enumerate(funcs)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for error in errors:
+            if error is not None:
+                raise error
+        return results
+
+    @contextlib.contextmanager
+    def _lock_raid_objects(self, lock_keys):
+        """Lock the array objects a change command touches.
+
+        A change of unknown objects, keyed cli.ARRAY_LOCK_KEY, runs
+        alone. The others only exclude changes sharing one of their
+        keys.
+        """
+        lock_keys = set(lock_keys)
+        if not lock_keys:
+            yield
+            return
+
+        with _array_locks_guard:
+            array_lock = _array_locks.setdefault(
+                self.ip, lockutils.ReaderWriterLock())
+        if cli.ARRAY_LOCK_KEY in lock_keys:
+            with array_lock.write_lock():
+                yield
+            return
+
+        with array_lock.read_lock(), contextlib.ExitStack() as stack:
+            # Always lock in the same order to avoid deadlocks.
+            for key in sorted(lock_keys):
+                stack.enter_context(lockutils.lock(
+                    'raidcmd-%s-%s' % (self.ip, key), 'infortrend-'))
+            yield
+
+    @contextlib.contextmanager
+    def _fence_flights(self):
+        """Keep show commands from sharing results across a change."""
+        with self._flight_lock:
+            self._flight_generation += 1
+        try:
+            yield
+        finally:
+            with self._flight_lock:
+                self._flight_generation += 1
+
+    def _execute_flight(self, cli_type, *args, **kwargs):
+        """Share one run of a show command among concurrent callers.
+
+        A caller joins the run of the same command with the same
+        parameters and priority if no change was issued since that run
+        started. An interactive caller never waits on a polling run.
+        """
+        priority = getattr(self._session_local, 'priority',
+                           cli.PRIORITY_INTERACTIVE)
+        key = (cli_type, args, tuple(sorted(kwargs.items())), priority)
+        with self._flight_lock:
+            flight = self._flights.get(key)
+            if flight and flight['generation'] == self._flight_generation:
+                self._flight_stats['hits'] += 1
+                leader = False
+            else:
+                flight = {
+                    'generation': self._flight_generation,
+                    'event': threading.Event(),
+                    'result': None,
+                }
+                self._flights[key] = flight
+                self._flight_stats['misses'] += 1
+                leader = True
+
+        if not leader:
+            flight['event'].wait()
+            if flight['result'] is None:
+                # The shared run failed, try on our own.
+                return self._execute_command(cli_type, *args, **kwargs)
+            rc, out = flight['result']
+            if isinstance(out, list):
+                out = list(out)
+            return rc, out
+
+        try:
+            flight['result'] = self._execute_command(
+                cli_type, *args, **kwargs)
+        finally:
+            with self._flight_lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            flight['event'].set()
+        return flight['result']
 
     def _execute(self, cli_type, *args, **kwargs):
         LOG.debug('Executing command type: %(type)s.', {'type': cli_type})
 
-        @lockutils.synchronized('raidcmd-%s' % self.pid, 'infortrend-', False)
-        def _lock_raidcmd(cli_type, *args, **kwargs):
-            return self._execute_command(cli_type, *args, **kwargs)
-
-        rc, out = _lock_raidcmd(cli_type, *args, **kwargs)
+        command = getattr(cli, cli_type)
+        if issubclass(command, cli.ShowCommand):
+            rc, out = self._execute_flight(cli_type, *args, **kwargs)
+        elif issubclass(command, cli.CLIBaseCommand):
+            # Reads run concurrently, changes are serialized per array
+            # object.
+            lock_keys = command.lock_keys(*args)
+            with self._lock_raid_objects(lock_keys):
+                if command.read_only:
+                    rc, out = self._execute_command(cli_type, *args, **kwargs)
+                else:
+                    with self._fence_flights():
+                        rc, out = self._execute_command(
+                            cli_type, *args, **kwargs)
+                    self._track_change(cli_type, args, rc)
+        else:
+            rc, out = self._execute_command(cli_type, *args, **kwargs)
 
         if rc != 0:
             if cli_type == 'CheckConnection':
@@ -379,6 +708,12 @@ class InfortrendCommon(object):
 
     @log_func
     def _init_map_info(self):
+        if (self.map_dict_init and self.topology.loads and
+                self.topology.expired()):
+            # The topology is read again, drop the old channels.
+            self._reset_map_info()
+            self.map_dict_init = False
+
         if not self.map_dict_init:
 
             rc, channel_info = self._execute('ShowChannel')
@@ -392,6 +727,7 @@ class InfortrendCommon(object):
             self._set_channel_id(channel_info, 'slot_a')
 
             self.map_dict_init = True
+            self._map_dict_loads = None
 
         for controller in sorted(self.map_dict.keys()):
             LOG.debug('Controller: [%(controller)s] '
@@ -399,58 +735,108 @@ class InfortrendCommon(object):
                           'controller': controller,
                           'ch': sorted(self.map_dict[controller].keys())})
 
+    def _reset_map_info(self):
+        for controller in self.map_dict:
+            self.map_dict[controller] = {}
+            self.target_dict[controller] = {}
+            if self.protocol == 'iSCSI':
+                self.mcs_dict[controller] = {}
+        self.topology.clear_mcs_channels()
+
+    def _refresh_topology(self):
+        """Read the portal IPs or target WWPNs again if expired."""
+        if not self.topology.expired():
+            return
+        generation = self.topology.generation
+        if self.protocol == 'iSCSI':
+            rc, net_list = self._execute('ShowNet')
+            self.topology.load_nets(net_list, generation)
+        else:
+            rc, wwn_list = self._execute('ShowWWN')
+            self.topology.load_wwns(wwn_list, generation)
+
     @log_func
-    def _update_map_info(self, multipath=False):
-        """Record the driver mapping information.
+    def _update_map_info(self):
+        """Record the free LUNs of the driver channels.
 
         map_dict = {
             'slot_a': {
-                '0': [1, 2, 3, 4]  # Slot A Channel 0 map lun 1, 2, 3, 4
+                '0': FreeLuns([0, 5, 6, ...])  # Slot A Channel 0 free luns
             },
             'slot_b' : {
-                '1': [0, 1, 3]     # Slot B Channel 1 map lun 0, 1, 3
+                '1': FreeLuns([2, 4, 5, ...])  # Slot B Channel 1 free luns
             }
         }
+
+        map_dict is only rebuilt from the map index after the index was
+        reloaded. In between, _track_change applies our own map changes
+        to the channels they touch, see _update_channel_map_info.
         """
-        rc, map_info = self._execute('ShowMap')
+        self._refresh_maps()
 
-        self._update_map_info_by_slot(map_info, 'slot_a')
+        if self._map_dict_loads == self.maps.loads:
+            return
+        self._map_dict_loads = self.maps.loads
 
-        if multipath and self._model_type == 'R':
-            self._update_map_info_by_slot(map_info, 'slot_b')
+        self._update_map_info_by_slot('slot_a')
 
-        return map_info
+        if self._model_type == 'R':
+            self._update_map_info_by_slot('slot_b')
 
     @log_func
-    def _update_map_info_by_slot(self, map_info, slot_key):
-        for key, value in self.map_dict[slot_key].items():
-            self.map_dict[slot_key][key] = list(
-                range(self.constants['MAX_LUN_MAP_PER_CHL']))
-
-        if len(map_info) > 0 and isinstance(map_info, list):
-            for entry in map_info:
-                ch = entry['Ch']
-                lun = entry['LUN']
-                if ch not in self.map_dict[slot_key].keys():
-                    continue
-
-                target_id = self.target_dict[slot_key][ch]
-                if (entry['Target'] == target_id and
-                        int(lun) in self.map_dict[slot_key][ch]):
-                    self.map_dict[slot_key][ch].remove(int(lun))
+    def _update_map_info_by_slot(self, slot_key):
+        for ch in self.map_dict[slot_key]:
+            self.map_dict[slot_key][ch] = self.maps.free_luns(
+                ch, self.target_dict[slot_key].get(ch), self.max_lun)
+
+    def _update_channel_map_info(self, channel_id, target_id):
+        """Update map_dict with a change of the maps of a channel."""
+        for slot_key in self.map_dict:
+            if (channel_id in self.map_dict[slot_key] and
+                    self.target_dict[slot_key].get(channel_id) == target_id):
+                self.map_dict[slot_key][channel_id] = self.maps.free_luns(
+                    channel_id, target_id, self.max_lun)
 
     def _check_initiator_has_lun_map(self, initiator_info):
-        rc, map_info = self._execute('ShowMap')
-
         if not isinstance(initiator_info, list):
             initiator_info = (initiator_info,)
-        if len(map_info) > 0:
-            for initiator_name in initiator_info:
-                for entry in map_info:
-                    if initiator_name.lower() == entry['Host-ID'].lower():
-                        return True
+
+        reloaded = self._refresh_maps()
+        if self.maps.has_host_map(initiator_info):
+            return True
+        if not reloaded:
+            # The host is dropped on a "no", maps made by other services
+            # since the last load are only known from a show.
+            self._load_maps()
+        return self.maps.has_host_map(initiator_info)
+
+    def _refresh_maps(self):
+        """Reload the LUN map index if expired.
+
+        Returns True if it was reloaded.
+        """
+        if self.maps.expired():
+            self._load_maps()
+            return True
         return False
 
+    def _load_maps(self):
+        generation = self.maps.generation
+        rc, map_info = self._execute('ShowMap')
+        self.maps.load(map_info, generation)
+
+    def _get_part_maps(self, part_id):
+        """Return the maps of the partition as the RAID has them now.
+
+        Other services on the RAID may have mapped or unmapped it since
+        the map index was loaded. The index is updated on the way.
+        """
+        rc, part_map_info = self._execute('ShowMap', 'part=%s' % part_id)
+        for channel_id, target_id in self.maps.load_part(
+                part_id, part_map_info):
+            self._update_channel_map_info(channel_id, target_id)
+        return self.maps.maps(part_id)
+
     @log_func
     def _set_channel_id(
             self, channel_info, controller):
@@ -463,7 +849,8 @@ class InfortrendCommon(object):
         for entry in channel_info:
             if entry['Type'] in check_channel_type:
                 if entry['Ch'] in self.channel_list[controller]:
-                    self.map_dict[controller][entry['Ch']] = []
+                    self.map_dict[controller][entry['Ch']] = (
+                        inventory.FreeLuns())
 
                     if self.protocol == 'iSCSI':
                         self._update_mcs_dict(
@@ -538,6 +925,7 @@ class InfortrendCommon(object):
         if mcs_id not in self.mcs_dict[controller]:
             self.mcs_dict[controller][mcs_id] = []
         self.mcs_dict[controller][mcs_id].append(channel_id)
+        self.topology.add_mcs_channel(controller, mcs_id, channel_id)
 
     def _check_pools_setup(self):
         temp_pool_dict = self.pool_dict.copy()
@@ -558,7 +946,7 @@ class InfortrendCommon(object):
             raise exception.VolumeDriverException(message=msg)
 
     def _check_host_setup(self):
-        rc, host_info = self._execute('ShowHost')
+        host_info = self._get_capability('host', 'ShowHost')
         max_lun = int(host_info[0]['Max LUN per ID'])
         device_type = host_info[0]['Peripheral device type']
 
@@ -568,12 +956,12 @@ class InfortrendCommon(object):
             LOG.error(msg)
             raise exception.VolumeDriverException(message=msg)
 
-        self.constants['MAX_LUN_MAP_PER_CHL'] = max_lun
+        self.max_lun = max_lun
         system_id = self._get_system_id(self.ip)
         LOG.info('Device: [%(device)s] '
                  'max LUN setting is: [%(luns)s]', {
                      'device': system_id,
-                     'luns': self.constants['MAX_LUN_MAP_PER_CHL']})
+                     'luns': self.max_lun})
 
     def create_volume(self, volume):
         """Create a Infortrend partition."""
@@ -671,13 +1059,13 @@ class InfortrendCommon(object):
         return False
 
     def _check_tier_space(self, tier_level, pool_id, volume_size):
-        rc, lv_info = self._execute('ShowLV', 'tier')
+        lv_info = self._get_capability('tiers', 'ShowLV', 'tier')
         if lv_info:
             for entry in lv_info:
                 if (entry['LV-ID'] == pool_id and
-                        int(entry['Tier']) == tier_level):
-                    total_space = self._parse_size(entry['Size'], 'MB')
-                    used_space = self._parse_size(entry['Used'], 'MB')
+                        entry['Tier'] == tier_level):
+                    total_space = entry['Size']
+                    used_space = entry['Used']
                     if not (total_space and used_space):
                         return
                     elif volume_size > (total_space - used_space):
@@ -687,29 +1075,6 @@ class InfortrendCommon(object):
                                         'pool_id': pool_id,
                                         'tier_level': tier_level})
 
-    def _parse_size(self, size_string, return_unit):
-        size = float(size_string.split(' ', 1)[0])
-        if 'TB' in size_string:
-            if return_unit == 'GB':
-                return round(ti_to_gi(size), 2)
-            elif return_unit == 'MB':
-                return round(ti_to_mi(size))
-        elif 'GB' in size_string:
-            if return_unit == 'GB':
-                return round(size, 2)
-            elif return_unit == 'MB':
-                return round(gi_to_mi(size))
-        elif 'MB' in size_string:
-            if return_unit == 'GB':
-                return round(mi_to_gi(size), 2)
-            elif return_unit == 'MB':
-                return round(size)
-        else:
-            LOG.warning('Tier size [%(size_string)s], '
-                        'the unit is not recognized.', {
-                            'size_string': size_string})
-        return
-
     def _create_part_parameters_str(self, extraspecs_dict):
         parameters_list = []
         parameters = {
@@ -727,13 +1092,17 @@ class InfortrendCommon(object):
     def _iscsi_create_map(self, part_id, multipath, host, system_id):
 
         host_filter = self._create_host_filter(host)
-        rc, net_list = self._execute('ShowNet')
-        self._update_map_info(multipath)
-        rc, part_mapping = self._execute(
-            'ShowMap', 'part=%s' % part_id)
+        self._refresh_topology()
+        self._update_map_info()
+        part_mapping = self._get_part_maps(part_id)
         map_chl, map_lun = self._get_mapping_info(multipath)
+        channels = [(controller, channel_id)
+                    for controller in sorted(map_chl)
+                    for channel_id in map_chl[controller]]
         lun_id = map_lun[0]
-        save_id = lun_id
+        attempt = 0
+        if self._has_lun_conflicts():
+            lun_id = str(self._claim_lun_id(channels, attempt))
 
         while True:
             rc, iqns, ips, luns = self._exec_iscsi_create_map(map_chl,
@@ -742,22 +1111,21 @@ class InfortrendCommon(object):
                                                               part_id,
                                                               lun_id,
                                                               host_filter,
-                                                              system_id,
-                                                              net_list)
+                                                              system_id)
             if rc == 20:
-                self._delete_all_map(part_id)
-                lun_id = self._find_next_lun_id(lun_id, save_id)
+                attempt += 1
+                lun_id = str(self._claim_lun_id(channels, attempt))
             else:
                 break
 
         return iqns, ips, luns
 
     def _exec_iscsi_create_map(self, channel_dict, part_mapping, host,
-                               part_id, lun_id, host_filter, system_id,
-                               net_list):
+                               part_id, lun_id, host_filter, system_id):
         iqns = []
         ips = []
         luns = []
+        created_maps = []
         rc = 0
         for controller in sorted(channel_dict.keys()):
             for channel_id in sorted(channel_dict[controller]):
@@ -778,6 +1146,9 @@ class InfortrendCommon(object):
                                     'part_id': part_id, 'Ch': channel_id,
                                     'tid': target_id, 'lun': lun_id}
                         LOG.warning(msg)
+                        self._handle_lun_conflict(
+                            part_id, created_maps, channel_id, target_id,
+                            lun_id)
                         return 20, 0, 0, 0
                     if rc != 0:
                         msg = _('Volume[%(part_id)s] create map failed, '
@@ -787,8 +1158,8 @@ class InfortrendCommon(object):
                         LOG.error(msg)
                         raise exception.VolumeDriverException(message=msg)
 
+                    created_maps.append((channel_id, target_id))
                     exist_lun_id = int(lun_id)
-                    self.map_dict[controller][channel_id].remove(exist_lun_id)
 
                 mcs_id = self._get_mcs_id(channel_id, controller)
                 # There might be some channels in the same group
@@ -801,8 +1172,7 @@ class InfortrendCommon(object):
                         'controller': controller,
                     }
                     iqns.append(self._generate_iqn(map_ch_info))
-                    ips.append(self._get_ip_by_channel(
-                        channel, net_list, controller))
+                    ips.append(self._get_ip_by_channel(channel, controller))
                     luns.append(exist_lun_id)
 
         return rc, iqns, ips, luns
@@ -813,7 +1183,7 @@ class InfortrendCommon(object):
                 if (entry['Ch'] == channel_id and
                         entry['Target'] == target_id and
                         entry['Host-ID'].lower() == host.lower()):
-                    return int(entry['LUN'])
+                    return entry['LUN']
         return -1
 
     def _create_host_filter(self, host):
@@ -1094,10 +1464,7 @@ class InfortrendCommon(object):
 
     @log_func
     def _get_lun_id(self, ch_id, controller='slot_a'):
-        lun_id = -1
-
-        if len(self.map_dict[controller][ch_id]) > 0:
-            lun_id = self.map_dict[controller][ch_id][0]
+        lun_id = self.map_dict[controller][ch_id].first()
 
         if lun_id == -1:
             msg = _('LUN number is out of bound '
@@ -1162,25 +1529,19 @@ class InfortrendCommon(object):
 
     def _get_minimum_common_lun_id(self, channel_dict):
         """Find the minimun common lun id in all channels."""
-        map_lun = []
-        # search for free lun id on all channels
-        for lun_id in range(self.constants['MAX_LUN_MAP_PER_CHL']):
-            lun_id_is_used = False
-            for controller in channel_dict.keys():
-                for channel_id in channel_dict[controller]:
-                    if lun_id not in self.map_dict[controller][channel_id]:
-                        lun_id_is_used = True
-            if not lun_id_is_used:
-                map_lun.append(str(lun_id))
-                break
-            # check lun id overflow
-            elif (lun_id == self.constants['MAX_LUN_MAP_PER_CHL'] - 1):
-                msg = _('LUN map has reached maximum value [%(max_lun)s].') % {
-                    'max_lun': self.constants['MAX_LUN_MAP_PER_CHL']}
-                LOG.error(msg)
-                raise exception.VolumeDriverException(message=msg)
+        lun_id = inventory.first_common_lun(
+            (self.map_dict[controller][channel_id]
+             for controller in channel_dict
+             for channel_id in channel_dict[controller]),
+            self.max_lun)
+        # check lun id overflow
+        if lun_id < 0:
+            msg = _('LUN map has reached maximum value [%(max_lun)s].') % {
+                'max_lun': self.max_lun}
+            LOG.error(msg)
+            raise exception.VolumeDriverException(message=msg)
 
-        return map_lun
+        return [str(lun_id)]
 
     @log_func
     def _get_mapping_info_with_normal(self):
@@ -1209,57 +1570,44 @@ class InfortrendCommon(object):
 
     @log_func
     def _get_minimun_mapping_channel_id(self, controller):
-        empty_lun_num = 0
-        min_map_chl = -1
-
         # Sort items to get a reliable behaviour. Dictionary items
         # are iterated in a random order because of hash randomization.
         # We don't care MCS group here, single path working as well.
-        for mcs in sorted(self.mcs_dict[controller].keys()):
-            mcs_chl = sorted((self.mcs_dict[controller][mcs]))[0]
-            free_lun_num = len(self.map_dict[controller][mcs_chl])
-            if empty_lun_num < free_lun_num:
-                min_map_chl = mcs_chl
-                empty_lun_num = free_lun_num
-
-        if int(min_map_chl) < 0:
+        mcs_channels = [sorted(self.mcs_dict[controller][mcs])[0]
+                        for mcs in sorted(self.mcs_dict[controller].keys())]
+        min_map_chl = inventory.most_free_channel(
+            self.map_dict[controller], mcs_channels)
+
+        if min_map_chl is None:
             msg = _('LUN map overflow on every channel.')
             LOG.error(msg)
             raise exception.VolumeDriverException(message=msg)
         else:
             return min_map_chl
 
+    def _get_fc_map_channels(self, wwpn_channel_info):
+        return [(slot_name, info['channel'])
+                for slot_name in ['slot_a', 'slot_b']
+                for info in wwpn_channel_info.values()
+                if info['channel'] in self.map_dict[slot_name]]
+
     def _get_common_lun_map_id(self, wwpn_channel_info):
-        map_lun = None
         # search for free lun id on all channels
-        for lun_id in range(self.constants['MAX_LUN_MAP_PER_CHL']):
-            lun_id_is_used = False
-            for slot_name in ['slot_a', 'slot_b']:
-                for wwpn in wwpn_channel_info:
-                    channel_id = wwpn_channel_info[wwpn]['channel']
-                    if channel_id not in self.map_dict[slot_name]:
-                        continue
-                    elif lun_id not in self.map_dict[slot_name][channel_id]:
-                        lun_id_is_used = True
-            if not lun_id_is_used:
-                map_lun = lun_id
-                break
-            # check lun id overflow
-            elif (lun_id == self.constants['MAX_LUN_MAP_PER_CHL'] - 1):
-                msg = _('LUN map has reached maximum value [%(max_lun)s].') % {
-                    'max_lun': self.constants['MAX_LUN_MAP_PER_CHL']}
-                LOG.error(msg)
-                raise exception.VolumeDriverException(message=msg)
+        map_lun = inventory.first_common_lun(
+            (self.map_dict[slot_name][channel_id] for slot_name, channel_id
+             in self._get_fc_map_channels(wwpn_channel_info)),
+            self.max_lun)
+        # check lun id overflow
+        if map_lun < 0:
+            msg = _('LUN map has reached maximum value [%(max_lun)s].') % {
+                'max_lun': self.max_lun}
+            LOG.error(msg)
+            raise exception.VolumeDriverException(message=msg)
 
         return map_lun
 
     def _get_mcs_id(self, channel_id, controller):
-        mcs_id = None
-
-        for mcs in self.mcs_dict[controller]:
-            if channel_id in self.mcs_dict[controller][mcs]:
-                mcs_id = mcs
-                break
+        mcs_id = self.topology.mcs_id(controller, channel_id)
 
         if mcs_id is None:
             msg = _('Cannot get mcs_id by channel id: %(channel_id)s.') % {
@@ -1319,31 +1667,16 @@ class InfortrendCommon(object):
         return False
 
     def _check_volume_exist(self, volume_id, part_id):
-        check_exist = False
-        have_map = False
-
-        rc, part_list = self._execute('ShowPartition', '-l')
-
-        if part_id:
-            key = 'ID'
-            find_key = part_id
-        else:
-            key = 'Name'
-            find_key = volume_id
-
-        for entry in part_list:
-            if entry[key] == find_key:
-                check_exist = True
-                if entry['Mapped'] == 'true':
-                    have_map = True
-                if not part_id:
-                    part_id = entry['ID']
-                break
+        if not part_id:
+            part = self._find_partition(name=volume_id)
+            if part is None:
+                return (False, False, None)
+            part_id = part['ID']
 
-        if check_exist:
-            return (check_exist, have_map, part_id)
-        else:
+        part = self._get_partition_detail(part_id)
+        if part is None:
             return (False, False, None)
+        return (True, part['Mapped'] is not False, part['ID'])
 
     def create_cloned_volume(self, volume, src_vref):
         """Create a clone of the volume by volume copy."""
@@ -1420,10 +1753,16 @@ class InfortrendCommon(object):
     def get_volume_stats(self, refresh=False):
         """Get volume status.
 
-        If refresh is True, update the status first.
+        If refresh is True, update the status. Stats younger than
+        infortrend_stats_max_age are returned at once and updated in the
+        background.
         """
-        if self._volume_stats is None or refresh:
-            self._update_volume_stats()
+        max_age = self.configuration.infortrend_stats_max_age
+        if (self._volume_stats is None or
+                (refresh and self._get_stats_age() >= max_age)):
+            self._refresh_volume_stats(max_age)
+        elif refresh:
+            self._start_stats_refresh()
 
         LOG.info(
             'Successfully update volume stats. '
@@ -1433,20 +1772,62 @@ class InfortrendCommon(object):
             'system_id: %(system_id)s, '
             'status: %(status)s, '
             'driver_version: %(driver_version)s, '
-            'storage_protocol: %(storage_protocol)s.', self._volume_stats)
+            'storage_protocol: %(storage_protocol)s, '
+            'age: %(stats_age)ds.',
+            dict(self._volume_stats, stats_age=self._get_stats_age()))
 
         return self._volume_stats
 
+    def _get_stats_age(self):
+        return time.monotonic() - self._stats_updated_at
+
+    def _refresh_volume_stats(self, max_age=None):
+        """Update the volume stats, one refresh at a time.
+
+        With max_age, the stats of a refresh which ended while waiting
+        are kept if they are younger than max_age.
+        """
+        with self._stats_refresh_lock:
+            if (max_age is not None and self._volume_stats is not None and
+                    self._get_stats_age() < max_age):
+                return
+            with self._command_priority(cli.PRIORITY_BACKGROUND):
+                self._update_volume_stats()
+
+    def _start_stats_refresh(self):
+        """Refresh the volume stats in a thread, unless one already is."""
+        with self._stats_lock:
+            if self._stats_refreshing:
+                return
+            self._stats_refreshing = True
+
+        thread = threading.Thread(target=self._refresh_stats_in_background,
+                                  name='infortrend-stats-%s' % self.ip)
+        thread.daemon = True
+        thread.start()
+
+    def _refresh_stats_in_background(self):
+        try:
+            self._refresh_volume_stats()
+        except Exception:
+            # The last stats are reported until a refresh succeeds.
+            LOG.exception('Failed to refresh volume stats in background.')
+        finally:
+            with self._stats_lock:
+                self._stats_refreshing = False
+
     def _update_volume_stats(self):
-        # Ensure the CLI is connected.
+        # Ensure the CLI is connected, before the sessions are used by
+        # the stats commands.
         status = self._check_connection()
 
         # Refresh cache
         rc, out = self._execute('InitCache')
         if rc != 0:
-            LOG.Warning('[InitCache Failed]')
+            LOG.warning('[InitCache Failed]')
 
         self.backend_name = self.configuration.safe_get('volume_backend_name')
+        pools = self._update_pools_stats()
         system_id = self._get_system_id(self.ip)
         data = {
             'volume_backend_name': self.backend_name,
@@ -1456,43 +1837,76 @@ class InfortrendCommon(object):
             'model_type': self._model_type,
             'system_id': system_id,
             'status': status,
-            'pools': self._update_pools_stats(system_id),
+            'pools': pools,
         }
+        # Replaced, never changed in place, so readers see whole stats.
         self._volume_stats = data
+        self._stats_updated_at = time.monotonic()
+
+        if self._session_pool:
+            LOG.debug('Raidcmd queue stats: %s', self._session_pool.stats())
+        LOG.debug('Show command sharing: %(hits)s hits, %(misses)s misses, '
+                  'hit rate %(rate).1f%%.', self._get_flight_stats())
+
+    def _get_flight_stats(self):
+        with self._flight_lock:
+            stats = dict(self._flight_stats)
+        total = stats['hits'] + stats['misses']
+        stats['rate'] = 100.0 * stats['hits'] / total if total else 0.0
+        return stats
 
     def _check_connection(self):
         rc, out = self._execute('CheckConnection')
         if rc == 0:
             return 'Connected'
         elif rc in (9, 13):
-            self._init_raid_connection()
-            self._set_raidcmd()
+            self._session_pool.reconnect()
+            self.topology.invalidate()
+            self.capabilities.invalidate()
             return 'Reconnected'
         else:
             return 'Error: %s' % out
 
-    def _update_pools_stats(self, system_id):
-        self._update_pool_tiers()
-        enable_specs_dict = self._get_enable_specs_on_array()
+    def _update_pools_stats(self):
+        # The stats commands do not depend on each other, so they run at
+        # once. Partitions are only counted with thin provisioning, which
+        # the last stats tell before the license arrives.
+        funcs = [
+            functools.partial(self._get_system_id, self.ip),
+            self._update_pool_tiers,
+            self._get_enable_specs_on_array,
+            functools.partial(self._execute, 'ShowLV'),
+            self._update_max_lun,
+        ]
+        if self._thin_provisioning:
+            funcs.extend([self._recount_pool_usage, self._refresh_maps])
+        results = self._run_concurrently(*funcs)
+        system_id = results[0]
+        enable_specs_dict = results[2]
+        rc, pools_info = results[3]
 
         if 'Thin Provisioning' in enable_specs_dict.keys():
             provisioning_support = True
         else:
             provisioning_support = False
 
-        rc, pools_info = self._execute('ShowLV')
         pools = []
 
+        if provisioning_support and not self._thin_provisioning:
+            self._recount_pool_usage()
+            self._refresh_maps()
+        self._thin_provisioning = provisioning_support
+
         if provisioning_support:
-            rc, part_list = self._execute('ShowPartition')
+            provisioning_factor = float(self.configuration.safe_get(
+                'max_over_subscription_ratio'))
+            lv_usage = self._get_pool_usage()
+            lv_mapped = self._count_mapped_partitions()
 
         for pool in pools_info:
             if pool['Name'] in self.pool_dict.keys():
-                total_space = float(pool['Size'].split(' ', 1)[0])
-                available_space = float(pool['Available'].split(' ', 1)[0])
-
-                total_capacity_gb = round(mi_to_gi(total_space), 2)
-                free_capacity_gb = round(mi_to_gi(available_space), 2)
+                total_capacity_gb = round(mi_to_gi(pool['Size']), 2)
+                free_capacity_gb = round(mi_to_gi(pool['Available']), 2)
 
                 _pool = {
                     'pool_name': pool['Name'],
@@ -1507,26 +1921,70 @@ class InfortrendCommon(object):
                 }
 
                 if provisioning_support:
-                    provisioning_factor = self.configuration.safe_get(
-                        'max_over_subscription_ratio')
-                    provisioned_space = self._get_provisioned_space(
-                        pool['ID'], part_list)
-                    provisioned_capacity_gb = round(
-                        mi_to_gi(provisioned_space), 2)
-                    _pool['provisioned_capacity_gb'] = provisioned_capacity_gb
-                    _pool['max_over_subscription_ratio'] = float(
-                        provisioning_factor)
+                    usage = lv_usage.get(pool['ID'], inventory.LVUsage())
+                    _pool.update({
+                        'provisioned_capacity_gb': round(
+                            mi_to_gi(usage.provisioned), 2),
+                        'max_over_subscription_ratio': provisioning_factor,
+                        'total_volumes': usage.partitions,
+                        'mapped_volumes': lv_mapped.get(pool['ID'], 0),
+                        'thin_volumes': usage.thin,
+                        'full_volumes': usage.full,
+                    })
 
                 pools.append(_pool)
 
         return pools
 
-    def _get_provisioned_space(self, pool_id, part_list):
-        provisioning_space = 0
-        for entry in part_list:
-            if entry['LV-ID'] == pool_id:
-                provisioning_space += int(entry['Size'])
-        return provisioning_space
+    def _recount_pool_usage(self):
+        """Recount the pool usage once the partitions were reloaded.
+
+        The partitions are only read again once their inventory expired,
+        the pool usage follows our own changes in between.
+        """
+        if self.partitions.expired():
+            self._load_partitions()
+
+        with self._pool_usage_lock:
+            loads = self.partitions.loads
+            if loads == self._pool_usage_loads:
+                return
+            # One pass over the partitions serves every pool.
+            usage = self.partitions.usage()
+            # New partitions are missing in stale LVs, but were counted.
+            if self.partitions.stale_lvs():
+                return
+            self._pool_usage = usage
+            self._pool_usage_loads = loads
+
+    def _count_mapped_partitions(self):
+        """Count the partitions of each LV the map index has maps of.
+
+        :returns: the counts, by LV-ID
+        """
+        mapped = self.maps.mapped_partitions()
+        counts = {}
+        for part in self.partitions.partitions():
+            if part['ID'] in mapped:
+                counts[part['LV-ID']] = counts.get(part['LV-ID'], 0) + 1
+        return counts
+
+    def _get_pool_usage(self):
+        with self._pool_usage_lock:
+            return dict((lv_id, usage.copy())
+                        for lv_id, usage in self._pool_usage.items())
+
+    def _track_usage(self, lv_id, old_row=None, new_row=None):
+        """Apply a change of a partition to the usage of its pool.
+
+        Called with _pool_usage_lock held, together with the change of
+        the partition inventory.
+        """
+        usage = self._pool_usage.setdefault(lv_id, inventory.LVUsage())
+        if old_row is not None:
+            usage.remove(old_row)
+        if new_row is not None:
+            usage.add(new_row)
 
     def _update_pool_tiers(self):
         """Setup the tier pools information.
@@ -1536,17 +1994,41 @@ class InfortrendCommon(object):
             '87654321': [0, 1, 3],    # Pool 87654321 has 3 tiers: 0, 1, 3
         }
         """
-        rc, lv_info = self._execute('ShowLV', 'tier')
+        lv_info = self._get_capability('tiers', 'ShowLV', 'tier')
 
         temp_dict = {}
         for entry in lv_info:
             if entry['LV-Name'] in self.pool_dict.keys():
                 if entry['LV-ID'] not in temp_dict.keys():
                     temp_dict[entry['LV-ID']] = []
-                temp_dict[entry['LV-ID']].append(int(entry['Tier']))
+                temp_dict[entry['LV-ID']].append(entry['Tier'])
 
         self.tier_pools_dict = temp_dict
 
+    def _update_max_lun(self):
+        """Follow a change of the max LUN per ID of the RAID."""
+        host_info = self._get_capability('host', 'ShowHost')
+        max_lun = int(host_info[0]['Max LUN per ID'])
+        if max_lun != self.max_lun:
+            LOG.info('Max LUN setting changed to [%s].', max_lun)
+            self.max_lun = max_lun
+            # Rebuild map_dict with the new number of LUNs.
+            self._map_dict_loads = None
+
+    def _get_capability(self, name, cli_type, *args):
+        """Return the output of a show command, cached as a capability."""
+        value = self.capabilities.get(name)
+        if value is None:
+            generation = self.capabilities.generation
+            rc, value = self._execute(cli_type, *args)
+            self.capabilities.set(name, value, generation)
+        return value
+
+    def invalidate_capabilities(self):
+        """Read the license, tiers and host settings again on next use."""
+        self.capabilities.invalidate()
+        LOG.info('Capabilities of the RAID [%s] invalidated.', self.ip)
+
     def create_snapshot(self, snapshot):
         """Creates a snapshot."""
 
@@ -1606,32 +2088,184 @@ class InfortrendCommon(object):
                             'snapshot_id': snapshot['id']})
 
     def _get_part_id(self, volume_id, pool_id=None):
+        part = self._find_partition(name=volume_id, pool_id=pool_id)
         count = 0
-        while True:
-            if count == 2:
-                rc, part_list = self._execute('ShowPartition')
-            else:
-                rc, part_list = self._execute('ShowPartition')
-
-            for entry in part_list:
-                if pool_id is None:
-                    if entry['Name'] == volume_id:
-                        return entry['ID']
-                else:
-                    if (entry['Name'] == volume_id and
-                            entry['LV-ID'] == pool_id):
-                        return entry['ID']
-
+        while part is None:
             if count >= 3:
                 msg = _('Failed to get partition info '
                         'from volume_id: %(volume_id)s.') % {
                     'volume_id': volume_id}
                 LOG.error(msg)
                 raise exception.VolumeBackendAPIException(data=msg)
-            else:
-                time.sleep(4)
+            # The RAID may list a new partition late.
+            time.sleep(4)
             count = count + 1
-        return
+            if pool_id:
+                self._load_lv_partitions(pool_id)
+            else:
+                self._load_partitions()
+            part = self.partitions.find(volume_id, pool_id)
+        return part['ID']
+
+    def _find_partition(self, part_id=None, name=None, pool_id=None):
+        """Return the partition row by ID or by name, None if not found.
+
+        A partition made outside of this backend since the last load is
+        not in the inventory. A miss by ID shows that partition, a miss
+        by name reloads the pool if given. The inventory is not reloaded
+        on a miss, it waits to expire.
+        """
+        reloaded = self._refresh_partitions()
+        if part_id:
+            part = self.partitions.get(part_id)
+            if part is None and not reloaded:
+                part = self._load_partition(part_id)
+            return part
+
+        part = self.partitions.find(name, pool_id)
+        if part is None and pool_id and not reloaded:
+            self._load_lv_partitions(pool_id)
+            part = self.partitions.find(name, pool_id)
+        return part
+
+    def _refresh_partitions(self):
+        """Reload the partition inventory if expired, or its stale LVs.
+
+        Returns True if the whole inventory was reloaded.
+        """
+        if self.partitions.expired():
+            self._load_partitions()
+            return True
+
+        for lv_id in self.partitions.stale_lvs():
+            self._load_lv_partitions(lv_id)
+        return False
+
+    def _load_partitions(self):
+        generation = self.partitions.generation
+        rc, part_list = self._execute('ShowPartition')
+        self.partitions.load(part_list, generation)
+
+    def _load_lv_partitions(self, lv_id):
+        generation = self.partitions.generation
+        rc, part_list = self._execute('ShowPartition', 'lv=%s' % lv_id)
+        self.partitions.load_lv(lv_id, part_list, generation)
+
+    def _load_partition(self, part_id):
+        """Add a partition missing from the inventory, None if not found."""
+        generation = self.partitions.generation
+        rc, part_list = self._execute('ShowPartition', 'part=%s' % part_id)
+        if rc != 0:
+            return None
+        self.partitions.load_part(part_id, part_list, generation)
+        return self.partitions.get(part_id)
+
+    def _get_partition_detail(self, part_id):
+        """Return the show part -l row of a partition, None if not found.
+
+        The inventory leaves out the columns only the detail has, like
+        Mapped.
+        """
+        rc, part_list = self._execute(
+            'ShowPartition', 'part=%s' % part_id, '-l')
+        if rc != 0:
+            return None
+        for part in part_list:
+            if part['ID'] == part_id:
+                return part
+        return None
+
+    def _track_change(self, cli_type, args, rc):
+        """Apply a change command to the partition and map inventories."""
+        if rc != 0:
+            # A LUN conflict of CreateMap reloads the maps of its
+            # channel, see _handle_lun_conflict.
+            return
+
+        if cli_type == 'CreatePartition':
+            with self._pool_usage_lock:
+                # The ID of the new partition is only known from a show.
+                self.partitions.invalidate_lv(args[0])
+                self._track_usage(
+                    args[0], new_row=self._new_partition_row(args[2:]))
+        elif cli_type == 'DeletePartition':
+            with self._pool_usage_lock:
+                part = self.partitions.get(args[0])
+                self.partitions.remove(args[0])
+                if part is not None:
+                    self._track_usage(part['LV-ID'], old_row=part)
+            self.maps.remove(args[0])
+        elif cli_type == 'SetPartition':
+            if args[0] == 'expand':
+                part = self.partitions.get(args[1])
+                size = args[2].split('=', 1)[1]
+                expand = cli.parse_size_mb('%s %s' % (size[:-2], size[-2:]))
+                if part is not None and expand is not None:
+                    changes = {'Size': part['Size'] + expand}
+                    # A full partition keeps all of its size reserved.
+                    if part.get('Min-reserve') == part['Size']:
+                        changes['Min-reserve'] = changes['Size']
+                    self._update_partition(args[1], changes)
+            elif args[0] not in cli.SetPartition.SUB_COMMANDS:
+                for arg in args[1:]:
+                    if arg.startswith('name='):
+                        self.partitions.update(
+                            args[0], {'Name': arg.split('=', 1)[1]})
+        elif cli_type == 'CreateMap' and args[0] == 'part':
+            self._track_new_map(*args[1:])
+        elif cli_type == 'DeleteMap' and args[0] == 'part':
+            if len(args) > 3:
+                self.maps.remove(args[1], args[2], args[3], int(args[4]))
+                self._update_channel_map_info(args[2], args[3])
+            else:
+                channels = set((row['Ch'], row['Target'])
+                               for row in self.maps.maps(args[1]))
+                self.maps.remove(args[1])
+                for channel_id, target_id in channels:
+                    self._update_channel_map_info(channel_id, target_id)
+
+    def _update_partition(self, part_id, changes):
+        """Apply a change to the partition inventory and pool usage."""
+        with self._pool_usage_lock:
+            part = self.partitions.get(part_id)
+            self.partitions.update(part_id, changes)
+            if part is not None:
+                new_part = dict(part)
+                new_part.update(changes)
+                self._track_usage(part['LV-ID'], part, new_part)
+
+    @staticmethod
+    def _new_partition_row(options):
+        """Return the columns a CreatePartition tells of its partition."""
+        values = dict(option.split('=', 1)
+                      for arg in options for option in arg.split()
+                      if '=' in option)
+        size = cli.parse_size_mb(values.get('size', ''))
+        reserve = values.get('min')
+        if reserve is not None:
+            reserve = cli.parse_size_mb(
+                '%s %s' % (reserve[:-2], reserve[-2:]))
+        return {
+            'Size': size,
+            'Min-reserve': size if reserve is None else reserve,
+        }
+
+    def _track_new_map(self, part_id, channel_id, target_id, lun, *options):
+        host_id = '---'
+        for option in options:
+            if option.startswith(('iqn=', 'wwn=')):
+                host_id = option.split('=', 1)[1]
+        part = self.partitions.get(part_id)
+        self.maps.add({
+            'Ch': channel_id,
+            'Target': target_id,
+            'LUN': int(lun),
+            'Media': 'PART',
+            'Name': part['Name'] if part else '',
+            'ID': part_id,
+            'Host-ID': host_id,
+        })
+        self._update_channel_map_info(channel_id, target_id)
 
     def create_volume_from_snapshot(self, volume, snapshot):
 
@@ -1724,7 +2358,7 @@ class InfortrendCommon(object):
         initiator_target_map, target_wwpns = self._build_initiator_target_map(
             connector, wwpn_list)
 
-        rc, part_mapping = self._execute('ShowMap', 'part=%s' % part_id)
+        part_mapping = self._get_part_maps(part_id)
 
         map_lun_list = []
 
@@ -1751,17 +2385,19 @@ class InfortrendCommon(object):
             return map_lun, target_wwpns, initiator_target_map
 
         # Update used LUN list
-        self._update_map_info(True)
+        self._update_map_info()
+        channels = self._get_fc_map_channels(wwpn_channel_info)
         map_lun = self._get_common_lun_map_id(wwpn_channel_info)
-        save_lun = map_lun
+        attempt = 0
+        if self._has_lun_conflicts():
+            map_lun = self._claim_lun_id(channels, attempt)
         while True:
             ret = self._create_new_fc_maps(
                 initiator_wwpn, initiator_target_map, target_wwpn,
                 wwpn_channel_info, part_id, map_lun)
             if ret == 20:
-                # Clean up the map for following re-create
-                self._delete_all_map(part_id)
-                map_lun = self._find_next_lun_id(map_lun, save_lun)
+                attempt += 1
+                map_lun = self._claim_lun_id(channels, attempt)
             else:
                 break
 
@@ -1769,6 +2405,7 @@ class InfortrendCommon(object):
 
     def _create_new_fc_maps(self, initiator_wwpn, initiator_target_map,
                             target_wwpn, wwpn_channel_info, part_id, map_lun):
+        created_maps = []
         for initiator_wwpn in sorted(initiator_target_map):
             for target_wwpn in initiator_target_map[initiator_wwpn]:
                 ch_id = wwpn_channel_info[target_wwpn.upper()]['channel']
@@ -1786,6 +2423,8 @@ class InfortrendCommon(object):
                                 'part_id': part_id, 'Ch': ch_id,
                                 'tid': target_id, 'lun': map_lun}
                     LOG.warning(msg)
+                    self._handle_lun_conflict(
+                        part_id, created_maps, ch_id, target_id, map_lun)
                     return 20
                 elif rc != 0:
                     msg = _('Volume[%(part_id)s] create map failed, '
@@ -1795,8 +2434,7 @@ class InfortrendCommon(object):
                     LOG.error(msg)
                     raise exception.VolumeDriverException(message=msg)
 
-                if map_lun in self.map_dict[controller][ch_id]:
-                    self.map_dict[controller][ch_id].remove(map_lun)
+                created_maps.append((ch_id, target_id))
         return rc
 
     def _build_initiator_target_map(self, connector, all_target_wwpns):
@@ -1836,14 +2474,73 @@ class InfortrendCommon(object):
             },
         }
 
-    def _find_next_lun_id(self, lun_id, save_id):
-        lun_id = lun_id + 1
-        if lun_id == self.constants['MAX_LUN_MAP_PER_CHL']:
-            lun_id = 0
-        elif lun_id == save_id:
+    def _handle_lun_conflict(self, part_id, created_maps, channel_id,
+                             target_id, lun_id):
+        """Undo a map that hit a LUN conflict and learn its channel.
+
+        Only the maps this attempt created are deleted, the other maps
+        of the partition stay. Only the maps of the conflicting channel
+        are read again.
+        """
+        for map_channel_id, map_target_id in sorted(set(created_maps)):
+            self._execute('DeleteMap', 'part', part_id, map_channel_id,
+                          map_target_id, str(lun_id), '-y')
+        with self._conflict_lock:
+            self._conflicted_luns[(channel_id, target_id, int(lun_id))] = (
+                time.monotonic())
+        self._load_channel_maps(channel_id)
+
+    def _load_channel_maps(self, channel_id):
+        rc, map_info = self._execute('ShowMap', 'channel=%s' % channel_id)
+        self.maps.load_channel(channel_id, map_info)
+        for slot_key in self.map_dict:
+            if channel_id in self.map_dict[slot_key]:
+                self._update_channel_map_info(
+                    channel_id, self.target_dict[slot_key].get(channel_id))
+
+    def _has_lun_conflicts(self):
+        """Return whether a map hit a LUN conflict recently."""
+        return bool(self._recent_lun_conflicts())
+
+    def _recent_lun_conflicts(self):
+        """Forget the old LUN conflicts, return the recent ones."""
+        now = time.monotonic()
+        with self._conflict_lock:
+            for key, conflicted_at in list(self._conflicted_luns.items()):
+                if now - conflicted_at >= self.LUN_CONFLICT_TIMEOUT:
+                    del self._conflicted_luns[key]
+            return list(self._conflicted_luns)
+
+    def _claim_lun_id(self, channels, attempt):
+        """Return the LUN to map with while another service maps too.
+
+        Used once a LUN conflict showed that another service maps on
+        the array. Services search from different offsets, taken from
+        a seed unique to each service and the attempt, so they stop
+        racing for the lowest free LUN. LUNs that recently conflicted
+        are skipped.
+
+        :param channels: the (controller, channel ID) pairs of the map
+        :param attempt: the number of conflicts of the map so far
+        """
+        max_lun = self.max_lun
+        conflicts = self._recent_lun_conflicts()
+
+        free_luns = []
+        for controller, channel_id in channels:
+            target_id = self.target_dict[controller].get(channel_id)
+            channel_free_luns = self.map_dict[controller][channel_id].copy()
+            for conflict_key in conflicts:
+                if conflict_key[:2] == (channel_id, target_id):
+                    channel_free_luns.reserve(conflict_key[2])
+            free_luns.append(channel_free_luns)
+
+        seed = '%s-%s' % (self._lun_search_seed, attempt)
+        offset = zlib.crc32(seed.encode('utf-8')) % max_lun
+        lun_id = inventory.first_common_lun(free_luns, max_lun, offset)
+        if lun_id < 0:
             msg = _('No available LUN among [%(max_lun)s] LUNs.'
-                    ) % {'max_lun':
-                         self.constants['MAX_LUN_MAP_PER_CHL']}
+                    ) % {'max_lun': max_lun}
             LOG.error(msg)
             raise exception.VolumeDriverException(message=msg)
         return lun_id
@@ -1901,22 +2598,20 @@ class InfortrendCommon(object):
             slot_id)
 
     @log_func
-    def _get_ip_by_channel(
-            self, channel_id, net_list, controller='slot_a'):
+    def _get_ip_by_channel(self, channel_id, controller='slot_a'):
 
         slot_name = 'slotA' if controller == 'slot_a' else 'slotB'
 
-        for entry in net_list:
-            if entry['ID'] == channel_id and entry['Slot'] == slot_name:
-                if entry['IPv4'] == '0.0.0.0':
-                    msg = _(
-                        'Please set ip on Channel[%(channel_id)s] '
-                        'with controller[%(controller)s].') % {
-                            'channel_id': channel_id, 'controller': slot_name}
-                    LOG.error(msg)
-                    raise exception.VolumeDriverException(message=msg)
-                else:
-                    return entry['IPv4']
+        ip = self.topology.ip(slot_name, channel_id)
+        if ip == '0.0.0.0':
+            msg = _(
+                'Please set ip on Channel[%(channel_id)s] '
+                'with controller[%(controller)s].') % {
+                    'channel_id': channel_id, 'controller': slot_name}
+            LOG.error(msg)
+            raise exception.VolumeDriverException(message=msg)
+        elif ip is not None:
+            return ip
 
         msg = _(
             'Can not find channel[%(channel_id)s] '
@@ -1927,12 +2622,12 @@ class InfortrendCommon(object):
         return
 
     def _get_wwpn_list(self):
-        rc, wwn_list = self._execute('ShowWWN')
+        self._refresh_topology()
 
         wwpn_list = []
         wwpn_channel_info = {}
 
-        for entry in wwn_list:
+        for entry in self.topology.wwns():
             channel_id = entry['CH']
             if 'BID' in entry['ID']:
                 slot_name = 'slot_b'
@@ -2101,18 +2796,7 @@ class InfortrendCommon(object):
         return lock_terminate_conn()
 
     def _delete_host_map(self, part_id, connector):
-        count = 0
-        while True:
-            rc, part_map_info = self._execute('ShowMap', 'part=%s' % part_id)
-            if len(part_map_info) > 0:
-                break
-            elif count > 2:
-                # in case of noinit fails
-                rc, part_map_info = self._execute('ShowMap',
-                                                  'part=%s' % part_id)
-                break
-            else:
-                count = count + 1
+        part_map_info = self._get_part_maps(part_id)
 
         if self.protocol == 'iSCSI':
             host = connector['initiator'].lower()
@@ -2135,7 +2819,7 @@ class InfortrendCommon(object):
                             entry['LUN'] == temp_lun):
                         self._execute(
                             'DeleteMap', 'part', part_id, entry['Ch'],
-                            entry['Target'], entry['LUN'], '-y')
+                            entry['Target'], str(entry['LUN']), '-y')
                         temp_ch = entry['Ch']
                         temp_tid = entry['Target']
                         temp_lun = entry['LUN']
@@ -2283,6 +2967,7 @@ class InfortrendCommon(object):
         return model_update
 
     def _wait_replica_complete(self, part_id):
+        @self._command_priority(cli.PRIORITY_BACKGROUND)
         def _inner():
             check_done = False
             try:
@@ -2304,7 +2989,7 @@ class InfortrendCommon(object):
 
     def _get_enable_specs_on_array(self):
         enable_specs = {}
-        rc, license_list = self._execute('ShowLicense')
+        license_list = self._get_capability('license', 'ShowLicense')
 
         for key, value in license_list.items():
             if value['Support']:
@@ -2315,8 +3000,11 @@ class InfortrendCommon(object):
     def manage_existing_get_size(self, volume, ref):
         """Return size of volume to be managed by manage_existing."""
 
-        volume_data = self._get_existing_volume_ref_data(ref)
         volume_pool_id = self._get_volume_pool_id(volume)
+        volume_data = self._get_existing_volume_ref_data(ref, volume_pool_id)
+
+        if volume_data:
+            volume_data = self._get_partition_detail(volume_data['ID'])
 
         if not volume_data:
             msg = _('Specified volume does not exist.')
@@ -2324,7 +3012,7 @@ class InfortrendCommon(object):
             raise exception.ManageExistingInvalidReference(
                 existing_ref=ref, reason=msg)
 
-        if volume_data['Mapped'].lower() != 'false':
+        if volume_data['Mapped'] is not False:
             msg = _('The specified volume is mapped. '
                     'Please unmap first for Openstack using.')
             LOG.error(msg)
@@ -2335,10 +3023,11 @@ class InfortrendCommon(object):
             LOG.error(msg)
             raise exception.VolumeBackendAPIException(data=msg)
 
-        return int(math.ceil(mi_to_gi(float(volume_data['Size']))))
+        return int(math.ceil(mi_to_gi(volume_data['Size'])))
 
     def manage_existing(self, volume, ref):
-        volume_data = self._get_existing_volume_ref_data(ref)
+        volume_data = self._get_existing_volume_ref_data(
+            ref, self._get_volume_pool_id(volume))
 
         if not volume_data:
             msg = _('Specified logical volume does not exist.')
@@ -2362,7 +3051,7 @@ class InfortrendCommon(object):
 
         return model_update
 
-    def _get_existing_volume_ref_data(self, ref):
+    def _get_existing_volume_ref_data(self, ref, pool_id=None):
 
         if 'source-name' in ref:
             key = 'Name'
@@ -2376,15 +3065,16 @@ class InfortrendCommon(object):
             raise exception.ManageExistingInvalidReference(
                 existing_ref=ref, reason=msg)
 
-        ref_dict = {}
-        rc, part_list = self._execute('ShowPartition', '-l')
-
-        for entry in part_list:
-            if entry[key] == find_key:
-                ref_dict = entry
-                break
+        if key == 'ID':
+            part = self._find_partition(part_id=find_key)
+        else:
+            # Reload only the volume's pool, a name from another pool
+            # is still found, for a clearer error.
+            part = self._find_partition(name=find_key, pool_id=pool_id)
+            if part is None and pool_id:
+                part = self._find_partition(name=find_key)
 
-        return ref_dict
+        return part or {}
 
     def unmanage(self, volume):
         part_id = self._extract_specific_provider_location(
@@ -2540,6 +3230,7 @@ class InfortrendCommon(object):
         self._wait_tier_migrate_complete(part_id)
 
     def _wait_tier_migrate_complete(self, part_id):
+        @self._command_priority(cli.PRIORITY_BACKGROUND)
         def _inner():
             check_done = False
             try:
@@ -2575,7 +3266,8 @@ class InfortrendCommon(object):
         manageable_volumes = []     # List to Return
         cinder_ids = [cinder_volume.id for cinder_volume in cinder_volumes]
 
-        rc, part_list = self._execute('ShowPartition', '-l')
+        with self._command_priority(cli.PRIORITY_BULK):
+            rc, part_list = self._execute('ShowPartition', '-l')
 
         for entry in part_list:
             # Check if parts are located within right LVs config.
@@ -2592,7 +3284,7 @@ class InfortrendCommon(object):
                 safety = False
                 reason = 'Already Managed'
                 cinder_id = entry['Name']
-            elif entry['Mapped'].lower() != 'false':
+            elif entry['Mapped'] is not False:
                 safety = False
                 reason = 'Volume In-use'
                 cinder_id = None
@@ -2607,7 +3299,7 @@ class InfortrendCommon(object):
                     'source-name': entry['Name'],
                     'pool-name': pool_name
                 },
-                'size': int(round(mi_to_gi(float(entry['Size'])))),
+                'size': int(round(mi_to_gi(entry['Size']))),
                 'safe_to_manage': safety,
                 'reason_not_safe': reason,
                 'cinder_id': cinder_id,
@@ -2635,15 +3327,9 @@ class InfortrendCommon(object):
 
         si = self._get_snapshot_ref_data(existing_ref)
 
-        rc, part_list = self._execute('ShowPartition')
-        volume_id = si['Partition-ID']
-
-        for entry in part_list:
-            if entry['ID'] == volume_id:
-                part = entry
-                break
+        part = self._find_partition(part_id=si['Partition-ID'])
 
-        return int(math.ceil(mi_to_gi(float(part['Size']))))
+        return int(math.ceil(mi_to_gi(part['Size'])))
 
     def get_manageable_snapshots(self, cinder_snapshots, marker, limit, offset,
                                  sort_keys, sort_dirs):
@@ -2652,8 +3338,9 @@ class InfortrendCommon(object):
         manageable_snapshots = []  # List to Return
         cinder_si_ids = [cinder_si.id for cinder_si in cinder_snapshots]
 
-        rc, si_list = self._execute('ShowSnapshot', '-l')
-        rc, part_list = self._execute('ShowPartition', '-l')
+        with self._command_priority(cli.PRIORITY_BULK):
+            rc, si_list = self._execute('ShowSnapshot', '-l')
+            rc, part_list = self._execute('ShowPartition', '-l')
 
         for entry in si_list:
             # Check if parts are located within right LVs config.
@@ -2676,7 +3363,7 @@ class InfortrendCommon(object):
                 safety = False
                 reason = 'Already Managed'
                 cinder_id = entry['Name']
-            elif part['Mapped'].lower() != 'false':
+            elif part['Mapped'] is not False:
                 safety = False
                 reason = 'Volume In-use'
                 cinder_id = None
@@ -2690,7 +3377,7 @@ class InfortrendCommon(object):
                     'source-id': entry['ID'],
                     'source-name': entry['Name']
                 },
-                'size': int(round(mi_to_gi(float(part['Size'])))),
+                'size': int(round(mi_to_gi(part['Size']))),
                 'safe_to_manage': safety,
                 'reason_not_safe': reason,
                 'cinder_id': cinder_id,
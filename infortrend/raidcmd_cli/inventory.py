@@ -0,0 +1,593 @@
+# Copyright (c) 2015 Infortrend Technology, Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+Infortrend RAID inventory.
+
+In-memory copies of the RAID objects the driver looks up on every
+request. They do no I/O: the driver loads them from show commands,
+applies its own changes to them and reloads them once they expire.
+"""
+import threading
+import time
+
+from cinder.volume.drivers.infortrend.raidcmd_cli import cli_factory as cli
+
+
+class Inventory(object):
+
+    """The expiry of an inventory loaded from the RAID."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._loaded_at = None
+        # Bumped by every change, a load that raced one is not trusted.
+        self.generation = 0
+
+    def expired(self):
+        with self._lock:
+            return (self._loaded_at is None or
+                    time.monotonic() - self._loaded_at >= self.ttl)
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def _loaded(self, generation):
+        if generation is None or generation == self.generation:
+            self._loaded_at = time.monotonic()
+        else:
+            self._loaded_at = None
+
+
+class PartitionInventory(Inventory):
+
+    """The partitions of a RAID, indexed by ID, name and LV-ID.
+
+    Rows are the ShowPartition rows of ``show part``, which leave out
+    whether a partition is mapped. An LV marked stale, after a partition
+    was created in it, has to be reloaded before its partitions can be
+    trusted again.
+    """
+
+    def __init__(self, ttl):
+        super(PartitionInventory, self).__init__(ttl)
+        self._by_id = {}
+        self._by_name = {}
+        self._by_lv = {}
+        self._stale_lvs = set()
+        # Counts the loads no change raced, counters taken from the
+        # inventory are recounted after the next one.
+        self.loads = 0
+
+    def stale_lvs(self):
+        with self._lock:
+            return sorted(self._stale_lvs)
+
+    def load(self, rows, generation=None):
+        """Replace the whole inventory with the rows of show part.
+
+        :param generation: the generation read before the show command
+                           started, the inventory stays expired if a
+                           change was applied since
+        """
+        with self._lock:
+            self._by_id = {}
+            self._by_name = {}
+            self._by_lv = {}
+            for row in rows:
+                self._add(row)
+            self._stale_lvs.clear()
+            if generation is None or generation == self.generation:
+                self.loads += 1
+            self._loaded(generation)
+
+    def load_lv(self, lv_id, rows, generation=None):
+        """Replace the partitions of one LV with the rows of its show."""
+        with self._lock:
+            for part_id in list(self._by_lv.get(lv_id, ())):
+                self._discard(part_id)
+            for row in rows:
+                if row['LV-ID'] == lv_id:
+                    self._add(row)
+            if generation is None or generation == self.generation:
+                self._stale_lvs.discard(lv_id)
+
+    def load_part(self, part_id, rows, generation=None):
+        """Replace one partition with the rows of its show.
+
+        Nothing is replaced if a change was applied since generation.
+        """
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._discard(part_id)
+            for row in rows:
+                if row['ID'] == part_id:
+                    self._add(row)
+
+    def invalidate_lv(self, lv_id):
+        with self._lock:
+            self.generation += 1
+            self._stale_lvs.add(lv_id)
+
+    def get(self, part_id):
+        with self._lock:
+            return self._by_id.get(part_id)
+
+    def find(self, name, lv_id=None):
+        """Return the first partition named name, in lv_id if given."""
+        with self._lock:
+            for row in self._by_name.get(name, {}).values():
+                if lv_id is None or row['LV-ID'] == lv_id:
+                    return row
+        return None
+
+    def partitions(self, lv_id=None):
+        with self._lock:
+            if lv_id is None:
+                return list(self._by_id.values())
+            return list(self._by_lv.get(lv_id, {}).values())
+
+    def usage(self):
+        """Sum the partitions of every LV up in one pass.
+
+        :returns: a dict of LVUsage, by LV-ID
+        """
+        with self._lock:
+            result = {}
+            for lv_id, rows in self._by_lv.items():
+                usage = LVUsage()
+                for row in rows.values():
+                    usage.add(row)
+                result[lv_id] = usage
+            return result
+
+    def update(self, part_id, changes):
+        """Apply a change of the driver to the partition.
+
+        :param changes: the new values, by column name
+        """
+        with self._lock:
+            self.generation += 1
+            row = self._by_id.get(part_id)
+            if row is None:
+                return
+            row = dict(row)
+            row.update(changes)
+            self._discard(part_id)
+            self._add(row)
+
+    def remove(self, part_id):
+        with self._lock:
+            self.generation += 1
+            self._discard(part_id)
+
+    def _add(self, row):
+        if not isinstance(row, cli.PartitionRow):
+            row = cli.PartitionRow(row)
+        part_id = row['ID']
+        self._by_id[part_id] = row
+        self._by_name.setdefault(row['Name'], {})[part_id] = row
+        self._by_lv.setdefault(row['LV-ID'], {})[part_id] = row
+
+    def _discard(self, part_id):
+        row = self._by_id.pop(part_id, None)
+        if row is None:
+            return
+        for index, key in ((self._by_name, row['Name']),
+                           (self._by_lv, row['LV-ID'])):
+            rows = index.get(key)
+            if rows is not None:
+                rows.pop(part_id, None)
+                if not rows:
+                    del index[key]
+
+
+class LVUsage(object):
+
+    """What the partitions of one LV provision.
+
+    A partition reserving less than its size is thin provisioned, the
+    driver creates full ones with all of their size reserved.
+    """
+
+    __slots__ = ('provisioned', 'partitions', 'thin', 'full')
+
+    def __init__(self):
+        self.provisioned = 0
+        self.partitions = 0
+        self.thin = 0
+        self.full = 0
+
+    def copy(self):
+        usage = LVUsage()
+        for name in self.__slots__:
+            setattr(usage, name, getattr(self, name))
+        return usage
+
+    def add(self, row):
+        self._count(row, 1)
+
+    def remove(self, row):
+        self._count(row, -1)
+
+    def _count(self, row, sign):
+        size = row.get('Size') or 0
+        reserve = row.get('Min-reserve')
+        self.provisioned += sign * size
+        self.partitions += sign
+        if reserve is not None and reserve < size:
+            self.thin += sign
+        else:
+            self.full += sign
+
+    def __eq__(self, other):
+        if not isinstance(other, LVUsage):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name)
+                   for name in self.__slots__)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __repr__(self):
+        return 'LVUsage(%s)' % ', '.join(
+            '%s=%s' % (name, getattr(self, name)) for name in self.__slots__)
+
+
+class MapIndex(Inventory):
+
+    """The LUN maps of a RAID, indexed by partition, host and LUN.
+
+    Rows are the ShowMap rows, one per host filter of a LUN map. A
+    Host-ID of '---' maps the LUN to every host. The LUNs used on each
+    channel target are also kept as a bitmap, the complement of its
+    FreeLuns.
+    """
+
+    def __init__(self, ttl):
+        super(MapIndex, self).__init__(ttl)
+        self._rows = {}
+        self._by_part = {}
+        self._by_host = {}
+        self._by_target = {}
+        self._used_bits = {}
+        # Counts the loads no change raced, a copy taken from the index
+        # is rebuilt after the next one.
+        self.loads = 0
+
+    def load(self, rows, generation=None):
+        """Replace the whole index with the rows of show map."""
+        with self._lock:
+            self._rows = {}
+            self._by_part = {}
+            self._by_host = {}
+            self._by_target = {}
+            self._used_bits = {}
+            for row in rows:
+                self._add(row)
+            if generation is None or generation == self.generation:
+                self.loads += 1
+            self._loaded(generation)
+
+    def maps(self, part_id):
+        """Return the maps of the partition, ordered by Ch-Target-LUN."""
+        with self._lock:
+            rows = list(self._by_part.get(part_id, {}).values())
+        return sorted(rows, key=_map_order)
+
+    def mapped_partitions(self):
+        """Return the IDs of the partitions with any map."""
+        with self._lock:
+            return set(self._by_part)
+
+    def has_host_map(self, host_ids):
+        """Return whether any of the IQNs or WWPNs still has a map."""
+        with self._lock:
+            return any(host_id.lower() in self._by_host
+                       for host_id in host_ids)
+
+    def used_luns(self, channel_id, target_id):
+        with self._lock:
+            return set(self._by_target.get((channel_id, target_id), ()))
+
+    def free_luns(self, channel_id, target_id, count):
+        """Return the FreeLuns of the LUNs below count on the target."""
+        free_luns = FreeLuns.all(count)
+        with self._lock:
+            free_luns.bits &= ~self._used_bits.get((channel_id, target_id), 0)
+        return free_luns
+
+    def load_channel(self, channel_id, rows):
+        """Replace the maps of one channel with the rows of its show."""
+        with self._lock:
+            self.generation += 1
+            for key in [key for key in self._rows if key[0] == channel_id]:
+                self._discard(key)
+            for row in rows:
+                if row['Ch'] == channel_id:
+                    self._add(row)
+
+    def load_part(self, part_id, rows):
+        """Replace the maps of one partition with the rows of its show.
+
+        :returns: the (Ch, Target) pairs whose used LUNs may have changed
+        """
+        with self._lock:
+            self.generation += 1
+            targets = set()
+            for key, row in list(self._by_part.get(part_id, {}).items()):
+                targets.add((row['Ch'], row['Target']))
+                self._discard(key)
+            for row in rows:
+                if row['ID'] == part_id:
+                    self._add(row)
+                    targets.add((row['Ch'], row['Target']))
+        return targets
+
+    def add(self, row):
+        with self._lock:
+            self.generation += 1
+            self._add(row)
+
+    def remove(self, part_id, channel_id=None, target_id=None, lun=None):
+        """Remove the maps of the partition, or its map of one LUN."""
+        with self._lock:
+            self.generation += 1
+            for key, row in list(self._by_part.get(part_id, {}).items()):
+                if (channel_id is None or
+                        (row['Ch'], row['Target'], row['LUN']) ==
+                        (channel_id, target_id, lun)):
+                    self._discard(key)
+
+    def _add(self, row):
+        if not isinstance(row, cli.MapRow):
+            row = cli.MapRow(row)
+        key = _map_key(row)
+        self._discard(key)
+        self._rows[key] = row
+        self._by_part.setdefault(row['ID'], {})[key] = row
+        self._by_host.setdefault(key[3], {})[key] = row
+        target_key = (row['Ch'], row['Target'])
+        luns = self._by_target.setdefault(target_key, {})
+        luns.setdefault(row['LUN'], {})[key] = row
+        if row['LUN'] is not None:
+            self._used_bits[target_key] = (
+                self._used_bits.get(target_key, 0) | 1 << row['LUN'])
+
+    def _discard(self, key):
+        row = self._rows.pop(key, None)
+        if row is None:
+            return
+        for index, index_key in ((self._by_part, row['ID']),
+                                 (self._by_host, key[3])):
+            rows = index[index_key]
+            del rows[key]
+            if not rows:
+                del index[index_key]
+        target_key = (row['Ch'], row['Target'])
+        luns = self._by_target[target_key]
+        del luns[row['LUN']][key]
+        if not luns[row['LUN']]:
+            del luns[row['LUN']]
+            if row['LUN'] is not None:
+                self._used_bits[target_key] &= ~(1 << row['LUN'])
+            if not luns:
+                self._used_bits.pop(target_key, None)
+                del self._by_target[target_key]
+
+
+class Topology(Inventory):
+
+    """The ports of a RAID the driver maps volumes on.
+
+    Rows are the ShowNet rows of the iSCSI channels or the ShowWWN rows
+    of the FC channels. Portal IPs are indexed by slot and channel and
+    channels by MCS group, so a connection looks both up directly.
+    """
+
+    def __init__(self, ttl):
+        super(Topology, self).__init__(ttl)
+        self._ips = {}
+        self._wwns = []
+        self._mcs_ids = {}
+        self.loads = 0
+
+    def load_nets(self, rows, generation=None):
+        """Replace the portal IPs with the rows of show net."""
+        with self._lock:
+            self._ips = {}
+            for row in rows:
+                self._ips.setdefault((row['Slot'], row['ID']), row['IPv4'])
+            self.loads += 1
+            self._loaded(generation)
+
+    def load_wwns(self, rows, generation=None):
+        """Replace the target WWPNs with the rows of show wwn."""
+        with self._lock:
+            self._wwns = list(rows)
+            self.loads += 1
+            self._loaded(generation)
+
+    def ip(self, slot, channel_id):
+        """Return the IPv4 of the channel, None if it has no portal."""
+        with self._lock:
+            return self._ips.get((slot, channel_id))
+
+    def wwns(self):
+        with self._lock:
+            return list(self._wwns)
+
+    def add_mcs_channel(self, controller, mcs_id, channel_id):
+        with self._lock:
+            self._mcs_ids[(controller, channel_id)] = mcs_id
+
+    def mcs_id(self, controller, channel_id):
+        with self._lock:
+            return self._mcs_ids.get((controller, channel_id))
+
+    def clear_mcs_channels(self):
+        with self._lock:
+            self._mcs_ids = {}
+
+
+class CapabilityCache(object):
+
+    """Settings of the RAID that rarely change, such as its license.
+
+    Each entry is the output of one show command, trusted for its own
+    TTL and then read again as a whole.
+    """
+
+    def __init__(self, ttls):
+        """:param ttls: the seconds each entry is trusted, by name"""
+        self.ttls = dict(ttls)
+        self._lock = threading.Lock()
+        self._entries = {}
+        # Bumped by every invalidation, a load that raced one is not kept.
+        self.generation = 0
+
+    def get(self, name):
+        """Return the entry, None if it was not loaded or expired."""
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                return None
+            value, loaded_at = entry
+            if time.monotonic() - loaded_at >= self.ttls[name]:
+                return None
+            return value
+
+    def set(self, name, value, generation=None):
+        with self._lock:
+            if generation is None or generation == self.generation:
+                self._entries[name] = (value, time.monotonic())
+
+    def invalidate(self, name=None):
+        """Drop the entry, or all entries if no name is given."""
+        with self._lock:
+            self.generation += 1
+            if name is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(name, None)
+
+
+def _map_key(row):
+    return (row['Ch'], row['Target'], row['LUN'], row['Host-ID'].lower())
+
+
+def _map_order(row):
+    return (row['Ch'], row['Target'], row['LUN'])
+
+
+class FreeLuns(object):
+
+    """The free LUNs of a channel, as a bitmap.
+
+    Bit n is set while LUN n is free, so the lowest LUN free on several
+    channels is an AND of their bitmaps and the lowest set bit.
+    """
+
+    __slots__ = ('bits',)
+
+    def __init__(self, luns=()):
+        self.bits = 0
+        for lun in luns:
+            self.bits |= 1 << lun
+
+    @classmethod
+    def all(cls, count):
+        """Return the bitmap with the LUNs 0 to count - 1 free."""
+        free_luns = cls()
+        free_luns.bits = (1 << count) - 1
+        return free_luns
+
+    def copy(self):
+        free_luns = FreeLuns()
+        free_luns.bits = self.bits
+        return free_luns
+
+    def first(self):
+        """Return the lowest free LUN, -1 if none is free."""
+        return _lowest_bit(self.bits)
+
+    def reserve(self, lun):
+        self.bits &= ~(1 << lun)
+
+    def release(self, lun):
+        self.bits |= 1 << lun
+
+    def __contains__(self, lun):
+        return bool(self.bits >> lun & 1)
+
+    def __len__(self):
+        return bin(self.bits).count('1')
+
+    def __iter__(self):
+        bits = self.bits
+        while bits:
+            lun = _lowest_bit(bits)
+            yield lun
+            bits &= bits - 1
+
+    def __eq__(self, other):
+        if isinstance(other, FreeLuns):
+            return self.bits == other.bits
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'FreeLuns(%r)' % list(self)
+
+
+def first_common_lun(free_luns, count, start=0):
+    """Return the first LUN below count free on all bitmaps, or -1.
+
+    The search begins at LUN start and wraps around to LUN 0.
+    """
+    bits = (1 << count) - 1
+    for channel_free_luns in free_luns:
+        bits &= channel_free_luns.bits
+    lun = _lowest_bit(bits >> start << start)
+    if lun < 0:
+        lun = _lowest_bit(bits)
+    return lun
+
+
+def most_free_channel(free_luns, channel_ids):
+    """Return the first channel with the most free LUNs, or None.
+
+    :param free_luns: the FreeLuns by channel ID
+    """
+    most_free = None
+    free_count = 0
+    for channel_id in channel_ids:
+        # The popcount of the bitmap.
+        count = len(free_luns[channel_id])
+        if free_count < count:
+            most_free = channel_id
+            free_count = count
+    return most_free
+
+
+def _lowest_bit(bits):
+    return (bits & -bits).bit_length() - 1
@@ -13,9 +13,21 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import asyncio
+import os
+import socket
+import threading
+import time
+import tracemalloc
+
+import eventlet
+from eventlet import hubs
+from eventlet import patcher
 import mock
 
+from cinder import exception
 from cinder import test
+from cinder.volume.drivers.infortrend.raidcmd_cli import async_cli
 from cinder.volume.drivers.infortrend.raidcmd_cli import cli_factory as cli
 
 
@@ -375,6 +387,10 @@ class InfortrendCLITestData(object):
         'provisioned_capacity_gb':
             round((40000) / 1024, 2),
         'max_over_subscription_ratio': 20.0,
+        'total_volumes': 2,
+        'mapped_volumes': 1,
+        'thin_volumes': 0,
+        'full_volumes': 2,
     }]
 
     test_volume_states_thin = {
@@ -499,7 +515,7 @@ RAIDCmd:>
     def get_test_show_snapshot(self, partition_id=None, snapshot_id=None):
         if partition_id and snapshot_id:
             return (0, [{
-                'Map': 'No',
+                'Map': False,
                 'Partition-ID': partition_id,
                 'SI-ID': snapshot_id,
                 'Name': '---',
@@ -508,14 +524,14 @@ RAIDCmd:>
             }])
         else:
             return (0, [{
-                'Map': 'No',
+                'Map': False,
                 'Partition-ID': self.fake_partition_id[0],
                 'SI-ID': self.fake_snapshot_id[0],
                 'Name': '---',
                 'Activated-time': 'Thu, Jan 09 01:33:11 2020',
                 'Index': '1',
             }, {
-                'Map': 'No',
+                'Map': False,
                 'Partition-ID': self.fake_partition_id[0],
                 'SI-ID': self.fake_snapshot_id[1],
                 'Name': '---',
@@ -525,14 +541,14 @@ RAIDCmd:>
 
     def get_test_show_snapshot_named(self):
         return (0, [{
-            'Map': 'No',
+            'Map': False,
             'Partition-ID': self.fake_partition_id[0],
             'SI-ID': self.fake_snapshot_id[0],
             'Name': self.fake_snapshot_name[0],
             'Activated-time': 'Thu, Jan 09 01:33:11 2020',
             'Index': '1',
         }, {
-            'Map': 'No',
+            'Map': False,
             'Partition-ID': self.fake_partition_id[1],
             'SI-ID': self.fake_snapshot_id[1],
             'Name': self.fake_snapshot_name[1],
@@ -568,7 +584,7 @@ RAIDCmd:>
 
     def get_test_show_snapshot_detail_filled_block(self):
         return (0, [{
-            'Mapped': 'Yes',
+            'Mapped': True,
             'Created-time': 'Wed, Jun 10 10:57:16 2015',
             'ID': self.fake_snapshot_id[0],
             'Last-modification-time': 'Wed, Jun 10 10:57:16 2015',
@@ -578,7 +594,7 @@ RAIDCmd:>
             'Activation-schedule-time': 'Not Actived',
             'Mapping': 'CH:0/ID:0/LUN:1',
             'Index': '1',
-            'Used': '0',
+            'Used': 0,
             'Name': '---',
             'Valid-filled-block': '0',
             'Partition-ID': self.fake_partition_id[0],
@@ -586,7 +602,7 @@ RAIDCmd:>
 
     def get_test_show_snapshot_detail(self):
         return (0, [{
-            'Mapped': 'Yes',
+            'Mapped': True,
             'Created-time': 'Wed, Jun 10 10:57:16 2015',
             'ID': self.fake_snapshot_id[0],
             'Last-modification-time': 'Wed, Jun 10 10:57:16 2015',
@@ -596,7 +612,7 @@ RAIDCmd:>
             'Activation-schedule-time': 'Not Actived',
             'Mapping': 'CH:0/ID:0/LUN:1',
             'Index': '1',
-            'Used': '0',
+            'Used': 0,
             'Name': '---',
             'Valid-filled-block': '0',
             'Partition-ID': self.fake_partition_id[0],
@@ -615,11 +631,11 @@ RAIDCmd:>
             'Last-modification-time': 'Fri, Dec 23 07:54:33 2016',
             'Activated-time': 'Fri, Dec 23 08:29:41 2016',
             'Activation-schedule-time': 'Not Actived',
-            'Used': '0',
+            'Used': 0,
             'Valid-filled-block': '0',
             'Total-filled-block': '0',
             'Description': '---',
-            'Mapped': 'No',
+            'Mapped': False,
             'Mapping': '---',
             'Backup-to-Cloud': 'false',
             'Status': 'OK',
@@ -634,11 +650,11 @@ RAIDCmd:>
             'Last-modification-time': 'Fri, Dec 23 07:54:33 2016',
             'Activated-time': 'Fri, Dec 23 08:29:41 2016',
             'Activation-schedule-time': 'Not Actived',
-            'Used': '0',
+            'Used': 0,
             'Valid-filled-block': '0',
             'Total-filled-block': '0',
             'Description': '---',
-            'Mapped': 'No',
+            'Mapped': False,
             'Mapping': '---',
             'Backup-to-Cloud': 'false',
             'Status': 'OK',
@@ -653,11 +669,11 @@ RAIDCmd:>
             'Last-modification-time': 'Fri, Dec 23 07:54:33 2016',
             'Activated-time': 'Fri, Dec 23 08:29:41 2016',
             'Activation-schedule-time': 'Not Actived',
-            'Used': '0',
+            'Used': 0,
             'Valid-filled-block': '0',
             'Total-filled-block': '0',
             'Description': '---',
-            'Mapped': 'No',
+            'Mapped': False,
             'Mapping': '---',
             'Backup-to-Cloud': 'false',
             'Status': 'OK',
@@ -673,11 +689,11 @@ RAIDCmd:>
             'Last-modification-time': 'Fri, Dec 23 07:54:33 2016',
             'Activated-time': 'Fri, Dec 23 08:29:41 2016',
             'Activation-schedule-time': 'Not Actived',
-            'Used': '0',
+            'Used': 0,
             'Valid-filled-block': '0',
             'Total-filled-block': '0',
             'Description': '---',
-            'Mapped': 'No',
+            'Mapped': False,
             'Mapping': '---',
             'Backup-to-Cloud': 'false',
             'Status': 'OK',
@@ -849,26 +865,26 @@ RAIDCmd:>
     def get_test_show_partition(self, volume_id=None, pool_id=None):
         result = [{
             'ID': self.fake_partition_id[0],
-            'Used': '20000',
+            'Used': 20000,
             'Name': self.fake_volume_id[0],
-            'Size': '20000',
-            'Min-reserve': '20000',
+            'Size': 20000,
+            'Min-reserve': 20000,
             'LV-ID': self.fake_lv_id[0],
         }, {
             'ID': self.fake_partition_id[1],
-            'Used': '20000',
+            'Used': 20000,
             'Name': self.fake_volume_id[1],
-            'Size': '20000',
-            'Min-reserve': '20000',
+            'Size': 20000,
+            'Min-reserve': 20000,
             'LV-ID': self.fake_lv_id[0],
         }]
         if volume_id and pool_id:
             result.append({
                 'ID': self.fake_partition_id[2],
-                'Used': '20000',
+                'Used': 20000,
                 'Name': volume_id,
-                'Size': '20000',
-                'Min-reserve': '20000',
+                'Size': 20000,
+                'Min-reserve': 20000,
                 'LV-ID': pool_id,
             })
         return (0, result)
@@ -894,15 +910,15 @@ RAIDCmd:>
                       self.fake_lv_id[0])
 
     def get_test_show_partition_detail_for_map(
-            self, partition_id, mapped='true'):
+            self, partition_id, mapped=True):
         result = [{
             'LV-ID': self.fake_lv_id[0],
             'Mapping': 'CH:1/ID:0/LUN:0, CH:1/ID:0/LUN:1',
-            'Used': '20000',
-            'Size': '20000',
+            'Used': 20000,
+            'Size': 20000,
             'ID': partition_id,
             'Progress': '---',
-            'Min-reserve': '20000',
+            'Min-reserve': 20000,
             'Last-modification-time': 'Wed, Jan 08 20:23:23 2020',
             'Valid-filled-block': '100',
             'Name': self.fake_volume_id[0],
@@ -916,29 +932,29 @@ RAIDCmd:>
         result = [{
             'LV-ID': self.fake_lv_id[0],
             'Mapping': 'CH:1/ID:0/LUN:0, CH:1/ID:0/LUN:1, CH:4/ID:0/LUN:0',
-            'Used': '20000',
-            'Size': '20000',
+            'Used': 20000,
+            'Size': 20000,
             'ID': self.fake_partition_id[0],
             'Progress': '---',
-            'Min-reserve': '20000',
+            'Min-reserve': 20000,
             'Last-modification-time': 'Wed, Jan 08 20:23:23 2020',
             'Valid-filled-block': '100',
             'Name': self.fake_volume_id[0],
-            'Mapped': 'true',
+            'Mapped': True,
             'Total-filled-block': '100',
             'Creation-time': 'Wed, Jan 08 20:23:23 2020',
         }, {
             'LV-ID': self.fake_lv_id[0],
             'Mapping': '---',
-            'Used': '20000',
-            'Size': '20000',
+            'Used': 20000,
+            'Size': 20000,
             'ID': self.fake_partition_id[1],
             'Progress': '---',
-            'Min-reserve': '20000',
+            'Min-reserve': 20000,
             'Last-modification-time': 'Sat, Jan 11 22:18:40 2020',
             'Valid-filled-block': '100',
             'Name': self.fake_volume_id[1],
-            'Mapped': 'false',
+            'Mapped': False,
             'Total-filled-block': '100',
             'Creation-time': 'Sat, Jan 11 22:18:40 2020',
         }]
@@ -946,43 +962,43 @@ RAIDCmd:>
             result.extend([{
                 'LV-ID': pool_id,
                 'Mapping': '---',
-                'Used': '20000',
-                'Size': '20000',
+                'Used': 20000,
+                'Size': 20000,
                 'ID': self.fake_partition_id[2],
                 'Progress': '---',
-                'Min-reserve': '20000',
+                'Min-reserve': 20000,
                 'Last-modification-time': 'Sat, Jan 15 22:18:40 2020',
                 'Valid-filled-block': '100',
                 'Name': volume_id,
-                'Mapped': 'false',
+                'Mapped': False,
                 'Total-filled-block': '100',
                 'Creation-time': 'Sat, Jan 15 22:18:40 2020',
             }, {
                 'LV-ID': '987654321',
                 'Mapping': '---',
-                'Used': '20000',
-                'Size': '20000',
+                'Used': 20000,
+                'Size': 20000,
                 'ID': '123123123123',
                 'Progress': '---',
-                'Min-reserve': '20000',
+                'Min-reserve': 20000,
                 'Last-modification-time': 'Sat, Jan 12 22:18:40 2020',
                 'Valid-filled-block': '100',
                 'Name': volume_id,
-                'Mapped': 'false',
+                'Mapped': False,
                 'Total-filled-block': '100',
                 'Creation-time': 'Sat, Jan 15 22:18:40 2020',
             }, {
                 'LV-ID': self.fake_lv_id[0],
                 'Mapping': '---',
-                'Used': '20000',
-                'Size': '20000',
+                'Used': 20000,
+                'Size': 20000,
                 'ID': '6bb119a8-d25b-45a7-8d1b-88e127885666',
                 'Progress': '---',
-                'Min-reserve': '20000',
+                'Min-reserve': 20000,
                 'Last-modification-time': 'Sat, Jan 16 22:18:40 2020',
                 'Valid-filled-block': '100',
                 'Name': volume_id,
-                'Mapped': 'false',
+                'Mapped': False,
                 'Total-filled-block': '100',
                 'Creation-time': 'Sat, Jan 14 22:18:40 2020',
             }])
@@ -1334,10 +1350,10 @@ RAIDCmd:>
         return (0, [{
             'Name': 'LV-1',
             'LD-amount': '1',
-            'Available': '841978 MB',
+            'Available': 841978,
             'ID': self.fake_lv_id[0],
             'Progress': '---',
-            'Size': '857982 MB',
+            'Size': 857982,
             'Status': 'On-line',
         }])
 
@@ -1360,10 +1376,10 @@ RAIDCmd:>
             'Policy': 'Default',
             'Status': 'On-line',
             'ID': self.fake_lv_id[0],
-            'Available': '841978 MB',
+            'Available': 841978,
             'Expandable-size': '0 MB',
             'Name': 'LV-1',
-            'Size': '857982 MB',
+            'Size': 857982,
             'LD-amount': '1',
             'Progress': '---',
         }])
@@ -1392,17 +1408,17 @@ RAIDCmd:>
         return (0, [{
             'LV-Name': 'LV-1',
             'LV-ID': self.fake_lv_id[1],
-            'Tier': '0',
-            'Size': '418.93 GB',
-            'Used': '10 GB(2.4%)',
+            'Tier': 0,
+            'Size': 428984,
+            'Used': 10240,
             'Data Service': '0 MB(0.0%)',
             'Reserved Ratio': '10.0%',
         }, {
             'LV-Name': 'LV-1',
             'LV-ID': self.fake_lv_id[1],
-            'Tier': '3',
-            'Size': '931.02 GB',
-            'Used': '0 MB(0.0%)',
+            'Tier': 3,
+            'Size': 953364,
+            'Used': 0,
             'Data Service': '0 MB(0.0%)',
             'Reserved Ratio': '0.0%',
         }])
@@ -1411,17 +1427,17 @@ RAIDCmd:>
         return (0, [{
             'LV-Name': 'LV-1',
             'LV-ID': self.fake_lv_id[0],
-            'Tier': '0',
-            'Size': '418.93 GB',
-            'Used': '10 GB(2.4%)',
+            'Tier': 0,
+            'Size': 428984,
+            'Used': 10240,
             'Data Service': '0 MB(0.0%)',
             'Reserved Ratio': '10.0%',
         }, {
             'LV-Name': 'LV-1',
             'LV-ID': self.fake_lv_id[0],
-            'Tier': '3',
-            'Size': '931.02 GB',
-            'Used': '0 MB(0.0%)',
+            'Tier': 3,
+            'Size': 953364,
+            'Used': 0,
             'Data Service': '0 MB(0.0%)',
             'Reserved Ratio': '0.0%',
         }])
@@ -1880,7 +1896,7 @@ RAIDCmd:>
     def get_show_map_with_lun_map_on_zoning(self):
         return (0, [{
             'Ch': '0',
-            'LUN': '0',
+            'LUN': 0,
             'Media': 'PART',
             'Host-ID': self.fake_initiator_wwpns[0],
             'Target': '112',
@@ -1892,7 +1908,7 @@ RAIDCmd:>
         if partition_id and channel_id:
             return (0, [{
                 'Ch': channel_id,
-                'LUN': '0',
+                'LUN': 0,
                 'Media': 'PART',
                 'Host-ID': '---',
                 'Target': '0',
@@ -1900,7 +1916,7 @@ RAIDCmd:>
                 'ID': partition_id,
             }, {
                 'Ch': channel_id,
-                'LUN': '1',
+                'LUN': 1,
                 'Media': 'PART',
                 'Host-ID': '---',
                 'Target': '0',
@@ -1910,7 +1926,7 @@ RAIDCmd:>
         else:
             return (0, [{
                 'Ch': '1',
-                'LUN': '0',
+                'LUN': 0,
                 'Media': 'PART',
                 'Host-ID': self.fake_initiator_iqn[0],
                 'Target': '0',
@@ -1918,7 +1934,7 @@ RAIDCmd:>
                 'ID': self.fake_partition_id[0],
             }, {
                 'Ch': '1',
-                'LUN': '1',
+                'LUN': 1,
                 'Media': 'PART',
                 'Host-ID': self.fake_initiator_iqn[0],
                 'Target': '0',
@@ -1926,7 +1942,7 @@ RAIDCmd:>
                 'ID': self.fake_partition_id[0],
             }, {
                 'Ch': '4',
-                'LUN': '0',
+                'LUN': 0,
                 'Media': 'PART',
                 'Host-ID': self.fake_initiator_iqn[0],
                 'Target': '0',
@@ -1937,7 +1953,7 @@ RAIDCmd:>
     def get_test_show_map_fc(self):
         return (0, [{
             'Ch': '0',
-            'LUN': '0',
+            'LUN': 0,
             'Media': 'PART',
             'Host-ID': self.fake_initiator_wwpns[0],
             'Target': '112',
@@ -1945,7 +1961,7 @@ RAIDCmd:>
             'ID': self.fake_partition_id[0],
         }, {
             'Ch': '0',
-            'LUN': '0',
+            'LUN': 0,
             'Media': 'PART',
             'Host-ID': self.fake_initiator_wwpns[1],
             'Target': '112',
@@ -1953,7 +1969,7 @@ RAIDCmd:>
             'ID': self.fake_partition_id[0],
         }, {
             'Ch': '5',
-            'LUN': '0',
+            'LUN': 0,
             'Media': 'PART',
             'Host-ID': self.fake_initiator_wwpns[0],
             'Target': '112',
@@ -1961,7 +1977,7 @@ RAIDCmd:>
             'ID': self.fake_partition_id[0],
         }, {
             'Ch': '5',
-            'LUN': '0',
+            'LUN': 0,
             'Media': 'PART',
             'Host-ID': self.fake_initiator_wwpns[1],
             'Target': '112',
@@ -1972,7 +1988,7 @@ RAIDCmd:>
     def get_test_show_map_multimap(self):
         return (0, [{
             'Ch': '1',
-            'LUN': '0',
+            'LUN': 0,
             'Media': 'PART',
             'Host-ID': '---',
             'Target': '0',
@@ -1980,7 +1996,7 @@ RAIDCmd:>
             'ID': self.fake_partition_id[0],
         }, {
             'Ch': '1',
-            'LUN': '1',
+            'LUN': 1,
             'Media': 'PART',
             'Host-ID': '---',
             'Target': '0',
@@ -1988,7 +2004,7 @@ RAIDCmd:>
             'ID': self.fake_partition_id[0],
         }, {
             'Ch': '4',
-            'LUN': '0',
+            'LUN': 0,
             'Media': 'PART',
             'Host-ID': '210000E08B0AADE1',
             'Target': '0',
@@ -1996,7 +2012,7 @@ RAIDCmd:>
             'ID': self.fake_partition_id[0],
         }, {
             'Ch': '4',
-            'LUN': '0',
+            'LUN': 0,
             'Media': 'PART',
             'Host-ID': '210000E08B0AADE2',
             'Target': '0',
@@ -2518,7 +2534,7 @@ class InfortrendCLITestCase(test.TestCase):
 
         if isinstance(out, list):
             for i in range(len(test_data[1])):
-                self.assertDictEqual(test_data[1][i], out[i])
+                self.assertDictEqual(test_data[1][i], dict(out[i]))
         else:
             self.assertDictEqual(test_data[1], out)
 
@@ -2668,3 +2684,528 @@ class InfortrendCLITestCase(test.TestCase):
             self.cli_data.get_fake_show_host(),
             self.cli_data.get_test_show_host(),
             cli.ShowHost)
+
+    def test_show_output_parser_chunks(self):
+        for command, fake, params in [
+                (cli.ShowPartition,
+                 self.cli_data.get_fake_show_partition(), ()),
+                (cli.ShowPartition,
+                 self.cli_data.get_fake_show_partition_detail(), ('-l',)),
+                (cli.ShowIQN, self.cli_data.get_fake_show_iqn(), ())]:
+            test_command = self._cli_set(command, fake)
+            test_command.parameters = params
+            expect = test_command._parser(fake)
+
+            for size in (1, 7, 64):
+                parser = cli.ShowOutputParser(test_command)
+                rows = []
+                # raidcmd prints no newline after the prompt.
+                output = fake.rstrip('\n')
+                for i in range(0, len(output), size):
+                    rows.extend(parser.feed(output[i:i + size]))
+                rows.extend(parser.close())
+
+                self.assertEqual(expect, (0, rows))
+                self.assertEqual((0, None), (parser.rc, parser.out))
+
+    def test_show_row(self):
+        row = cli.MapRow({'Ch': '1', 'LUN': '0', 'Extra': 'x'})
+
+        self.assertEqual('1', row['Ch'])
+        self.assertEqual('x', row['Extra'])
+        self.assertIsNone(row.get('Target'))
+        self.assertNotIn('Target', row)
+        self.assertRaises(KeyError, lambda: row['Host-ID'])
+        self.assertEqual({'Ch': '1', 'LUN': '0', 'Extra': 'x'}, dict(row))
+        self.assertFalse(hasattr(row, '__dict__'))
+
+    def test_show_schema(self):
+        self.assertEqual(12, cli.parse_int('12'))
+        self.assertIsNone(cli.parse_int('---'))
+        self.assertTrue(cli.parse_bool('Yes'))
+        self.assertFalse(cli.parse_bool('false'))
+        self.assertIsNone(cli.parse_bool('N/A'))
+        self.assertEqual(20000, cli.parse_size_mb('20000'))
+        self.assertEqual(857982, cli.parse_size_mb('857982 MB'))
+        self.assertEqual(10240, cli.parse_size_mb('10 GB(2.4%)'))
+        self.assertEqual(1048576, cli.parse_size_mb('1 TB'))
+        self.assertIsNone(cli.parse_size_mb('1 PB'))
+        self.assertIsNone(cli.parse_size_mb('N/A'))
+
+    def test_show_row_memory(self):
+        entry = self.cli_data.get_fake_show_partition_detail()
+        entry = entry[entry.index(' ID:'):entry.index('\n\n', 1) + 2]
+        fake = ('show part -l\n' + entry * 2000 +
+                'CLI: Successful: 2000 partition(s) shown\n'
+                'Return: 0x0000\n\nRAIDCmd:>')
+
+        def retained(row_class):
+            test_command = self._cli_set(cli.ShowPartition, fake)
+            test_command.parameters = ('-l',)
+            test_command.row_class = row_class
+            tracemalloc.start()
+            try:
+                rc, rows = test_command._parser(fake)
+                size = tracemalloc.get_traced_memory()[0]
+            finally:
+                tracemalloc.stop()
+            self.assertEqual(2000, len(rows))
+            return size
+
+        self.assertLess(retained(cli.PartitionRow), retained(None) * 0.6)
+
+    def _table_line(self, cells, widths=(16, 64, 16, 10, 10, 11)):
+        return ' ' + '  '.join(
+            cell.ljust(width) for cell, width in zip(cells, widths))
+
+    def test_table_columns(self):
+        header = self._table_line(
+            ('ID', 'Name', 'LV-ID', 'Size', 'Used', 'Min-reserve'))
+        fake = '\n'.join([
+            'show part',
+            header,
+            '-' * len(header),
+            self._table_line((self.cli_data.fake_partition_id[0],
+                              'Data  Volume', self.cli_data.fake_lv_id[0],
+                              '20000', '', '20000')),
+            '',
+            'CLI: Successful: 1 partition(s) shown',
+            'Return: 0x0000',
+            '',
+            'RAIDCmd:>'])
+        test_command = self._cli_set(cli.ShowPartition, fake)
+
+        self.assertEqual((0, [{
+            'ID': self.cli_data.fake_partition_id[0],
+            'Name': 'Data  Volume',
+            'LV-ID': self.cli_data.fake_lv_id[0],
+            'Size': 20000,
+            'Used': None,
+            'Min-reserve': 20000,
+        }]), test_command._parser(fake))
+
+    def test_table_columns_unknown_header(self):
+        header = ' ID  Name  LV-ID  Size  Used  Min-reserve  Extra'
+
+        columns = cli.TableColumns(header, (
+            'ID', 'Name', 'LV-ID', 'Size', 'Used', 'Min-reserve'))
+
+        self.assertEqual(('ID', 'Name', 'LV-ID', 'Size', 'Used',
+                          'Min-reserve', 'Extra'), columns.names)
+        self.assertIsNone(columns.split(' 1234567890ABCDEF  Part-1'))
+
+    def test_table_columns_large_table(self):
+        names = ('ID', 'Name', 'LV-ID', 'Size', 'Used', 'Min-reserve')
+        header = self._table_line(names)
+        table = [self._table_line((
+            '%016X' % i, 'volume-%d' % i, self.cli_data.fake_lv_id[0],
+            '20000', '20000', '20000')) for i in range(10000)]
+
+        keys = cli.strip_empty_in_list(header.split('  '))
+        expect = [dict(zip(keys, cli.strip_empty_in_list(row.split('  '))))
+                  for row in table]
+        columns = cli.TableColumns(header, names)
+
+        self.assertEqual(expect, [dict(zip(columns.names, columns.split(row)))
+                                  for row in table])
+
+    @mock.patch.object(cli, 'PARSE_CHUNK_SIZE', 7)
+    @mock.patch.object(cli.LOG, 'debug', mock.Mock())
+    def test_show_partition_detail_in_chunks(self):
+        self._test_show_command(
+            self.cli_data.get_fake_show_partition_detail(),
+            self.cli_data.get_test_show_partition_detail(),
+            cli.ShowPartition, '-l')
+
+    @mock.patch.object(cli.LOG, 'debug', mock.Mock())
+    def test_os_read_returns_on_prompt(self):
+        read_fd, write_fd = os.pipe()
+        self.addCleanup(os.close, read_fd)
+        self.addCleanup(os.close, write_fd)
+        os.write(write_fd,
+                 self.cli_data.get_fake_cli_succeed().encode('utf-8'))
+
+        timing = {}
+        with mock.patch.object(
+                cli.hubs, 'trampoline',
+                wraps=cli.hubs.trampoline) as trampoline, \
+                mock.patch.object(
+                    cli, 'os_read_nonblocking',
+                    wraps=cli.os_read_nonblocking) as read:
+            content = cli.os_read(read_fd, 8192, 'RAIDCmd:>', 60, timing)
+
+        # The first wakeup reads the prompt, no more waits or reads.
+        self.assertEqual(1, trampoline.call_count)
+        self.assertEqual(1, read.call_count)
+        self.assertEqual(self.cli_data.get_fake_cli_succeed(), content)
+        self.assertIn('first_output', timing)
+        self.assertIn('prompt', timing)
+
+    @mock.patch.object(cli.LOG, 'error', mock.Mock())
+    def test_os_read_timeout(self):
+        read_fd, write_fd = os.pipe()
+        self.addCleanup(os.close, read_fd)
+        self.addCleanup(os.close, write_fd)
+        os.write(write_fd, b'show part')
+
+        content = cli.os_read(read_fd, 8192, 'RAIDCmd:>', 0.1)
+
+        self.assertEqual('Raidcmd timeout: show part', content)
+
+    @mock.patch.object(cli.LOG, 'debug', mock.Mock())
+    def test_os_read_idle_timeout(self):
+        raidcmd, driver = socket.socketpair()
+        self.addCleanup(raidcmd.close)
+        self.addCleanup(driver.close)
+
+        def fake_raidcmd():
+            # Keep streaming for longer than the idle timeout.
+            for i in range(6):
+                raidcmd.sendall(b'row\r\n')
+                eventlet.sleep(0.05)
+            raidcmd.sendall(b'RAIDCmd:>')
+
+        eventlet.spawn(fake_raidcmd)
+        content = cli.os_read(
+            driver.fileno(), 8192, 'RAIDCmd:>', 0.2, max_timeout=5)
+
+        self.assertEqual('row\r\n' * 6 + 'RAIDCmd:>', content)
+
+    @mock.patch.object(cli.LOG, 'error')
+    def test_os_read_max_timeout(self, log_error):
+        raidcmd, driver = socket.socketpair()
+        self.addCleanup(raidcmd.close)
+        self.addCleanup(driver.close)
+
+        def fake_raidcmd():
+            for i in range(10):
+                raidcmd.sendall(b'row\r\n')
+                eventlet.sleep(0.05)
+
+        eventlet.spawn(fake_raidcmd)
+        content = cli.os_read(
+            driver.fileno(), 8192, 'RAIDCmd:>', 0.2, max_timeout=0.2)
+
+        self.assertTrue(content.startswith('Raidcmd timeout: row\r\n'))
+        self.assertIn('max timeout', log_error.call_args[0][0])
+
+    @mock.patch.object(cli.LOG, 'debug', mock.Mock())
+    def test_os_read_large_output(self):
+        raidcmd, driver = socket.socketpair()
+        self.addCleanup(raidcmd.close)
+        self.addCleanup(driver.close)
+        listing = 'x' * (4 * 1024 * 1024) + 'RAIDCmd:>'
+
+        def fake_raidcmd():
+            raidcmd.sendall(listing.encode('utf-8'))
+
+        thread = threading.Thread(target=fake_raidcmd)
+        thread.daemon = True
+        thread.start()
+        driver.setblocking(False)
+        output = cli.RaidcmdOutput('RAIDCmd:>', 5)
+        content = None
+        while content is None:
+            hubs.trampoline(driver.fileno(), read=True, timeout=5)
+            content = cli.os_drain(driver.fileno(), output)
+
+        self.assertEqual(listing, content)
+        self.assertGreater(output.read_size, 8192)
+
+    def test_raidcmd_output_split_reads(self):
+        output = cli.RaidcmdOutput('RAIDCmd:>', 60)
+        data = u'Name: caf\xe9\r\nRAIDCmd:>'.encode('utf-8')
+
+        arrived = [output.feed(data[i:i + 1]) for i in range(len(data))]
+
+        self.assertEqual([False] * (len(data) - 1) + [True], arrived)
+        self.assertEqual(u'Name: caf\xe9\r\nRAIDCmd:>', output.content)
+
+    def _feed_transcript(self, size):
+        row = self.cli_data.get_fake_show_partition_detail().replace(
+            'RAIDCmd:>', '').encode('utf-8')
+        transcript = row * (size // len(row)) + b'RAIDCmd:>'
+        output = cli.RaidcmdOutput('RAIDCmd:>', 60)
+
+        reads = 0
+        for i in range(0, len(transcript), 8192):
+            output.feed(transcript[i:i + 8192])
+            reads += 1
+
+        self.assertTrue(output.content.endswith('RAIDCmd:>'))
+        # Each read only rescans the bytes a split prompt could start in.
+        self.assertLessEqual(
+            output.scanned,
+            len(transcript) + reads * (len('RAIDCmd:>') - 1))
+        return output.scanned
+
+    def test_raidcmd_output_scales_linearly(self):
+        # A quadratic reader scans 16 times more of 4 times the output.
+        small = self._feed_transcript(2 * 1024 * 1024)
+        large = self._feed_transcript(8 * 1024 * 1024)
+
+        self.assertLess(large, small * 5)
+
+    @mock.patch.object(cli.LOG, 'error', mock.Mock())
+    def test_os_read_closed(self):
+        read_fd, write_fd = os.pipe()
+        self.addCleanup(os.close, read_fd)
+        os.write(write_fd, b'show part')
+        os.close(write_fd)
+
+        content = cli.os_read(read_fd, 8192, 'RAIDCmd:>', 60)
+
+        self.assertEqual('Raidcmd closed: show part', content)
+
+    def test_os_execute_does_not_block_greenthreads(self):
+        raidcmd, driver = socket.socketpair()
+        self.addCleanup(raidcmd.close)
+        self.addCleanup(driver.close)
+        ticked = eventlet.Event()
+
+        def fake_raidcmd():
+            # Answer only after the ticker ran, which it can only do
+            # while os_execute waits.
+            ticked.wait()
+            raidcmd.sendall(
+                self.cli_data.get_fake_cli_succeed().encode('utf-8'))
+
+        def ticker():
+            ticked.send()
+
+        eventlet.spawn(fake_raidcmd)
+        eventlet.spawn(ticker)
+        content = cli.os_execute(driver.fileno(), 5, 'show part\n')
+
+        self.assertEqual(self.cli_data.get_fake_cli_succeed(), content)
+        self.assertTrue(ticked.ready())
+
+    def _async_session(self, *replies):
+        # The asyncio loop blocks the eventlet hub, so the fake raidcmd
+        # needs a real thread and socket.
+        raidcmd, driver = patcher.original('socket').socketpair()
+        self.addCleanup(raidcmd.close)
+        self.addCleanup(driver.close)
+        commands = []
+
+        def fake_raidcmd():
+            # Answer each command line with the next reply.
+            for reply in replies:
+                command = b''
+                while not command.endswith(b'\n'):
+                    command += raidcmd.recv(1)
+                commands.append(command.decode('utf-8'))
+                raidcmd.sendall(reply.encode('utf-8'))
+
+        thread = patcher.original('threading').Thread(target=fake_raidcmd)
+        thread.daemon = True
+        thread.start()
+
+        session = async_cli.AsyncRaidcmdSession(
+            'java', 'raidcmd.jar', raidcmd_timeout=5, cli_retry_time=2)
+        driver.setblocking(False)
+        session.fd = driver.fileno()
+        return session, commands
+
+    @mock.patch.object(cli.LOG, 'debug', mock.Mock())
+    def test_async_session_run(self):
+        session, commands = self._async_session(
+            self.cli_data.get_fake_show_partition(),
+            self.cli_data.get_fake_show_partition())
+
+        async def run():
+            return await asyncio.gather(
+                session.run('show part'), session.run('ShowPartition'))
+
+        results = asyncio.run(run())
+
+        expect = (0, self.cli_data.get_test_show_partition()[1])
+        self.assertEqual([expect, expect], [
+            (rc, [dict(row) for row in out]) for rc, out in results])
+        self.assertEqual(['show part  \n', 'show part  \n'], commands)
+
+    @mock.patch.object(cli.LOG, 'debug', mock.Mock())
+    @mock.patch.object(cli.LOG, 'error', mock.Mock())
+    def test_async_session_run_retry(self):
+        session, commands = self._async_session(
+            self.cli_data.get_fake_cli_failed(),
+            self.cli_data.get_fake_cli_succeed())
+
+        rc, out = asyncio.run(session.run('DeleteMap', 'part', '123'))
+
+        self.assertEqual(0, rc)
+        self.assertEqual(['delete map part 123 \n'] * 2, commands)
+
+    @mock.patch.object(cli.LOG, 'debug', mock.Mock())
+    @mock.patch.object(async_cli.LOG, 'warning', mock.Mock())
+    def test_async_session_reopen_broken(self):
+        session, commands = self._async_session(
+            self.cli_data.get_fake_cli_succeed())
+        session.broken = True
+        reopened = []
+
+        async def fake_reopen():
+            reopened.append(session.broken)
+            session.broken = False
+
+        session._reopen = fake_reopen
+        rc, out = asyncio.run(session.run('DeleteMap', 'part', '123'))
+
+        self.assertEqual(0, rc)
+        self.assertEqual([True], reopened)
+        self.assertEqual(['delete map part 123 \n'], commands)
+
+    def test_async_session_parse_without_eventlet(self):
+        session = async_cli.AsyncRaidcmdSession('java', 'raidcmd.jar')
+        names = ('ID', 'Name', 'LV-ID', 'Size', 'Used', 'Min-reserve')
+        header = self._table_line(names)
+        fake = '\n'.join(
+            ['show part', header, '-' * len(header)] +
+            [self._table_line(('%016X' % i, 'volume-%d' % i,
+                               self.cli_data.fake_lv_id[0],
+                               '20000', '20000', '20000'))
+             for i in range(cli.PARSE_YIELD_ROWS)] +
+            ['', 'CLI: Successful: partition(s) shown', 'Return: 0x0000',
+             '', 'RAIDCmd:>'])
+
+        with mock.patch.object(cli.eventlet, 'sleep') as sleep:
+            rc, out = cli.ShowPartition(session.cli_conf)._parser(fake)
+            self.assertEqual(cli.PARSE_YIELD_ROWS, len(out))
+            self.assertFalse(sleep.called)
+
+            cli.ShowPartition({})._parser(fake)
+            sleep.assert_called_once_with()
+
+    def test_async_get_command(self):
+        self.assertEqual(cli.ShowPartition, async_cli.get_command('show part'))
+        self.assertEqual(cli.CreateMap, async_cli.get_command('CreateMap'))
+        self.assertRaises(exception.VolumeDriverException,
+                          async_cli.get_command, 'show nothing')
+
+    def _fake_session(self, alive=True):
+        session = mock.Mock(connected=False, broken=False)
+        session.is_alive.return_value = alive
+        return session
+
+    def test_session_pool_connect_once(self):
+        sessions = [self._fake_session(), self._fake_session()]
+        connect = mock.Mock()
+        pool = cli.RaidcmdSessionPool(
+            2, mock.Mock(side_effect=sessions), connect)
+        pool.start()
+
+        for i in range(4):
+            with pool.session() as session:
+                self.assertIn(session, sessions)
+
+        connect.assert_has_calls(
+            [mock.call(sessions[0]), mock.call(sessions[1])])
+        self.assertEqual(2, connect.call_count)
+
+    @mock.patch.object(cli.LOG, 'warning', mock.Mock())
+    def test_session_pool_replace_dead_session(self):
+        dead_session = self._fake_session(alive=False)
+        new_session = self._fake_session()
+        pool = cli.RaidcmdSessionPool(
+            1, mock.Mock(side_effect=[dead_session, new_session]),
+            mock.Mock())
+        pool.start()
+
+        with pool.session() as session:
+            self.assertEqual(new_session, session)
+
+        dead_session.close.assert_called_once_with()
+        self.assertEqual([new_session], pool._sessions)
+
+    @mock.patch.object(cli.LOG, 'error', mock.Mock())
+    def test_command_timeout_not_retried_on_session(self):
+        test_command = self._cli_multi_set(cli.ShowMap, [
+            'Raidcmd timeout: show map',
+            self.cli_data.get_fake_show_map(),
+        ])
+
+        rc, out = test_command.execute()
+
+        self.assertEqual(-3, rc)
+        self.assertEqual(1, test_command._execute.call_count)
+
+    def test_session_pool_reconnect(self):
+        session = self._fake_session()
+        connect = mock.Mock()
+        pool = cli.RaidcmdSessionPool(
+            1, mock.Mock(return_value=session), connect)
+        pool.start()
+
+        with pool.session():
+            pass
+        pool.reconnect()
+        with pool.session():
+            pass
+
+        self.assertEqual(2, connect.call_count)
+
+    def test_lock_keys(self):
+        part_id = self.cli_data.fake_partition_id[0]
+        si_id = self.cli_data.fake_snapshot_id[0]
+
+        self.assertEqual((), cli.ShowPartition.lock_keys('-l'))
+        self.assertEqual((), cli.CheckConnection.lock_keys())
+        self.assertEqual(
+            ('part-%s' % part_id,),
+            cli.DeletePartition.lock_keys(part_id, '-y'))
+        self.assertEqual(
+            ('part-%s' % part_id,),
+            cli.SetPartition.lock_keys('expand', part_id, 'size=1GB'))
+        self.assertEqual(
+            ('part-%s' % part_id,),
+            cli.SetPartition.lock_keys(part_id, 'name=test'))
+        self.assertEqual(
+            ('si-%s' % si_id, 'part-%s' % part_id),
+            cli.CreateReplica.lock_keys(
+                'Cinder-Snapshot', 'si', si_id, 'part', part_id))
+        self.assertEqual(('raidcmd',), cli.DeleteIQN.lock_keys())
+
+    def test_session_pool_priority(self):
+        session = self._fake_session()
+        pool = cli.RaidcmdSessionPool(
+            1, mock.Mock(return_value=session), mock.Mock())
+        pool.start()
+        checkout_order = []
+
+        def run_command(priority):
+            with pool.session(priority):
+                checkout_order.append(priority)
+
+        with pool.session():
+            threads = [
+                threading.Thread(target=run_command, args=(priority,))
+                for priority in (cli.PRIORITY_BULK,
+                                 cli.PRIORITY_BACKGROUND,
+                                 cli.PRIORITY_INTERACTIVE)]
+            # Queue the commands from the lowest priority.
+            for waiters, thread in enumerate(threads, 1):
+                thread.start()
+                while len(pool._waiters) < waiters:
+                    time.sleep(0.01)
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([cli.PRIORITY_INTERACTIVE,
+                          cli.PRIORITY_BACKGROUND,
+                          cli.PRIORITY_BULK], checkout_order)
+        stats = pool.stats()
+        self.assertEqual(1, stats['bulk']['max_waiting'])
+        self.assertEqual(0, stats['bulk']['waiting'])
+        self.assertEqual(2, stats['interactive']['commands'])
+
+    def test_session_pool_aging(self):
+        session = self._fake_session()
+        pool = cli.RaidcmdSessionPool(
+            1, mock.Mock(return_value=session), mock.Mock(), aging=1)
+        now = time.time()
+        pool._waiters = [
+            {'priority': cli.PRIORITY_INTERACTIVE, 'time': now},
+            {'priority': cli.PRIORITY_BULK, 'time': now - 3},
+        ]
+
+        self.assertEqual(pool._waiters[1], pool._next_waiter())
@@ -14,6 +14,8 @@
 #    under the License.
 
 import copy
+import threading
+import time
 
 import mock
 
@@ -22,7 +24,9 @@ from cinder import test
 from cinder.tests.unit import utils
 from cinder.tests.unit.volume.drivers.infortrend import test_infortrend_cli
 from cinder.volume import configuration
+from cinder.volume.drivers.infortrend.raidcmd_cli import cli_factory as cli
 from cinder.volume.drivers.infortrend.raidcmd_cli import common_cli
+from cinder.volume.drivers.infortrend.raidcmd_cli import inventory
 from cinder.volume import utils as cv_utils
 
 SUCCEED = (0, '')
@@ -483,7 +487,7 @@ class InfortrendFCCommonTestCase(InfortrendTestCase):
         }
         self._driver_setup(mock_commands)
         self.driver.map_dict = {
-            'slot_a': {'0': [], '5': []},
+            'slot_a': {'0': inventory.FreeLuns(), '5': inventory.FreeLuns()},
             'slot_b': {},
         }
         self.driver.fc_lookup_service = mock.Mock()
@@ -519,14 +523,18 @@ class InfortrendFCCommonTestCase(InfortrendTestCase):
         test_partition_id = self.cli_data.fake_partition_id[0]
         test_connector = self.cli_data.test_connector_fc
 
+        rc, map_info = self.cli_data.get_show_map_with_lun_map_on_zoning()
+        # The initiator keeps a map of another partition.
+        map_info.append(
+            dict(map_info[0], ID=self.cli_data.fake_partition_id[1], LUN=1))
         mock_commands = {
             'DeleteMap': SUCCEED,
-            'ShowMap': self.cli_data.get_show_map_with_lun_map_on_zoning(),
+            'ShowMap': (rc, map_info),
             'ShowDevice': self.cli_data.get_test_show_device(),
         }
         self._driver_setup(mock_commands)
         self.driver.map_dict = {
-            'slot_a': {'0': [], '5': []},
+            'slot_a': {'0': inventory.FreeLuns(), '5': inventory.FreeLuns()},
             'slot_b': {},
         }
         self.driver.target_dict = {
@@ -644,6 +652,155 @@ class InfortrendiSCSICommonTestCase(InfortrendTestCase):
         self.driver._execute('DeleteIQN')
         self.assertEqual(1, log_warning.call_count)
 
+    @mock.patch('oslo_concurrency.lockutils.lock')
+    def test_execute_lock_by_object(self, lock):
+
+        test_partition_id = self.cli_data.fake_partition_id[0]
+        mock_commands = {
+            'ShowMap': self.cli_data.get_test_show_map(),
+            'CreateMap': SUCCEED,
+        }
+        self._driver_setup(mock_commands)
+
+        self.driver._execute('ShowMap')
+        lock.assert_not_called()
+
+        self.driver._execute(
+            'CreateMap', 'part', test_partition_id, '1', '0', '2', 'iqn=a')
+
+        expect_lock = [
+            mock.call('raidcmd-%s-lun-1-0-2' % self.driver.ip,
+                      'infortrend-'),
+            mock.call('raidcmd-%s-part-%s' % (
+                self.driver.ip, test_partition_id), 'infortrend-'),
+        ]
+        lock.assert_has_calls(expect_lock, any_order=True)
+        self.assertEqual(2, lock.call_count)
+
+    @mock.patch.object(common_cli.LOG, 'warning', mock.Mock())
+    @mock.patch.object(cli.LOG, 'warning', mock.Mock())
+    def test_execute_command_retry_timeout_on_new_session(self):
+
+        self.driver = self._get_driver(self.configuration)
+        self.driver.cli_conf = {}
+        timed_out = mock.Mock(connected=True, broken=False, pid=1, fd=1)
+        healthy = mock.Mock(connected=True, broken=False, pid=2, fd=2)
+        self.driver._session_pool = cli.RaidcmdSessionPool(
+            1, mock.Mock(side_effect=[timed_out, healthy]), mock.Mock())
+        self.driver._session_pool.start()
+        fds = []
+
+        def fake_execute(command, *args, **kwargs):
+            fds.append(command.fd)
+            if command.fd == timed_out.fd:
+                return -3, 'Raidcmd timeout: '
+            return SUCCEED
+
+        with mock.patch.object(cli.ShowMap, 'execute', autospec=True,
+                               side_effect=fake_execute):
+            rc, out = self.driver._execute_command('ShowMap')
+
+        self.assertEqual(SUCCEED, (rc, out))
+        self.assertEqual([timed_out.fd, healthy.fd], fds)
+        timed_out.close.assert_called_once_with()
+
+    def test_lock_raid_objects_unknown_objects_run_alone(self):
+
+        self._driver_setup({})
+        order = []
+        locked = threading.Event()
+        release = threading.Event()
+
+        def change(lock_keys, name, wait=None):
+            with self.driver._lock_raid_objects(lock_keys):
+                locked.set()
+                if wait is not None:
+                    wait.wait(5)
+                order.append(name)
+
+        keyed = threading.Thread(
+            target=change, args=(('part-1',), 'part-1', release))
+        keyed.start()
+        locked.wait(5)
+        # Changes of other objects run along.
+        change(('part-2',), 'part-2')
+        unknown = threading.Thread(
+            target=change, args=((cli.ARRAY_LOCK_KEY,), 'unknown'))
+        unknown.start()
+        unknown.join(0.1)
+        release.set()
+        keyed.join()
+        unknown.join()
+
+        self.assertEqual(['part-2', 'part-1', 'unknown'], order)
+
+    def test_execute_share_show_command(self):
+
+        self._driver_setup({})
+        release = threading.Event()
+        show_map = self.cli_data.get_test_show_map()
+
+        def fake_execute_command(cli_type, *args, **kwargs):
+            release.wait(5)
+            return show_map
+
+        self.driver._execute_command = mock.Mock(
+            side_effect=fake_execute_command)
+
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(self.driver._execute('ShowMap')))
+            for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for _ in range(500):
+            if self.driver._get_flight_stats()['hits'] == 2:
+                break
+            threading.Event().wait(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.driver._execute_command.assert_called_once_with('ShowMap')
+        self.assertEqual([show_map] * 3, results)
+        self.assertEqual(
+            {'hits': 2, 'misses': 1, 'rate': 200.0 / 3},
+            self.driver._get_flight_stats())
+
+    def test_execute_show_command_not_shared_across_change(self):
+
+        self._driver_setup({})
+        self.driver._execute_command = mock.Mock(return_value=SUCCEED)
+
+        key = ('ShowMap', (), (), cli.PRIORITY_INTERACTIVE)
+        self.driver._flights[key] = {
+            'generation': self.driver._flight_generation,
+            'event': threading.Event(),
+            'result': None,
+        }
+        with self.driver._fence_flights():
+            self.driver._execute('ShowMap')
+
+        self.driver._execute_command.assert_called_once_with('ShowMap')
+        self.assertEqual(1, self.driver._get_flight_stats()['misses'])
+
+    def test_execute_show_command_not_shared_across_priority(self):
+
+        self._driver_setup({})
+        self.driver._execute_command = mock.Mock(return_value=SUCCEED)
+
+        key = ('ShowMap', (), (), cli.PRIORITY_BACKGROUND)
+        self.driver._flights[key] = {
+            'generation': self.driver._flight_generation,
+            'event': threading.Event(),
+            'result': None,
+        }
+        self.driver._execute('ShowMap')
+
+        self.driver._execute_command.assert_called_once_with('ShowMap')
+        self.assertEqual(1, self.driver._get_flight_stats()['misses'])
+
     def test_normal_channel(self):
 
         test_map_dict = {
@@ -734,8 +891,16 @@ class InfortrendiSCSICommonTestCase(InfortrendTestCase):
         }
         lun_list = list(range(0, 127))
         fake_map_dict = {
-            'slot_a': {'1': lun_list[2:], '2': lun_list[:], '4': lun_list[1:]},
-            'slot_b': {'1': lun_list[:], '2': lun_list[:], '4': lun_list[:]},
+            'slot_a': {
+                '1': inventory.FreeLuns(lun_list[2:]),
+                '2': inventory.FreeLuns(lun_list[:]),
+                '4': inventory.FreeLuns(lun_list[1:]),
+            },
+            'slot_b': {
+                '1': inventory.FreeLuns(lun_list[:]),
+                '2': inventory.FreeLuns(lun_list[:]),
+                '4': inventory.FreeLuns(lun_list[:]),
+            },
         }
 
         test_map_chl = {
@@ -766,8 +931,15 @@ class InfortrendiSCSICommonTestCase(InfortrendTestCase):
         }
         lun_list = list(range(0, 127))
         fake_map_dict = {
-            'slot_a': {'1': lun_list[2:], '2': lun_list[:], '4': lun_list[1:]},
-            'slot_b': {'1': lun_list[:], '2': lun_list[:]},
+            'slot_a': {
+                '1': inventory.FreeLuns(lun_list[2:]),
+                '2': inventory.FreeLuns(lun_list[:]),
+                '4': inventory.FreeLuns(lun_list[1:]),
+            },
+            'slot_b': {
+                '1': inventory.FreeLuns(lun_list[:]),
+                '2': inventory.FreeLuns(lun_list[:]),
+            },
         }
 
         test_map_chl = {
@@ -799,15 +971,15 @@ class InfortrendiSCSICommonTestCase(InfortrendTestCase):
         lun_list = list(range(0, 127))
         fake_map_dict = {
             'slot_a': {
-                '1': lun_list[2:],
-                '2': lun_list[3:],
-                '3': lun_list[:],
-                '4': lun_list[1:],
-                '5': lun_list[:],
+                '1': inventory.FreeLuns(lun_list[2:]),
+                '2': inventory.FreeLuns(lun_list[3:]),
+                '3': inventory.FreeLuns(lun_list[:]),
+                '4': inventory.FreeLuns(lun_list[1:]),
+                '5': inventory.FreeLuns(lun_list[:]),
             },
             'slot_b': {
-                '1': lun_list[:],
-                '2': lun_list[:],
+                '1': inventory.FreeLuns(lun_list[:]),
+                '2': inventory.FreeLuns(lun_list[:]),
             },
         }
 
@@ -828,6 +1000,61 @@ class InfortrendiSCSICommonTestCase(InfortrendTestCase):
         self.assertDictEqual(test_map_chl, map_chl)
         self.assertEqual(test_map_lun, map_lun)
 
+    def test_free_luns(self):
+
+        free_luns = inventory.FreeLuns.all(4)
+        free_luns.reserve(0)
+        free_luns.reserve(2)
+
+        self.assertEqual([1, 3], free_luns)
+        self.assertEqual(2, len(free_luns))
+        self.assertEqual(1, free_luns.first())
+        self.assertNotIn(0, free_luns)
+
+        free_luns.release(0)
+        free_luns.reserve(1)
+        free_luns.reserve(3)
+
+        self.assertEqual(0, free_luns.first())
+        self.assertEqual(
+            3, inventory.first_common_lun(
+                [inventory.FreeLuns([1, 3]), inventory.FreeLuns([0, 3])], 4))
+        self.assertEqual(
+            -1, inventory.first_common_lun(
+                [inventory.FreeLuns([1]), inventory.FreeLuns([0, 4])], 4))
+        self.assertEqual(-1, inventory.FreeLuns().first())
+        self.assertEqual(
+            '2', inventory.most_free_channel(
+                {'1': inventory.FreeLuns([0]),
+                 '2': inventory.FreeLuns([0, 1]),
+                 '4': inventory.FreeLuns([0, 2])}, ['1', '2', '4']))
+        self.assertIsNone(
+            inventory.most_free_channel({'1': inventory.FreeLuns()}, ['1']))
+
+    def test_free_luns_many_channels(self):
+        max_lun = 4096
+        channels = 32
+        used_luns = [set(range(ch, max_lun // 2, ch + 1))
+                     for ch in range(channels)]
+        # The lowest LUN no channel uses.
+        expect_lun = min(set(range(max_lun)).difference(*used_luns))
+
+        free_luns = []
+        for used in used_luns:
+            luns = inventory.FreeLuns.all(max_lun)
+            for lun in used:
+                luns.reserve(lun)
+            free_luns.append(luns)
+        lun_id = inventory.first_common_lun(free_luns, max_lun)
+        for luns in free_luns:
+            luns.reserve(lun_id)
+
+        self.assertEqual(expect_lun, lun_id)
+        for used, luns in zip(used_luns, free_luns):
+            self.assertEqual(
+                [lun for lun in range(max_lun)
+                 if lun not in used and lun != lun_id], list(luns))
+
     def test_specific_channel_with_multipath(self):
 
         configuration = copy.copy(self.configuration)
@@ -933,7 +1160,7 @@ class InfortrendiSCSICommonTestCase(InfortrendTestCase):
         self.driver.delete_volume(test_volume)
 
         expect_cli_cmd = [
-            mock.call('ShowPartition', '-l'),
+            mock.call('ShowPartition', 'part=%s' % test_partition_id, '-l'),
             mock.call('DeleteMap', 'part', test_partition_id, '-y'),
             mock.call('DeletePartition', test_partition_id, '-y'),
         ]
@@ -956,12 +1183,148 @@ class InfortrendiSCSICommonTestCase(InfortrendTestCase):
         self.driver.delete_volume(test_volume)
 
         expect_cli_cmd = [
-            mock.call('ShowPartition', '-l'),
+            mock.call('ShowPartition', 'part=%s' % test_partition_id, '-l'),
             mock.call('DeletePartition', test_partition_id, '-y'),
         ]
         self._assert_cli_has_calls(expect_cli_cmd)
         self.assertEqual(1, log_info.call_count)
 
+    def test_partition_inventory(self):
+
+        test_volume_id = self.cli_data.fake_volume_id[1]
+        test_partition_id = self.cli_data.fake_partition_id[1]
+        test_lv_id = self.cli_data.fake_lv_id[0]
+
+        mock_commands = {
+            'ShowPartition': self.cli_data.get_test_show_partition_detail(),
+            'CreatePartition': SUCCEED,
+            'SetPartition': SUCCEED,
+            'DeletePartition': SUCCEED,
+        }
+        self._driver_setup(mock_commands)
+
+        self.assertEqual(test_partition_id,
+                         self.driver._get_part_id(test_volume_id))
+        self.assertEqual(test_partition_id,
+                         self.driver._get_part_id(test_volume_id, test_lv_id))
+
+        self.driver._execute('SetPartition', test_partition_id, 'name=new')
+        self.driver._execute(
+            'SetPartition', 'expand', test_partition_id, 'size=1GB')
+        self.assertEqual(test_partition_id, self.driver._get_part_id('new'))
+        self.assertEqual(
+            21024, self.driver.partitions.get(test_partition_id)['Size'])
+
+        self.driver._execute('DeletePartition', test_partition_id, '-y')
+        self.assertIsNone(self.driver.partitions.get(test_partition_id))
+
+        # A miss by name does not reload the inventory.
+        self.assertIsNone(self.driver._find_partition(name='missing'))
+        self.assertEqual([mock.call('ShowPartition')], [
+            call for call in self.driver._execute_command.call_args_list
+            if call[0][0] == 'ShowPartition'])
+
+        # A miss by ID shows that partition only.
+        self.assertEqual(test_partition_id, self.driver._find_partition(
+            part_id=test_partition_id)['ID'])
+        self.driver._execute_command.assert_called_with(
+            'ShowPartition', 'part=%s' % test_partition_id)
+
+        # A new partition reloads its LV only.
+        self.driver._execute('CreatePartition', test_lv_id, 'new', 'size=1')
+        self.driver._get_part_id(self.cli_data.fake_volume_id[0])
+        self.driver._execute_command.assert_called_with(
+            'ShowPartition', 'lv=%s' % test_lv_id)
+
+        # An expired inventory is reloaded.
+        self.driver.partitions.ttl = 0
+        self.driver._get_part_id(self.cli_data.fake_volume_id[0])
+        self.driver._execute_command.assert_called_with('ShowPartition')
+
+    def test_lun_map_index_raced_load(self):
+
+        rc, map_info = self.cli_data.get_test_show_map()
+        maps = inventory.MapIndex(60)
+        maps.load(map_info)
+
+        # A change applied while show map ran.
+        generation = maps.generation
+        maps.remove(self.cli_data.fake_partition_id[0])
+        maps.load(map_info, generation)
+
+        self.assertEqual(1, maps.loads)
+        self.assertTrue(maps.expired())
+
+        maps.load(map_info, maps.generation)
+
+        self.assertEqual(2, maps.loads)
+        self.assertFalse(maps.expired())
+
+    def test_lun_map_index(self):
+
+        test_initiator = self.cli_data.fake_initiator_iqn[0]
+        test_partition_id = self.cli_data.fake_partition_id[0]
+        test_new_partition_id = self.cli_data.fake_partition_id[1]
+
+        mock_commands = {
+            'ShowMap': self.cli_data.get_test_show_map(),
+            'CreateMap': [SUCCEED, (20, '')],
+            'DeleteMap': SUCCEED,
+        }
+        self._driver_setup(mock_commands)
+        self.driver.map_dict = {
+            'slot_a': {'1': inventory.FreeLuns()},
+            'slot_b': {},
+        }
+        self.driver.target_dict = {
+            'slot_a': {'1': '0'},
+            'slot_b': {},
+        }
+
+        self.assertTrue(
+            self.driver._check_initiator_has_lun_map(test_initiator.upper()))
+        self.assertEqual(3, len(self.driver.maps.maps(test_partition_id)))
+        self.driver._update_map_info()
+        self.assertEqual(2, self.driver.map_dict['slot_a']['1'].first())
+
+        self.driver._execute('CreateMap', 'part', test_new_partition_id,
+                             '1', '0', '2', 'iqn=%s' % test_initiator)
+        self.assertEqual(
+            [2], [row['LUN'] for row in
+                  self.driver.maps.maps(test_new_partition_id)])
+        self.assertEqual({0, 1, 2}, self.driver.maps.used_luns('1', '0'))
+        self.driver._update_map_info()
+        self.assertEqual(3, self.driver.map_dict['slot_a']['1'].first())
+
+        self.driver._execute(
+            'DeleteMap', 'part', test_partition_id, '1', '0', '0', '-y')
+        self.assertEqual({1, 2}, self.driver.maps.used_luns('1', '0'))
+        self.assertEqual([0, 3], self.driver.maps.free_luns('1', '0', 4))
+        self.assertEqual(0, self.driver.map_dict['slot_a']['1'].first())
+        self.driver._execute('DeleteMap', 'part', test_partition_id, '-y')
+        self.driver._execute('DeleteMap', 'part', test_new_partition_id, '-y')
+        self.assertEqual([], self.driver.maps.maps(test_partition_id))
+        self.assertEqual([mock.call('ShowMap')], [
+            call for call in self.driver._execute_command.call_args_list
+            if call[0][0] == 'ShowMap'])
+
+        # The host is only found unmapped after a show.
+        mock_commands['ShowMap'] = (0, [])
+        self.assertFalse(
+            self.driver._check_initiator_has_lun_map([test_initiator]))
+        # Maps made by other services since are found.
+        mock_commands['ShowMap'] = self.cli_data.get_test_show_map()
+        self.assertTrue(
+            self.driver._check_initiator_has_lun_map([test_initiator]))
+        self.assertEqual(3, [
+            call[0][0] for call in self.driver._execute_command.call_args_list
+        ].count('ShowMap'))
+
+        # The attach that hit a LUN conflict reloads its channel.
+        self.driver._execute('CreateMap', 'part', test_partition_id,
+                             '1', '0', '0', 'iqn=%s' % test_initiator)
+        self.assertFalse(self.driver.maps.expired())
+
     def test_delete_volume_with_delete_fail(self):
 
         test_volume = self.cli_data.test_volume
@@ -1105,8 +1468,8 @@ class InfortrendiSCSICommonTestCase(InfortrendTestCase):
         mock_commands = {
             'InitCache': SUCCEED,
             'ShowLicense': self.cli_data.get_test_show_license_full(),
-            'ShowLV': [self.cli_data.get_test_show_lv_tier(),
-                       self.cli_data.get_test_show_lv()],
+            'ShowLV': self._mock_show_lv,
+            'ShowHost': self.cli_data.get_test_show_host(),
             'ShowDevice': self.cli_data.get_test_show_device(),
             'CheckConnection': SUCCEED,
         }
@@ -1127,9 +1490,10 @@ class InfortrendiSCSICommonTestCase(InfortrendTestCase):
         mock_commands = {
             'InitCache': SUCCEED,
             'ShowLicense': self.cli_data.get_test_show_license_thin(),
-            'ShowLV': [self.cli_data.get_test_show_lv_tier(),
-                       self.cli_data.get_test_show_lv()],
+            'ShowLV': self._mock_show_lv,
+            'ShowHost': self.cli_data.get_test_show_host(),
             'ShowPartition': self.cli_data.get_test_show_partition_detail(),
+            'ShowMap': self.cli_data.get_test_show_map(),
             'ShowDevice': self.cli_data.get_test_show_device(),
             'CheckConnection': SUCCEED,
         }
@@ -1142,6 +1506,240 @@ class InfortrendiSCSICommonTestCase(InfortrendTestCase):
         self.assertDictEqual.__self__.maxDiff = None
         self.assertDictEqual(test_volume_states, volume_states)
 
+    def test_partition_usage(self):
+
+        rc, rows = self.cli_data.get_test_show_partition_detail()
+        rows[1] = dict(rows[1], **{'Min-reserve': 4000})
+        rows.append(dict(rows[0], **{
+            'LV-ID': self.cli_data.fake_lv_id[1],
+            'ID': self.cli_data.fake_partition_id[2]}))
+        partitions = inventory.PartitionInventory(60)
+        partitions.load(rows)
+
+        usage = partitions.usage()
+
+        lv_usage = usage[self.cli_data.fake_lv_id[0]]
+        self.assertEqual(40000, lv_usage.provisioned)
+        self.assertEqual(2, lv_usage.partitions)
+        self.assertEqual(1, lv_usage.thin)
+        self.assertEqual(1, lv_usage.full)
+        lv_usage = usage[self.cli_data.fake_lv_id[1]]
+        self.assertEqual(1, lv_usage.partitions)
+        self.assertEqual(1, lv_usage.full)
+        self.assertNotIn(self.cli_data.fake_lv_id[2], usage)
+
+    def test_pool_usage(self):
+
+        test_lv_id = self.cli_data.fake_lv_id[0]
+        test_partition_id = self.cli_data.fake_partition_id[1]
+
+        mock_commands = {
+            'ShowPartition': self.cli_data.get_test_show_partition_detail(),
+            'CreatePartition': SUCCEED,
+            'SetPartition': SUCCEED,
+            'DeletePartition': SUCCEED,
+        }
+        self._driver_setup(mock_commands)
+
+        self.driver._recount_pool_usage()
+        usage = self.driver._get_pool_usage()[test_lv_id]
+        self.assertEqual((40000, 2), (usage.provisioned, usage.partitions))
+
+        # Our own changes are counted without reading the partitions.
+        self.driver._execute('CreatePartition', test_lv_id, 'new',
+                             'size=4096', 'init=disable min=0MB')
+        self.driver._execute(
+            'SetPartition', 'expand', test_partition_id, 'size=1GB')
+        self.driver._execute(
+            'DeletePartition', self.cli_data.fake_partition_id[0], '-y')
+        self.driver._recount_pool_usage()
+        usage = self.driver._get_pool_usage()[test_lv_id]
+        self.assertEqual((25120, 2, 1, 1), (
+            usage.provisioned, usage.partitions, usage.thin, usage.full))
+        self.assertEqual([mock.call('ShowPartition')], [
+            call for call in self.driver._execute_command.call_args_list
+            if call[0][0] == 'ShowPartition'])
+
+        # An expired inventory is read again and recounted.
+        self.driver.partitions.ttl = 0
+        self.driver._recount_pool_usage()
+        usage = self.driver._get_pool_usage()[test_lv_id]
+        self.assertEqual((40000, 2), (usage.provisioned, usage.partitions))
+        self.driver._execute_command.assert_called_with('ShowPartition')
+
+    @mock.patch.object(common_cli.LOG, 'info', mock.Mock())
+    def test_capability_cache(self):
+
+        test_lv_id = self.cli_data.fake_lv_id[0]
+
+        mock_commands = {
+            'ShowLicense': self.cli_data.get_test_show_license_thin(),
+            'ShowLV': self._mock_show_lv,
+            'ShowHost': self.cli_data.get_test_show_host(),
+        }
+        self._driver_setup(mock_commands)
+        self.driver._map_dict_loads = 1
+
+        def show_calls(*args):
+            return [call for call in
+                    self.driver._execute_command.call_args_list
+                    if call[0] == args]
+
+        self.driver._get_enable_specs_on_array()
+        self.driver._get_enable_specs_on_array()
+        self.driver._update_pool_tiers()
+        self.driver._check_tier_space(0, test_lv_id, 1024)
+        self.driver._update_max_lun()
+        self.driver._update_max_lun()
+
+        self.assertEqual(1, len(show_calls('ShowLicense')))
+        self.assertEqual(1, len(show_calls('ShowLV', 'tier')))
+        self.assertEqual(1, len(show_calls('ShowHost')))
+        self.assertEqual(64, self.driver.max_lun)
+        self.assertEqual(
+            128, self.driver.constants['MAX_LUN_MAP_PER_CHL'])
+        self.assertIsNone(self.driver._map_dict_loads)
+
+        # SIGHUP lets operators read the RAID again.
+        common_cli._on_config_mutate(common_cli.CONF, {})
+        self.driver._get_enable_specs_on_array()
+        self.assertEqual(2, len(show_calls('ShowLicense')))
+
+        # Each entry expires on its own.
+        self.driver.capabilities.ttls['tiers'] = 0
+        self.driver._update_pool_tiers()
+        self.driver._get_enable_specs_on_array()
+        self.assertEqual(2, len(show_calls('ShowLV', 'tier')))
+        self.assertEqual(2, len(show_calls('ShowLicense')))
+
+    @mock.patch.object(common_cli.LOG, 'info', mock.Mock())
+    def test_get_volume_stats_in_background(self):
+
+        mock_commands = {
+            'InitCache': SUCCEED,
+            'ShowLicense': self.cli_data.get_test_show_license_thin(),
+            'ShowLV': self._mock_show_lv,
+            'ShowHost': self.cli_data.get_test_show_host(),
+            'ShowPartition': self.cli_data.get_test_show_partition_detail(),
+            'ShowMap': self.cli_data.get_test_show_map(),
+            'ShowDevice': self.cli_data.get_test_show_device(),
+            'CheckConnection': SUCCEED,
+        }
+        self._driver_setup(mock_commands)
+        self.driver.system_id = self.cli_data.fake_system_id[0]
+
+        volume_states = self.driver.get_volume_stats(True)
+        self.assertEqual(1, self.driver._execute_command.call_args_list.count(
+            mock.call('CheckConnection')))
+
+        # Young stats are reported at once and refreshed in a thread.
+        self.driver._stats_updated_at -= 10
+        with mock.patch.object(common_cli.threading, 'Thread') as mock_thread:
+            self.assertEqual(
+                volume_states, self.driver.get_volume_stats(True))
+            self.driver.get_volume_stats(True)
+        self.assertEqual(1, mock_thread.call_count)
+        self.assertEqual(1, self.driver._execute_command.call_args_list.count(
+            mock.call('CheckConnection')))
+
+        mock_thread.call_args[1]['target']()
+        self.assertEqual(2, self.driver._execute_command.call_args_list.count(
+            mock.call('CheckConnection')))
+
+        # Stats older than the limit are refreshed before reporting.
+        self.driver._stats_updated_at -= (
+            self.configuration.infortrend_stats_max_age)
+        with mock.patch.object(
+                self.driver, '_start_stats_refresh') as start_stats_refresh:
+            self.driver.get_volume_stats(True)
+        start_stats_refresh.assert_not_called()
+        self.assertEqual(3, self.driver._execute_command.call_args_list.count(
+            mock.call('CheckConnection')))
+
+    @mock.patch.object(common_cli.LOG, 'info', mock.Mock())
+    def test_get_volume_stats_waits_for_refresh(self):
+
+        mock_commands = {
+            'InitCache': SUCCEED,
+            'ShowLicense': self.cli_data.get_test_show_license_thin(),
+            'ShowLV': self._mock_show_lv,
+            'ShowHost': self.cli_data.get_test_show_host(),
+            'ShowPartition': self.cli_data.get_test_show_partition_detail(),
+            'ShowMap': self.cli_data.get_test_show_map(),
+            'ShowDevice': self.cli_data.get_test_show_device(),
+            'CheckConnection': SUCCEED,
+        }
+        self._driver_setup(mock_commands)
+        self.driver.system_id = self.cli_data.fake_system_id[0]
+        self.driver.get_volume_stats(True)
+        self.driver._stats_updated_at -= (
+            self.configuration.infortrend_stats_max_age)
+        release = threading.Event()
+        update_volume_stats = self.driver._update_volume_stats
+        refresh_lock = mock.MagicMock()
+        lock = threading.Lock()
+        refresh_lock.__enter__.side_effect = lambda: lock.acquire()
+        refresh_lock.__exit__.side_effect = lambda *exc: lock.release()
+        self.driver._stats_refresh_lock = refresh_lock
+
+        def slow_update():
+            release.wait(5)
+            update_volume_stats()
+
+        with mock.patch.object(self.driver, '_update_volume_stats',
+                               side_effect=slow_update) as update:
+            background = threading.Thread(
+                target=self.driver._refresh_stats_in_background)
+            background.start()
+            # Stale stats wait for the refresh under way, not start one.
+            foreground = threading.Thread(
+                target=self.driver.get_volume_stats, args=(True,))
+            foreground.start()
+            for _ in range(500):
+                if refresh_lock.__enter__.call_count == 2:
+                    break
+                threading.Event().wait(0.01)
+            release.set()
+            background.join()
+            foreground.join()
+
+        self.assertEqual(1, update.call_count)
+
+    @mock.patch.object(common_cli.LOG, 'info', mock.Mock())
+    def test_get_volume_stats_concurrently(self):
+
+        test_volume_states = self.cli_data.test_volume_states_thin
+        # Every stats command waits for all others to be issued.
+        barrier = threading.Barrier(5, timeout=10)
+
+        def wait_all(result):
+            def fake_command(*args, **kwargs):
+                barrier.wait()
+                if callable(result):
+                    return result(*args, **kwargs)
+                return result
+            return fake_command
+
+        mock_commands = {
+            'InitCache': SUCCEED,
+            'ShowLicense': wait_all(
+                self.cli_data.get_test_show_license_thin()),
+            'ShowLV': wait_all(self._mock_show_lv),
+            'ShowHost': self.cli_data.get_test_show_host(),
+            'ShowPartition': wait_all(
+                self.cli_data.get_test_show_partition_detail()),
+            'ShowMap': wait_all(self.cli_data.get_test_show_map()),
+            'CheckConnection': SUCCEED,
+        }
+        self._driver_setup(mock_commands)
+        self.driver.VERSION = '99.99'
+        self.driver.system_id = self.cli_data.fake_system_id[0]
+        self.driver._thin_provisioning = True
+
+        volume_states = self.driver.get_volume_stats(True)
+
+        self.assertDictEqual(test_volume_states, volume_states)
+
     def test_get_volume_stats_fail(self):
 
         mock_commands = {
@@ -1464,6 +2062,139 @@ class InfortrendiSCSICommonTestCase(InfortrendTestCase):
         self.assertDictEqual(
             self.cli_data.test_iscsi_properties_empty_map, properties)
 
+    def test_initialize_connection_with_topology_cache(self):
+
+        test_volume = self.cli_data.test_volume
+        test_connector = copy.deepcopy(self.cli_data.test_connector_iscsi)
+        test_iscsi_properties = self.cli_data.test_iscsi_properties_empty_map
+        test_target_protal = [test_iscsi_properties['data']['target_portal']]
+        test_target_iqn = [test_iscsi_properties['data']['target_iqn']]
+
+        test_connector['multipath'] = False
+
+        mock_commands = {
+            'ShowChannel': self.cli_data.get_test_show_channel(),
+            'ShowMap': self.cli_data.get_test_show_empty_list(),
+            'ShowIQN': self.cli_data.get_test_show_iqn(),
+            'CreateMap': SUCCEED,
+            'ShowNet': self.cli_data.get_test_show_net(),
+            'ExecuteCommand': self.cli_data.get_fake_discovery(
+                test_target_iqn, test_target_protal),
+            'ShowDevice': self.cli_data.get_test_show_device(),
+        }
+        self._driver_setup(mock_commands)
+
+        def topology_calls():
+            return [
+                call[0][0] for call in
+                self.driver._execute_command.call_args_list
+                if call[0][0] in ('ShowChannel', 'ShowNet')]
+
+        properties = self.driver.initialize_connection(
+            test_volume, test_connector)
+        self.driver._init_map_info()
+        self.driver._refresh_topology()
+
+        self.assertDictEqual(test_iscsi_properties, properties)
+        self.assertEqual(['ShowChannel', 'ShowNet'], topology_calls())
+        self.assertEqual('172.27.0.3', self.driver._get_ip_by_channel('2'))
+
+        # A reconnect reads the topology again.
+        self.driver.topology.invalidate()
+        self.driver._init_map_info()
+        self.driver._refresh_topology()
+
+        self.assertEqual(['ShowChannel', 'ShowNet'] * 2, topology_calls())
+        self.assertEqual(['1', '2', '4'],
+                         sorted(self.driver.map_dict['slot_a']))
+
+    def test_lun_conflict_simulation(self):
+        # Two services attach volumes on one array, each from its own
+        # copy of the maps, which misses the maps of the other service.
+        test_initiator = self.cli_data.fake_initiator_iqn[0]
+        test_system_id = self.cli_data.fake_system_id[0]
+
+        def simulate(conflict_timeout):
+            array_maps = {}
+            stats = {'conflicts': 0, 'retries': 0}
+
+            def create_map(*args):
+                key = (args[2], args[3], int(args[4]))
+                if key in array_maps:
+                    stats['conflicts'] += 1
+                    return (20, '')
+                array_maps[key] = args[1]
+                return SUCCEED
+
+            def delete_map(*args):
+                del array_maps[(args[2], args[3], int(args[4]))]
+                return SUCCEED
+
+            def show_map(*args):
+                return 0, [{
+                    'Ch': ch, 'Target': target, 'LUN': lun, 'Media': 'PART',
+                    'Name': '', 'ID': part_id, 'Host-ID': test_initiator,
+                } for (ch, target, lun), part_id in sorted(array_maps.items())
+                    if not args or 'channel=%s' % ch in args]
+
+            services = []
+            for host in ('host-a', 'host-b'):
+                mock_commands = {
+                    'ShowChannel': self.cli_data.get_test_show_channel(),
+                    'ShowMap': show_map,
+                    'CreateMap': create_map,
+                    'DeleteMap': delete_map,
+                    'ShowNet': self.cli_data.get_test_show_net(),
+                }
+                self._driver_setup(mock_commands)
+                self.driver.LUN_CONFLICT_TIMEOUT = conflict_timeout
+                self.driver._init_map_info()
+                self.driver._update_map_info()
+                self.driver._lun_search_seed = host
+                services.append((host, self.driver))
+
+            for i in range(20):
+                for host, service in services:
+                    service._iscsi_create_map(
+                        '%s-%d' % (host, i), False, test_initiator,
+                        test_system_id)
+                    stats['retries'] += [
+                        call[0][0] for call in
+                        service._execute_command.call_args_list
+                    ].count('CreateMap') - 1
+                    service._execute_command.reset_mock()
+
+            self.assertEqual(40, len(array_maps))
+            self.assertEqual(40, len(set(array_maps.values())))
+            self.assertEqual(stats['conflicts'], stats['retries'])
+            return stats
+
+        stats = simulate(common_cli.InfortrendCommon.LUN_CONFLICT_TIMEOUT)
+        lowest_first_stats = simulate(0)
+
+        self.assertLess(stats['conflicts'], lowest_first_stats['conflicts'])
+
+    def test_claim_lun_id(self):
+
+        self._driver_setup({})
+        self.driver.map_dict = {
+            'slot_a': {'1': inventory.FreeLuns.all(4)},
+            'slot_b': {},
+        }
+        self.driver.target_dict = {
+            'slot_a': {'1': '0'},
+            'slot_b': {},
+        }
+        self.driver._conflicted_luns = {
+            ('1', '0', lun): time.monotonic() for lun in (0, 1, 2)}
+
+        self.assertEqual(
+            3, self.driver._claim_lun_id([('slot_a', '1')], 1))
+        # Services sharing a backend_host still search apart.
+        self.assertNotEqual(
+            self.driver._lun_search_seed,
+            self._get_driver(self.configuration)._lun_search_seed)
+
     def test_initialize_connection_with_create_map_fail(self):
 
         test_volume = self.cli_data.test_volume
@@ -1816,7 +2547,9 @@ class InfortrendiSCSICommonTestCase(InfortrendTestCase):
             test_volume, test_ref_volume)
 
         expect_cli_cmd = [
-            mock.call('ShowPartition', '-l', '-noinit'),
+            mock.call('ShowPartition', '-noinit'),
+            mock.call('ShowPartition', 'part=%s' % test_ref_volume_id,
+                      '-l', '-noinit'),
         ]
         self._assert_cli_has_calls(expect_cli_cmd)
         self.assertEqual(20, size)
@@ -1824,6 +2557,7 @@ class InfortrendiSCSICommonTestCase(InfortrendTestCase):
     def test_manage_existing_get_size_with_name(self):
 
         test_volume = self.cli_data.test_volume
+        test_partition_id = self.cli_data.fake_partition_id[2]
         test_ref_volume = self.cli_data.test_ref_volume_with_name
         test_pool = self.cli_data.fake_lv_id[0]
 
@@ -1839,7 +2573,9 @@ class InfortrendiSCSICommonTestCase(InfortrendTestCase):
             test_volume, test_ref_volume)
 
         expect_cli_cmd = [
-            mock.call('ShowPartition', '-l', '-noinit'),
+            mock.call('ShowPartition', '-noinit'),
+            mock.call('ShowPartition', 'part=%s' % test_partition_id,
+                      '-l', '-noinit'),
         ]
         self._assert_cli_has_calls(expect_cli_cmd)
         self.assertEqual(20, size)
@@ -1934,7 +2670,7 @@ class InfortrendiSCSICommonTestCase(InfortrendTestCase):
             test_volume, test_ref_volume)
 
         expect_cli_cmd = [
-            mock.call('ShowPartition', '-l', '-noinit'),
+            mock.call('ShowPartition', '-noinit'),
             mock.call('SetPartition', test_partition_id,
                       'name=%s' % test_volume['id']),
             mock.call('ShowDevice', '-noinit'),